@@ -1,3 +1,4 @@
+import glob
 import os
 import logging
 
@@ -5,12 +6,17 @@ import luigi
 
 from src import (
     download_faers_data,
+    verify_faers_data,
+    case_index,
     deduplicate_faers_data,
+    ingest_faers_data,
+    detect_duplicate_reports,
     mark_data,
     get_demographic_data,
     summarize_demographic_data,
     report,
 )
+from src.utils import QuestionConfig
 
 # Ensure logging is configured
 logging.basicConfig(level=logging.INFO)
@@ -25,7 +31,43 @@ logging_config = {
 }
 
 
-class Faers_Pipeline(luigi.Task):
+class RefreshableTask(luigi.Task):
+    """A task that runs again for every new `refresh_stamp`
+
+    A refresh re-validates the downloads against the mirror (see
+    `DownloadData`), which changes the inputs of every later task even though
+    their outputs exist. Once it succeeds, the task leaves a stamp file next
+    to its output, and it is complete only for the stamp it ran with. The
+    tasks are incremental, so running them again recomputes only what the
+    refresh changed.
+    """
+
+    refresh_stamp = luigi.Parameter(default="")
+
+    def stamp_file(self):
+        path = self.output().path
+        dir_stamp = path if os.path.isdir(path) else os.path.dirname(path)
+        return os.path.join(
+            dir_stamp, f"_refreshed_{self.get_task_family()}_{self.refresh_stamp}"
+        )
+
+    def complete(self):
+        if not super().complete():
+            return False
+        return not self.refresh_stamp or os.path.exists(self.stamp_file())
+
+    def on_success(self):
+        if self.refresh_stamp:
+            fn_stamp = self.stamp_file()
+            pattern = f"_refreshed_{self.get_task_family()}_*"
+            for fn in glob.glob(os.path.join(os.path.dirname(fn_stamp), pattern)):
+                os.remove(fn)
+            with open(fn_stamp, "w") as fh:
+                fh.write(self.refresh_stamp)
+        return super().on_success()
+
+
+class Faers_Pipeline(RefreshableTask):
     dir_data = "data"
     dir_external = os.path.join(dir_data, "external")
     dir_interim = os.path.join(dir_data, "interim")
@@ -36,31 +78,82 @@ class Faers_Pipeline(luigi.Task):
 
     year_q_from = luigi.Parameter(default="2013q1")
     year_q_to = luigi.Parameter(default="2023q1")
+    # Combine the reports that MinHash finds to be duplicates across caseids
+    detect_duplicates = luigi.BoolParameter(default=False)
+    # A new stamp (e.g. the date) re-fetches the quarters that changed on the
+    # mirror and recomputes only their outputs
+    refresh_stamp = luigi.Parameter(default="")
 
     def requires(self):
+        stamp = self.refresh_stamp
         # download the data
         download = DownloadData(
             dir_output=self.dir_external,
             year_q_from=self.year_q_from,
             year_q_to=self.year_q_to,
+            refresh_stamp=stamp,
         )
         yield download
 
+        # verify the downloaded archives
+        verify = VerifyData(
+            dir_in=download.output().path,
+            dependency_params={"download": download.param_kwargs},
+            refresh_stamp=stamp,
+        )
+        yield verify
+
         # deduplicate the data
         dedup = DeduplicateData(
             dir_in=download.output().path,
             dir_out=os.path.join(self.dir_interim, "faers_deduplicated"),
-            dependency_params={"download": download.param_kwargs},
+            dependency_params={"verify": verify.param_kwargs},
+            refresh_stamp=stamp,
         )
         yield dedup
+
+        # convert the tables to Parquet, once per quarter
+        ingest = IngestData(
+            dir_in=dedup.output().path,
+            dir_out=os.path.join(self.dir_interim, "faers_ingested"),
+            dependency_params={"deduplicate": dedup.param_kwargs},
+            refresh_stamp=stamp,
+        )
+        yield ingest
+
+        mark_dependencies = {
+            "deduplicate": dedup.param_kwargs,
+            "ingest": ingest.param_kwargs,
+        }
+        duplicate_clusters = ""
+        if self.detect_duplicates:
+            # find duplicate reports filed under different caseids
+            duplicates = DetectDuplicateReports(
+                year_q_from=download.year_q_from,
+                year_q_to=download.year_q_to,
+                dir_in=ingest.output().path,
+                fn_out=detect_duplicate_reports.clusters_filename(
+                    self.dir_interim, download.year_q_from, download.year_q_to
+                ),
+                dependency_params={"ingest": ingest.param_kwargs},
+                refresh_stamp=stamp,
+            )
+            yield duplicates
+            duplicate_clusters = duplicates.output().path
+            mark_dependencies["detect_duplicates"] = duplicates.param_kwargs
+
         # mark the data
         marked = MarkTheData(
             year_q_from=download.year_q_from,
             year_q_to=download.year_q_to,
-            dir_in=dedup.output().path,
+            dir_in=ingest.output().path,
             config_dir=self.config_dir,
             dir_out=os.path.join(self.dir_interim, "marked_data_v2"),
-            dependency_params={"deduplicate": dedup.param_kwargs},
+            case_index=os.path.join(dedup.output().path, case_index.INDEX_FILENAME),
+            duplicate_clusters=duplicate_clusters,
+            download_dir=download.output().path,
+            dependency_params=mark_dependencies,
+            refresh_stamp=stamp,
         )
         yield marked
 
@@ -68,12 +161,14 @@ class Faers_Pipeline(luigi.Task):
             year_q_from=download.year_q_from,
             year_q_to=download.year_q_to,
             dir_marked_data=os.path.dirname(marked.output().path),
-            dir_raw_data=dedup.output().path,
+            dir_raw_data=ingest.output().path,
             dir_config=self.config_dir,
             dir_out=os.path.join(self.dir_interim, "demographic_analysis_v2"),
             clean_on_failure=True,
+            download_dir=download.output().path,
             dependency_params={"mark_the_data": marked.param_kwargs},
             threads=1,
+            refresh_stamp=stamp,
         )
         yield demographic_data
 
@@ -83,19 +178,22 @@ class Faers_Pipeline(luigi.Task):
             dir_out=os.path.join(self.dir_interim, "demographic_summary_v2"),
             clean_on_failure=True,
             dependency_params={"get_demographic_data": demographic_data.param_kwargs},
+            refresh_stamp=stamp,
         )
         yield demographic_summary
 
         yielded_report = Report(
             dir_marked_data=os.path.dirname(marked.output().path),
-            dir_raw_data=dedup.output().path,
+            dir_raw_data=ingest.output().path,
             config_dir=self.config_dir,
             dir_reports=self.output().path,
             output_raw_exposure_data=True,
+            duplicate_clusters=duplicate_clusters,
             dependency_params={
                 "mark_the_data": marked.param_kwargs,
-                "deduplicate": dedup.param_kwargs,
+                "ingest": ingest.param_kwargs,
             },
+            refresh_stamp=stamp,
         )
         yield yielded_report
 
@@ -103,11 +201,21 @@ class Faers_Pipeline(luigi.Task):
         return luigi.LocalTarget(os.path.join(self.dir_processed, "reports"))
 
 
-class DownloadData(luigi.Task):
+def refreshed_quarters(task):
+    """The quarters that the refresh `task` belongs to re-fetched, if any"""
+    if not (task.refresh_stamp and task.download_dir):
+        return None
+    return download_faers_data.read_changed_quarters(task.download_dir)
+
+
+class DownloadData(RefreshableTask):
     dir_output = luigi.Parameter()
     year_q_from = luigi.Parameter()
     year_q_to = luigi.Parameter()
     threads = luigi.IntParameter(default=4)
+    engine = luigi.Parameter(default="async")
+    # Only applies when the task runs; a new refresh_stamp makes it run again
+    refresh = luigi.BoolParameter(default=False)
 
     def output(self):
         dir_target = os.path.join(self.dir_output, "faers")
@@ -121,6 +229,8 @@ class DownloadData(luigi.Task):
             year_q_to=self.year_q_to,
             dir_out=self.output().path,
             threads=self.threads,
+            engine=self.engine,
+            refresh=self.refresh or bool(self.refresh_stamp),
         )
         # After download, log all files that should be present
         expected_files = download_faers_data.get_expected_filenames(
@@ -138,15 +248,39 @@ class DownloadData(luigi.Task):
         assert os.path.exists(self.output().path)
 
 
-class DeduplicateData(luigi.Task):
+class VerifyData(RefreshableTask):
     dir_in = luigi.Parameter()
-    dir_out = luigi.Parameter()
     threads = luigi.IntParameter(default=4)
+    remove_corrupt = luigi.BoolParameter(default=False)
     dependency_params = luigi.DictParameter()
 
     def requires(self):
         return [DownloadData(**(self.dependency_params["download"]))]
 
+    def output(self):
+        return luigi.LocalTarget(
+            os.path.join(self.dir_in, verify_faers_data.SUCCESS_FILENAME)
+        )
+
+    def run(self):
+        verify_faers_data.main(
+            dir_in=self.dir_in,
+            threads=self.threads,
+            remove_corrupt=self.remove_corrupt,
+        )
+
+
+class DeduplicateData(RefreshableTask):
+    dir_in = luigi.Parameter()
+    dir_out = luigi.Parameter()
+    threads = luigi.IntParameter(default=4)
+    mode = luigi.Parameter(default="case_version")
+    materialize = luigi.Parameter(default="auto")
+    dependency_params = luigi.DictParameter()
+
+    def requires(self):
+        return [VerifyData(**(self.dependency_params["verify"]))]
+
     def input(self):
         return luigi.LocalTarget(self.dir_in)
 
@@ -155,28 +289,113 @@ class DeduplicateData(luigi.Task):
 
     def run(self):
         deduplicate_faers_data.main(
+            dir_in=self.input().path,
+            dir_out=self.output().path,
+            threads=self.threads,
+            mode=self.mode,
+            materialize=self.materialize,
+        )
+
+
+class IngestData(RefreshableTask):
+    dir_in = luigi.Parameter()
+    dir_out = luigi.Parameter()
+    threads = luigi.IntParameter(default=4)
+    dependency_params = luigi.DictParameter()
+
+    def requires(self):
+        return [DeduplicateData(**(self.dependency_params["deduplicate"]))]
+
+    def input(self):
+        return luigi.LocalTarget(self.dir_in)
+
+    def output(self):
+        return luigi.LocalTarget(self.dir_out)
+
+    def run(self):
+        ingest_faers_data.main(
             dir_in=self.input().path, dir_out=self.output().path, threads=self.threads
         )
 
 
-class MarkTheData(luigi.Task):
+class DetectDuplicateReports(RefreshableTask):
     year_q_from = luigi.Parameter()
     year_q_to = luigi.Parameter()
-    dir_in = luigi.Parameter(default="data/interim/faers_deduplicated")
+    dir_in = luigi.Parameter()
+    fn_out = luigi.Parameter()
+    threshold = luigi.FloatParameter(default=0.8)
+    dependency_params = luigi.DictParameter()
+
+    def requires(self):
+        return [IngestData(**(self.dependency_params["ingest"]))]
+
+    def output(self):
+        return luigi.LocalTarget(self.fn_out)
+
+    def run(self):
+        detect_duplicate_reports.main(
+            year_q_from=self.year_q_from,
+            year_q_to=self.year_q_to,
+            dir_in=self.dir_in,
+            fn_out=self.output().path,
+            threshold=self.threshold,
+        )
+
+
+class MarkTheData(RefreshableTask):
+    year_q_from = luigi.Parameter()
+    year_q_to = luigi.Parameter()
+    dir_in = luigi.Parameter(default="data/interim/faers_ingested")
     config_dir = luigi.Parameter(default="config")
     dir_out = luigi.Parameter(default="data/interim/marked_data_v2")
     threads = luigi.IntParameter(default=7)
     dependency_params = luigi.DictParameter(default={})
     version = luigi.Parameter(default="v3")
+    case_index = luigi.Parameter(default="")
+    duplicate_clusters = luigi.Parameter(default="")
+    shards = luigi.IntParameter(default=1)
+    marking_engine = luigi.Parameter(default="dense")
+    filtered_read = luigi.BoolParameter(
+        default=True, parsing=luigi.BoolParameter.EXPLICIT_PARSING
+    )
+    merge_quarters = luigi.BoolParameter(
+        default=True, parsing=luigi.BoolParameter.EXPLICIT_PARSING
+    )
+    combined_file = luigi.BoolParameter(
+        default=False, parsing=luigi.BoolParameter.EXPLICIT_PARSING
+    )
+    chunksize = luigi.IntParameter(default=1 << 20)
+    memory_limit = luigi.FloatParameter(default=0.0)
+    append = luigi.BoolParameter(
+        default=False, parsing=luigi.BoolParameter.EXPLICIT_PARSING
+    )
+    # Where DownloadData records the quarters that a refresh re-fetched
+    download_dir = luigi.Parameter(default="")
 
     def requires(self):
-        return DeduplicateData(**self.dependency_params.get("deduplicate", {}))
+        ret = [IngestData(**self.dependency_params.get("ingest", {}))]
+        if "deduplicate" in self.dependency_params:
+            ret.append(DeduplicateData(**self.dependency_params["deduplicate"]))
+        if "detect_duplicates" in self.dependency_params:
+            ret.append(
+                DetectDuplicateReports(**self.dependency_params["detect_duplicates"])
+            )
+        return ret
 
     def output(self):
-        return luigi.LocalTarget(os.path.join(self.dir_out, "_SUCCESS"))
+        # A new or changed config, case index or duplicate clusters makes
+        # the task incomplete. Rerunning it marks only the configs that are
+        # not marked yet.
+        config_items = QuestionConfig.load_config_items(self.config_dir)
+        fingerprint = mark_data.configs_fingerprint(
+            config_items, inputs=[self.case_index, self.duplicate_clusters]
+        )
+        return luigi.LocalTarget(os.path.join(self.dir_out, f"_SUCCESS_{fingerprint}"))
 
     def run(self):
         os.makedirs(self.dir_out, exist_ok=True)
+        for fn in glob.glob(os.path.join(self.dir_out, "_SUCCESS*")):
+            os.remove(fn)
         mark_data.main(
             year_q_from=self.year_q_from,
             year_q_to=self.year_q_to,
@@ -185,6 +404,17 @@ class MarkTheData(luigi.Task):
             dir_out=self.dir_out,
             threads=self.threads,
             clean_on_failure=True,
+            fn_case_index=self.case_index or None,
+            fn_duplicate_clusters=self.duplicate_clusters or None,
+            shards=self.shards,
+            marking_engine=self.marking_engine,
+            filtered_read=self.filtered_read,
+            merge_quarters=self.merge_quarters,
+            combined_file=self.combined_file,
+            chunksize=self.chunksize,
+            memory_limit=self.memory_limit,
+            append=self.append,
+            changed_quarters=refreshed_quarters(self),
         )
         with self.output().open("w") as out_file:
             out_file.write(
@@ -194,7 +424,7 @@ class MarkTheData(luigi.Task):
             out_file.write(f"Version: {self.version}")
 
 
-class GetDemographicData(luigi.Task):
+class GetDemographicData(RefreshableTask):
     year_q_from = luigi.Parameter()
     year_q_to = luigi.Parameter()
     dir_marked_data = luigi.Parameter()
@@ -203,6 +433,7 @@ class GetDemographicData(luigi.Task):
     dir_out = luigi.Parameter()
     threads = luigi.IntParameter(default=4)
     clean_on_failure = luigi.BoolParameter(default=True)
+    download_dir = luigi.Parameter(default="")
     dependency_params = luigi.DictParameter(default=dict())
 
     def requires(self):
@@ -229,12 +460,13 @@ class GetDemographicData(luigi.Task):
             dir_out=self.dir_out,
             threads=self.threads,
             clean_on_failure=self.clean_on_failure,
+            changed_quarters=refreshed_quarters(self),
         )
         with self.output().open("w") as out_file:
             out_file.write("success")
 
 
-class SummarizeDemographicData(luigi.Task):
+class SummarizeDemographicData(RefreshableTask):
     dir_demography_data = luigi.Parameter()
     dir_config = luigi.Parameter()
     dir_out = luigi.Parameter()
@@ -265,12 +497,14 @@ class SummarizeDemographicData(luigi.Task):
             out_file.write("success")
 
 
-class Report(luigi.Task):
+class Report(RefreshableTask):
     dir_marked_data = luigi.Parameter(default="data/interim/marked_data_v2")
-    dir_raw_data = luigi.Parameter(default="data/interim/faers_deduplicated")
+    dir_raw_data = luigi.Parameter(default="data/interim/faers_ingested")
     config_dir = luigi.Parameter(default="config")
     dir_reports = luigi.Parameter(default="data/processed/reports")
     output_raw_exposure_data = luigi.BoolParameter(default=True)
+    threads = luigi.IntParameter(default=1)
+    duplicate_clusters = luigi.Parameter(default="")
     dependency_params = luigi.DictParameter(default={})
     version = luigi.Parameter(default="v3")
 
@@ -288,6 +522,8 @@ class Report(luigi.Task):
             config_dir=self.config_dir,
             dir_reports=self.dir_reports,
             output_raw_exposure_data=self.output_raw_exposure_data,
+            threads=self.threads,
+            fn_duplicate_clusters=self.duplicate_clusters or None,
         )
         with self.output().open("w") as out_file:
             out_file.write(f"Reports generated using data from {self.dir_marked_data}")
@@ -0,0 +1,123 @@
+import logging
+import time
+
+import defopt
+import numpy as np
+import pandas as pd
+
+from src import utils
+from src.mark_data import (
+    handle_duplicates,
+    handle_duplicates_within_case,
+    load_quarters,
+    merge_marks,
+)
+from src.utils import Quarter, QuestionConfig, generate_quarters
+
+logger = logging.getLogger("FAERS")
+
+
+def handle_duplicates_groupby_apply(df):
+    """The original `handle_duplicates`, one Python call per duplicated case"""
+    cols_boolean = [c for c in df.columns if df.dtypes[c] == np.dtype(bool)]
+    cols_rest = [c for c in df.columns if (c not in cols_boolean) and (c != "q")]
+    rows_per_caseid = df["caseid"].value_counts()
+    df["rows_per_caseid"] = rows_per_caseid.reindex(df.caseid).values
+    sel = df.rows_per_caseid == 1
+    already_good = df.loc[sel]
+    need_to_fix = df.loc[~sel]
+    fixed = need_to_fix.groupby("caseid").apply(
+        lambda d: handle_duplicates_within_case(d, cols_boolean, cols_rest)
+    )
+    ret = pd.concat([already_good, fixed], sort=False)
+    uniqueness = utils.compute_df_uniqueness(ret, ["caseid"], do_print=False)
+    assert uniqueness == 1.0
+    return ret.set_index("caseid")
+
+
+def synthetic_merged(n_cases, n_flags=20, max_rows_per_case=4, seed=0):
+    """A `merge_marks`-like table with a random number of rows per case"""
+    rng = np.random.default_rng(seed)
+    rows_per_case = rng.integers(1, max_rows_per_case + 1, size=n_cases)
+    caseids = np.repeat(np.arange(n_cases), rows_per_case)
+    n = len(caseids)
+    ret = pd.DataFrame(
+        {
+            "caseid": caseids,
+            "age": np.where(rng.random(n) < 0.2, np.nan, rng.uniform(0, 90, n)),
+            "sex": rng.choice(["F", "M", None], size=n),
+            "wt": rng.uniform(3, 150, n),
+            "event_date": rng.choice(["20190101", "20200315", None], size=n),
+            "q": rng.choice(["2020q1", "2020q2", "2020q3"], size=n),
+        }
+    )
+    for i in range(n_flags):
+        ret[f"flag {i}"] = rng.random(n) < 0.05
+    return utils.categorize(ret).sort_values(["caseid", "q"])
+
+
+def timed(func, df):
+    t = time.perf_counter()
+    ret = func(df.copy())
+    return ret, time.perf_counter() - t
+
+
+def main(
+    *,
+    year_q_from=None,
+    year_q_to=None,
+    dir_in=None,
+    config_dir=None,
+    n_synthetic_cases=1_000_000,
+):
+    """
+    Compare the run time of the vectorized `handle_duplicates` with the
+    original groupby().apply() implementation, and check that both return
+    the same table
+
+    :param str year_q_from:
+        XXXXqQ, where XXXX is the year, q is the literal "q" and Q is 1, 2, 3 or 4
+    :param str year_q_to:
+        XXXXqQ, where XXXX is the year, q is the literal "q" and Q is 1, 2, 3 or 4
+    :param str dir_in:
+        Directory with the FAERS tables. If not given, synthetic data is used
+    :param str config_dir:
+        Directory with config files
+    :param int n_synthetic_cases:
+        N of cases in the synthetic data
+
+    :return: None
+
+    """
+    if dir_in is None:
+        df = synthetic_merged(n_synthetic_cases)
+    else:
+        quarters = list(generate_quarters(Quarter(year_q_from), Quarter(year_q_to)))
+        config_items = QuestionConfig.load_config_items(config_dir)
+        drug_names = set()
+        reaction_types = set()
+        for config in config_items:
+            drug_names.update(set(config.drugs))
+            if config.control is not None:
+                drug_names.update(set(config.control))
+            reaction_types.update(set(config.reactions))
+        df_drug, df_reac, df_demo = load_quarters(
+            quarters, dir_in, drug_names, reaction_types
+        )
+        df = merge_marks(df_drug, df_reac, df_demo, config_items)
+    print(f"{len(df):,d} rows of {df.caseid.nunique():,d} cases")
+
+    new, t_new = timed(handle_duplicates, df)
+    print(f"vectorized:        {t_new:8.2f} s")
+    old, t_old = timed(handle_duplicates_groupby_apply, df)
+    print(f"groupby().apply(): {t_old:8.2f} s")
+    print(f"speedup:           {t_old / t_new:8.1f}x")
+
+    # groupby().apply() returns the fixed rows with the object dtype
+    old = old.astype(new.dtypes.to_dict())
+    pd.testing.assert_frame_equal(new, old)
+    print("The results are identical")
+
+
+if __name__ == "__main__":
+    defopt.run(main)
@@ -0,0 +1,194 @@
+import json
+import logging
+import os
+
+import defopt
+import numpy as np
+
+from src import utils
+from src.utils import Quarter
+
+logger = logging.getLogger("FAERS")
+
+INDEX_FILENAME = "case_index.npy"
+INDEX_DTYPE = np.dtype([("caseid", "<i8"), ("quarter", "<i4"), ("primaryid", "<i8")])
+
+
+class CaseIndex:
+    """Map of every caseid to the quarter and primaryid of its latest version
+
+    The index is a single structured numpy array sorted by caseid and saved as
+    a `.npy` file, so that it can be memory-mapped and searched with binary
+    search. The quarters that were added to the index, and the modification
+    times of their demographic tables, are kept in a `.json` sidecar so that
+    the index can be updated incrementally.
+    """
+
+    def __init__(self, entries=None, quarters=None):
+        if entries is None:
+            entries = np.empty(0, dtype=INDEX_DTYPE)
+        self.entries = entries
+        self.quarters = dict(quarters or {})
+
+    @staticmethod
+    def meta_filename(fn):
+        return os.path.splitext(fn)[0] + ".json"
+
+    @classmethod
+    def load(cls, fn, mmap_mode="r"):
+        if not os.path.exists(fn):
+            return cls()
+        entries = np.load(fn, mmap_mode=mmap_mode)
+        with open(cls.meta_filename(fn)) as fh:
+            quarters = json.load(fh)["quarters"]
+        return cls(entries, quarters)
+
+    def save(self, fn):
+        with open(fn + ".part", "wb") as fh:
+            np.save(fh, np.asarray(self.entries))
+        os.replace(fn + ".part", fn)
+        fn_meta = self.meta_filename(fn)
+        with open(fn_meta + ".part", "w") as fh:
+            json.dump({"quarters": self.quarters}, fh, indent=1, sort_keys=True)
+        os.replace(fn_meta + ".part", fn_meta)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def update(self, q, caseids, primaryids, version=None):
+        """Add the cases reported in quarter `q`
+
+        Entries previously added for `q` are replaced. A case keeps the entry
+        from the latest quarter it was reported in.
+        """
+        q = Quarter(str(q))
+        new = np.empty(len(caseids), dtype=INDEX_DTYPE)
+        new["caseid"] = utils.to_int64(caseids, "caseid")
+        new["quarter"] = q.ordinal()
+        new["primaryid"] = utils.to_int64(primaryids, "primaryid")
+        old = np.asarray(self.entries)
+        old = old[old["quarter"] != q.ordinal()]
+        merged = np.concatenate([old, new])
+        # np.lexsort sorts by the last key first
+        order = np.lexsort((merged["primaryid"], merged["quarter"], merged["caseid"]))
+        merged = merged[order]
+        is_last = np.ones(len(merged), dtype=bool)
+        is_last[:-1] = merged["caseid"][1:] != merged["caseid"][:-1]
+        self.entries = merged[is_last]
+        self.quarters[str(q)] = version
+
+    def lookup(self, caseids):
+        """Positions of `caseids` in the index and whether they were found"""
+        caseids = utils.to_int64(caseids, "caseid")
+        keys = self.entries["caseid"]
+        if not len(keys):
+            return np.zeros(len(caseids), dtype=int), np.zeros(len(caseids), bool)
+        pos = np.minimum(np.searchsorted(keys, caseids), len(keys) - 1)
+        found = keys[pos] == caseids
+        return pos, found
+
+    def latest_quarter(self, caseids):
+        """The latest quarter each case was reported in, or None if unknown"""
+        pos, found = self.lookup(caseids)
+        return [
+            str(Quarter.from_ordinal(self.entries["quarter"][p])) if f else None
+            for p, f in zip(pos, found)
+        ]
+
+    def is_latest_quarter(self, caseids, q):
+        """Whether `q` is the latest quarter each case was reported in
+
+        Cases that are not in the index are considered to be the latest.
+        """
+        pos, found = self.lookup(caseids)
+        return ~found | (self.entries["quarter"][pos] == Quarter(str(q)).ordinal())
+
+    def is_latest(self, caseids, primaryids):
+        """Whether each (caseid, primaryid) row is the latest version of its case
+
+        Cases that are not in the index are considered to be the latest.
+        """
+        pos, found = self.lookup(caseids)
+        primaryids = utils.to_int64(primaryids, "primaryid")
+        return ~found | (self.entries["primaryid"][pos] == primaryids)
+
+
+def update_index(fn_index, dir_in, quarters=None, save=True):
+    """Add to the index the quarters in `dir_in` that are new or changed
+
+    If `quarters` are given, only these quarters are indexed. An index that
+    holds other quarters is rebuilt: the entry of a case from a quarter that
+    is left out may hide its latest version in the given ones. Unless `save`,
+    the updated index is only returned.
+    """
+    index = CaseIndex.load(fn_index, mmap_mode=None)
+    available = []
+    for fn in os.listdir(dir_in):
+        if fn.startswith("demo") and fn.endswith(utils.INGESTED_EXTENSION):
+            available.append(Quarter(fn[len("demo") : -len(utils.INGESTED_EXTENSION)]))
+    if quarters is not None:
+        wanted = {str(q) for q in quarters}
+        available = [q for q in available if str(q) in wanted]
+        if set(index.quarters) - wanted:
+            index = CaseIndex()
+    quarters = available
+    n_updated = 0
+    for q in sorted(quarters):
+        fn_demo = utils.quarter_table_filename(dir_in, "demo", q)
+        version = os.path.getmtime(fn_demo)
+        if index.quarters.get(str(q)) == version:
+            continue
+        df = utils.read_table(fn_demo, columns=["caseid", "primaryid"])
+        index.update(q, df.caseid.values, df.primaryid.values, version=version)
+        n_updated += 1
+    if n_updated:
+        logger.info(
+            f"Updated {n_updated} quarters, the index has {len(index):,d} cases"
+        )
+    if n_updated and save:
+        index.save(fn_index)
+    return index
+
+
+def _latest_versions(index, caseids):
+    """The quarter ordinal and primaryid of `caseids` in `index`, -1 if absent"""
+    pos, found = index.lookup(caseids)
+    entries = np.asarray(index.entries)
+    quarters = np.full(len(caseids), -1, dtype=np.int64)
+    primaryids = np.full(len(caseids), -1, dtype=np.int64)
+    quarters[found] = entries["quarter"][pos[found]]
+    primaryids[found] = entries["primaryid"][pos[found]]
+    return quarters, primaryids
+
+
+def changed_cases(before, after):
+    """The cases whose latest version differs between two indexes
+
+    Returns their caseids and their quarter ordinals in `before` and in
+    `after`, -1 where an index does not have the case.
+    """
+    caseids = np.union1d(before.entries["caseid"], after.entries["caseid"])
+    quarters_before, primaryids_before = _latest_versions(before, caseids)
+    quarters_after, primaryids_after = _latest_versions(after, caseids)
+    changed = (quarters_before != quarters_after) | (
+        primaryids_before != primaryids_after
+    )
+    return caseids[changed], quarters_before[changed], quarters_after[changed]
+
+
+def main(*, fn_index, dir_in):
+    """
+
+    :param str fn_index:
+        The index file (.npy)
+    :param str dir_in:
+        Directory with the deduplicated demographic tables
+
+    :return: None
+
+    """
+    update_index(fn_index, dir_in)
+
+
+if __name__ == "__main__":
+    defopt.run(main)
@@ -0,0 +1,177 @@
+import json
+import logging
+import os
+
+import numpy as np
+import pandas as pd
+
+from src import marked_store
+
+logger = logging.getLogger("FAERS")
+
+CASE_TABLE_SUBDIR = "case_table"
+META_FILENAME = "case_table.json"
+# FAERS dates, YYYYMMDD or, if partial, YYYYMM or YYYY
+DATE_COLUMNS = ["event_date"]
+
+
+def _dates(values):
+    """FAERS dates as datetime64[s], which pandas uses without a copy
+
+    A partial date falls on the first day of its month or year. Missing and
+    invalid dates are NaT.
+    """
+    if np.issubdtype(np.asarray(values).dtype, np.datetime64):
+        return np.asarray(values).astype("datetime64[s]")
+    s = pd.Series(values, dtype=object).where(pd.notna(values)).astype("string")
+    s = s.where(s.str.len() != 4, s + "0101")
+    s = s.where(s.str.len() != 6, s + "01")
+    ret = pd.to_datetime(s, format="%Y%m%d", errors="coerce")
+    return ret.values.astype("datetime64[s]")
+
+
+class CaseTable:
+    """The demographic columns of the marked cases, indexed by case ordinal
+
+    The case with ordinal i is row i of the marked data store, with its
+    quarters in order. Every column is a numpy array saved as a `.npy` file,
+    so that the table can be memory-mapped: the processes that load it share
+    one copy in the page cache, and a process selects the rows it needs by
+    their ordinals. Categorical columns are saved as their codes
+    and the `DATE_COLUMNS` as datetime64, so that `frame` can use the mapped
+    arrays as they are. Other string columns are saved as fixed-width UTF-8
+    bytes, which are decoded by every call. A `.json` sidecar keeps the
+    dtypes and the modification times of the store files the table was
+    built from.
+    """
+
+    def __init__(self, arrays, meta):
+        self.arrays = arrays
+        self.meta = meta
+
+    @staticmethod
+    def directory(dir_marked):
+        return os.path.join(dir_marked, CASE_TABLE_SUBDIR)
+
+    @classmethod
+    def from_frame(cls, df, versions=None):
+        """The table of `df`, a frame indexed by caseid"""
+        arrays = {"caseid": df.index.values}
+        columns = {}
+        for c in df.columns:
+            values = df[c]
+            if isinstance(values.dtype, pd.CategoricalDtype):
+                arrays[c] = values.cat.codes.values
+                columns[c] = {
+                    "categories": values.cat.categories.tolist(),
+                    "ordered": bool(values.cat.ordered),
+                }
+            elif c in DATE_COLUMNS:
+                arrays[c] = _dates(values.values)
+                columns[c] = {"date": True}
+            elif values.dtype == object:
+                # Missing values are saved as empty strings
+                strings = values.where(values.notna(), "").values.astype(str)
+                arrays[c] = np.char.encode(strings, "utf-8")
+                columns[c] = {"strings": True}
+            else:
+                arrays[c] = values.values
+                columns[c] = {}
+        return cls(arrays, {"columns": columns, "versions": dict(versions or {})})
+
+    @classmethod
+    def load(cls, dir_marked, mmap_mode="r"):
+        """The table saved in `dir_marked`, or None if there is none"""
+        d = cls.directory(dir_marked)
+        fn_meta = os.path.join(d, META_FILENAME)
+        if not os.path.exists(fn_meta):
+            return None
+        with open(fn_meta) as fh:
+            meta = json.load(fh)
+        arrays = {
+            c: np.load(os.path.join(d, f"{c}.npy"), mmap_mode=mmap_mode)
+            for c in ["caseid"] + list(meta["columns"])
+        }
+        return cls(arrays, meta)
+
+    def save(self, dir_marked):
+        d = self.directory(dir_marked)
+        os.makedirs(d, exist_ok=True)
+        fn_meta = os.path.join(d, META_FILENAME)
+        # Until all the columns are saved, so that a partial table is not loaded
+        if os.path.exists(fn_meta):
+            os.remove(fn_meta)
+        for c, values in self.arrays.items():
+            fn = os.path.join(d, f"{c}.npy")
+            with open(fn + ".part", "wb") as fh:
+                np.save(fh, np.asarray(values))
+            os.replace(fn + ".part", fn)
+        with open(fn_meta + ".part", "w") as fh:
+            json.dump(self.meta, fh, indent=1)
+        os.replace(fn_meta + ".part", fn_meta)
+
+    def __len__(self):
+        return len(self.arrays["caseid"])
+
+    @property
+    def columns(self):
+        return list(self.meta["columns"])
+
+    def frame(self, ordinals=None, columns=None):
+        """The rows of the cases with `ordinals` (all by default), indexed by
+        caseid
+
+        The rows are selected on the memory-mapped arrays, so that only they
+        are read and copied. Without `ordinals`, the numeric and date columns
+        are views of the arrays rather than copies.
+        """
+        if columns is None:
+            columns = self.columns
+
+        def take(values):
+            return values if ordinals is None else values[ordinals]
+
+        data = {}
+        for c in columns:
+            info = self.meta["columns"][c]
+            values = take(self.arrays[c])
+            if "categories" in info:
+                dtype = pd.CategoricalDtype(info["categories"], info["ordered"])
+                values = pd.Categorical.from_codes(values, dtype=dtype)
+            elif info.get("strings"):
+                values = pd.Series(np.char.decode(values, "utf-8"), dtype=object)
+                values = values.where(values != "", np.nan).values
+            data[c] = values
+        index = pd.Index(take(self.arrays["caseid"]), name="caseid", copy=False)
+        return pd.DataFrame(data, index=index, copy=False)
+
+
+def store_versions(dir_marked):
+    """The modification time of each quarter file of the marked data store"""
+    return {
+        q: os.path.getmtime(marked_store.quarter_filename(dir_marked, q))
+        for q in marked_store.stored_quarters(dir_marked)
+    }
+
+
+def load_case_table(dir_marked, columns=marked_store.DEMOGRAPHIC_COLUMNS):
+    """The case table of the marked data store, memory-mapped
+
+    The table is (re)built if the store changed since it was saved, or if
+    its dates were saved as strings.
+    """
+    versions = store_versions(dir_marked)
+    table = CaseTable.load(dir_marked)
+    if (
+        table is not None
+        and table.meta["versions"] == versions
+        and table.columns == list(columns)
+        and all(
+            table.meta["columns"][c].get("date") for c in columns if c in DATE_COLUMNS
+        )
+    ):
+        return table
+    df = marked_store.read_marked(dir_marked, list(versions), columns=columns)
+    logger.info(f"Saving the case table of {len(df):,d} cases")
+    CaseTable.from_frame(df[list(columns)], versions).save(dir_marked)
+    return CaseTable.load(dir_marked)
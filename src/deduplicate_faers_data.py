@@ -1,25 +1,171 @@
 import glob
 import logging
 import os
+import re
 import shutil
+from functools import partial
+from multiprocessing import Pool
 from multiprocessing.dummy import Pool as ThreadPool
 
 import defopt
+import pandas as pd
 import tqdm
 
+from src import case_index, utils
+
 logger = logging.getLogger("FAERS")
 
+# Tables whose rows are linked to a report version through `primaryid`
+DEDUPLICATED_TABLES = ["demo", "drug", "reac", "outc", "ther"]
+
+
+MATERIALIZE_STRATEGIES = ("auto", "hardlink", "copy_file_range", "sendfile", "stream")
+
+
+def _copy_with_kernel(fn_in, fn_out, copy_func):
+    """Copy a file in kernel space with `os.copy_file_range` or `os.sendfile`"""
+    with open(fn_in, "rb") as f_in, open(fn_out, "wb") as f_out:
+        remaining = os.fstat(f_in.fileno()).st_size
+        offset = 0
+        while remaining > 0:
+            if copy_func is os.sendfile:
+                n = os.sendfile(f_out.fileno(), f_in.fileno(), offset, remaining)
+            else:
+                n = os.copy_file_range(
+                    f_in.fileno(), f_out.fileno(), remaining, offset_src=offset
+                )
+            if n == 0:
+                break
+            offset += n
+            remaining -= n
+
+
+def _copy_streamed(fn_in, fn_out, chunk_size=1 << 20):
+    with open(fn_in, "rb") as f_in, open(fn_out, "wb") as f_out:
+        shutil.copyfileobj(f_in, f_out, length=chunk_size)
+
+
+def materialize_file(file_in, file_out, strategy="auto"):
+    """Make `file_out` an exact copy of `file_in` without reading it into memory
+
+    With the "auto" strategy, a hard link is tried first. If the files are on
+    different file systems, the data is copied in the kernel
+    (`os.copy_file_range`, then `os.sendfile`). Streamed, chunked copying is
+    the last resort. The output is written to a temporary file that is renamed
+    once complete.
+    """
+    if strategy not in MATERIALIZE_STRATEGIES:
+        raise ValueError(f"Unknown materialization strategy {strategy}")
+    file_tmp = file_out + ".part"
+    if os.path.exists(file_tmp):
+        os.remove(file_tmp)
+    attempts = [
+        ("hardlink", os.link),
+        ("copy_file_range", partial(_copy_with_kernel, copy_func=os.copy_file_range)),
+        ("sendfile", partial(_copy_with_kernel, copy_func=os.sendfile)),
+        ("stream", _copy_streamed),
+    ]
+    if strategy != "auto":
+        attempts = [a for a in attempts if a[0] == strategy]
+    for i, (name, func) in enumerate(attempts):
+        try:
+            func(file_in, file_tmp)
+        except (OSError, AttributeError) as err:
+            # AttributeError: os.copy_file_range or os.sendfile do not exist
+            # on this platform
+            if i == len(attempts) - 1:
+                raise
+            logger.debug(f"Could not {name} {file_in}, falling back: {err}")
+            if os.path.exists(file_tmp):
+                os.remove(file_tmp)
+        else:
+            break
+    if name != "hardlink":
+        shutil.copystat(file_in, file_tmp)
+    os.replace(file_tmp, file_out)
+    return name
+
 
-def deduplicate_file(file_in, dir_out):
+def deduplicate_file(file_in, dir_out, strategy="auto"):
     fn = os.path.split(file_in)[-1]
     file_out = os.path.join(dir_out, fn)
-    if os.path.exists(file_out):
+    if utils.is_up_to_date(file_out, [file_in]):
         logger.debug(f"Skipping {file_in} because {file_out} already exists")
         return
-    open(file_out, "wb").write(open(file_in, "rb").read())
+    materialize_file(file_in, file_out, strategy=strategy)
+
+
+def latest_case_versions(df_demo):
+    """The `primaryid`s of the latest version of each case
+
+    Following the FDA recommendation, the latest version of a case is the one
+    with the highest `caseversion`. Ties are broken by the FDA receipt date
+    and then by the highest `primaryid`.
+    """
+    keys = pd.DataFrame(
+        {
+            "caseid": pd.to_numeric(df_demo["caseid"], errors="coerce"),
+            "caseversion": pd.to_numeric(df_demo["caseversion"], errors="coerce"),
+            "fda_dt": pd.to_numeric(df_demo["fda_dt"], errors="coerce"),
+            "primaryid": pd.to_numeric(df_demo["primaryid"], errors="coerce"),
+        },
+        index=df_demo.index,
+    )
+    keys = keys.sort_values(
+        ["caseid", "caseversion", "fda_dt", "primaryid"], kind="stable"
+    )
+    latest = ~keys.caseid.duplicated(keep="last")
+    return set(df_demo.loc[keys.index[latest.values], "primaryid"])
+
+
+def deduplicate_quarter(q, dir_in, dir_out, engine="pyarrow"):
+    """Keep only the latest version of each case reported in quarter `q`
+
+    The deduplicated tables are saved as typed, column-pruned Parquet files,
+    the same files the ingest stage would produce.
+    """
+    files_in = {
+        table: os.path.join(dir_in, f"{table}{q}{utils.RAW_EXTENSION}")
+        for table in DEDUPLICATED_TABLES
+    }
+    files_in = {table: fn for table, fn in files_in.items() if os.path.exists(fn)}
+    files_out = {
+        table: os.path.join(dir_out, f"{table}{q}{utils.INGESTED_EXTENSION}")
+        for table in files_in
+    }
+    if all(
+        utils.is_up_to_date(files_out[table], files_in.values()) for table in files_in
+    ):
+        logger.debug(f"Skipping {q} because it is already deduplicated")
+        return
+    if "demo" not in files_in:
+        raise FileNotFoundError(f"No demographic data for {q} in {dir_in}")
+
+    tables = {}
+    for table, fn in files_in.items():
+        dtypes = utils.FAERS_TABLE_DTYPES[table]
+        tables[table] = utils.read_table(
+            fn, columns=dtypes.keys(), dtype=dtypes, engine=engine
+        )
+    primaryids = latest_case_versions(tables["demo"])
+    for table, df in tables.items():
+        sel = df.primaryid.isin(primaryids)
+        logger.info(
+            f"{q} {table}: keeping {sel.sum():,d} of {len(df):,d} rows "
+            f"({len(primaryids):,d} cases)"
+        )
+        utils.write_table(df.loc[sel], files_out[table])
 
 
-def main(*, dir_in, dir_out, threads=4):
+def main(
+    *,
+    dir_in,
+    dir_out,
+    threads=4,
+    mode="case_version",
+    engine="pyarrow",
+    materialize="auto",
+):
     """
 
     :param str dir_in:
@@ -28,6 +174,16 @@ def main(*, dir_in, dir_out, threads=4):
         Output directory
     :param int threads:
         N of parallel threads
+    :param str mode:
+        "case_version" keeps only the latest version of every case in each
+        quarter, saves the tables as Parquet and updates the caseid index
+        (`case_index.npy`). "copy" copies the files as they are
+    :param str engine:
+        CSV parser used in the "case_version" mode, "pyarrow" or "pandas"
+    :param str materialize:
+        How the "copy" mode materializes files: "hardlink",
+        "copy_file_range", "sendfile", "stream" or "auto" (the first one
+        that works, in this order)
 
     :return: None
 
@@ -37,16 +193,49 @@ def main(*, dir_in, dir_out, threads=4):
     dir_out = os.path.abspath(dir_out)
     os.makedirs(dir_out, exist_ok=True)
     try:
-        in_files = glob.glob(os.path.join(dir_in, "*.*"))
-        with ThreadPool(threads) as pool:
-            _ = list(
-                tqdm.tqdm(
-                    pool.imap(
-                        lambda file_in: deduplicate_file(file_in, dir_out), in_files
-                    ),
-                    total=len(in_files),
+        in_files = glob.glob(os.path.join(dir_in, "*.csv.zip"))
+        if mode == "copy":
+            with ThreadPool(threads) as pool:
+                _ = list(
+                    tqdm.tqdm(
+                        pool.imap(
+                            lambda file_in: deduplicate_file(
+                                file_in, dir_out, strategy=materialize
+                            ),
+                            in_files,
+                        ),
+                        total=len(in_files),
+                    )
+                )
+        elif mode == "case_version":
+            quarters = set()
+            for fn in in_files:
+                m = re.search(r"^demo(\d\d\d\dq\d)\.csv\.zip$", os.path.split(fn)[-1])
+                if m is not None:
+                    quarters.add(m.group(1))
+            quarters = sorted(quarters)
+            with Pool(threads) as pool:
+                _ = list(
+                    tqdm.tqdm(
+                        pool.imap_unordered(
+                            partial(
+                                deduplicate_quarter,
+                                dir_in=dir_in,
+                                dir_out=dir_out,
+                                engine=engine,
+                            ),
+                            quarters,
+                        ),
+                        total=len(quarters),
+                    )
                 )
+            # Cases are re-reported across quarters. The index tells every
+            # later stage which quarter holds the latest version of a case.
+            case_index.update_index(
+                os.path.join(dir_out, case_index.INDEX_FILENAME), dir_out
             )
+        else:
+            raise ValueError(f"Unknown deduplication mode {mode}")
     except Exception as err:
         shutil.rmtree(dir_out)
         raise err
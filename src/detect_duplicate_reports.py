@@ -0,0 +1,291 @@
+import logging
+import os
+
+import defopt
+import numpy as np
+import pandas as pd
+
+from src import utils
+from src.case_index import CaseIndex
+from src.utils import Quarter, generate_quarters
+
+logger = logging.getLogger("FAERS")
+
+# The demographic tokens two duplicate reports must not disagree on
+DEMOGRAPHIC_TOKENS = ["age:", "sex:", "event:"]
+
+# Universal hashing modulo a Mersenne prime. Token hashes and the
+# coefficients are kept below 2**32 so that a * x + b fits in 64 bits.
+_MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+_MAX_HASH = np.uint64((1 << 32) - 1)
+
+
+def clusters_filename(dir_out, year_q_from, year_q_to):
+    """Where the clusters of the quarters `year_q_from`..`year_q_to` are saved"""
+    return os.path.join(
+        dir_out,
+        f"duplicate_clusters_{year_q_from}_{year_q_to}{utils.INGESTED_EXTENSION}",
+    )
+
+
+def hash_tokens(tokens):
+    """Stable 32-bit hashes of an array of strings"""
+    hashes = pd.util.hash_array(np.asarray(tokens, dtype=object))
+    return hashes & _MAX_HASH
+
+
+def case_tokens(dir_in, quarters, fn_case_index=None, engine="pandas"):
+    """The (caseid, token) pairs that describe each case
+
+    The tokens of a case are its normalized drug names, its normalized
+    reaction PTs, and its age (in whole years), sex and event date. Rows of
+    case versions that were superseded in a later quarter are ignored if a
+    caseid index is given.
+    """
+    index = CaseIndex.load(fn_case_index) if fn_case_index else None
+    ret = []
+    for q in quarters:
+        df_drug = utils.read_table(
+            utils.quarter_table_filename(dir_in, "drug", q),
+            columns=["primaryid", "caseid", "drugname"],
+            dtype=utils.FAERS_TABLE_DTYPES["drug"],
+            engine=engine,
+        ).dropna()
+        df_reac = utils.read_table(
+            utils.quarter_table_filename(dir_in, "reac", q),
+            columns=["primaryid", "caseid", "pt"],
+            dtype=utils.FAERS_TABLE_DTYPES["reac"],
+            engine=engine,
+        ).dropna()
+        df_demo = utils.read_demo_data(
+            utils.quarter_table_filename(dir_in, "demo", q), engine=engine
+        )
+        if index is not None:
+            df_drug = df_drug.loc[
+                index.is_latest(df_drug.caseid.values, df_drug.primaryid.values)
+            ]
+            df_reac = df_reac.loc[
+                index.is_latest(df_reac.caseid.values, df_reac.primaryid.values)
+            ]
+            df_demo = df_demo.loc[index.is_latest_quarter(df_demo.caseid.values, q)]
+        drugs = utils.DRUG_NAMES(df_drug.drugname)
+        reactions = utils.REACTION_NAMES(df_reac.pt)
+        ret.append(
+            pd.DataFrame(
+                {"caseid": df_drug.caseid, "token": "drug:" + drugs.astype(str)}
+            )
+        )
+        ret.append(
+            pd.DataFrame(
+                {"caseid": df_reac.caseid, "token": "reaction:" + reactions.astype(str)}
+            )
+        )
+        demo_tokens = {
+            "age:": df_demo.age.round().astype("Int64").astype(str),
+            "sex:": df_demo.sex.astype(str),
+            "event:": df_demo.event_date.astype(str),
+        }
+        for prefix, values in demo_tokens.items():
+            sel = ~values.isin(["<NA>", "NaT", "nan", "None", ""])
+            ret.append(
+                pd.DataFrame(
+                    {"caseid": df_demo.caseid[sel], "token": prefix + values[sel]}
+                )
+            )
+    ret = pd.concat(ret, ignore_index=True).drop_duplicates()
+    logger.info(f"{len(ret):,d} tokens of {ret.caseid.nunique():,d} cases")
+    return ret
+
+
+def minhash_signatures(case_codes, token_hashes, n_cases, num_perm=64, seed=0):
+    """MinHash signature matrix, one row per case and one column per permutation
+
+    `case_codes` are the case of each token, in 0..n_cases - 1. A permutation
+    of the token space is simulated by the hash function (a * x + b) mod p.
+    """
+    rng = np.random.default_rng(seed)
+    a = rng.integers(1, int(_MAX_HASH), size=num_perm, dtype=np.uint64)
+    b = rng.integers(0, int(_MAX_HASH), size=num_perm, dtype=np.uint64)
+    order = np.argsort(case_codes, kind="stable")
+    case_codes = case_codes[order]
+    token_hashes = token_hashes[order].astype(np.uint64)
+    starts = np.flatnonzero(np.r_[True, case_codes[1:] != case_codes[:-1]])
+    signatures = np.full((n_cases, num_perm), _MAX_HASH, dtype=np.uint32)
+    for i in range(num_perm):
+        h = (a[i] * token_hashes + b[i]) % _MERSENNE_PRIME & _MAX_HASH
+        signatures[case_codes[starts], i] = np.minimum.reduceat(h, starts)
+    return signatures
+
+
+def lsh_candidate_pairs(signatures, bands=16, max_bucket_size=100):
+    """Pairs of cases whose signatures are identical in at least one band
+
+    Each band of `rows = num_perm // bands` signature values is hashed into a
+    bucket. Every member of a bucket is paired with the first member, which
+    keeps the number of candidate pairs linear in the number of cases.
+    Buckets larger than `max_bucket_size` are skipped: they hold cases that
+    share only very common tokens.
+    """
+    n_cases, num_perm = signatures.shape
+    rows = num_perm // bands
+    pairs = []
+    for band in range(bands):
+        block = signatures[:, band * rows : (band + 1) * rows].astype(np.uint64)
+        keys = np.zeros(n_cases, dtype=np.uint64)
+        for j in range(rows):
+            # Overflow is intended: the key is a polynomial hash modulo 2**64
+            keys = keys * np.uint64(1000003) ^ block[:, j]
+        order = np.argsort(keys, kind="stable")
+        keys = keys[order]
+        starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+        sizes = np.diff(np.r_[starts, n_cases])
+        member_bucket = np.repeat(np.arange(len(starts)), sizes)
+        sel = (sizes[member_bucket] > 1) & (sizes[member_bucket] <= max_bucket_size)
+        sel &= np.arange(n_cases) != starts[member_bucket]
+        first = order[starts[member_bucket[sel]]]
+        pairs.append(np.stack([first, order[sel]], axis=1))
+    pairs = np.concatenate(pairs)
+    pairs.sort(axis=1)
+    return np.unique(pairs, axis=0)
+
+
+def connected_components(n, pairs):
+    """Label of each of `n` nodes, the smallest node of its component"""
+    labels = np.arange(n)
+    if not len(pairs):
+        return labels
+    while True:
+        m = np.minimum(labels[pairs[:, 0]], labels[pairs[:, 1]])
+        new = labels.copy()
+        np.minimum.at(new, pairs[:, 0], m)
+        np.minimum.at(new, pairs[:, 1], m)
+        new = new[new]
+        if np.array_equal(new, labels):
+            return labels
+        labels = new
+
+
+def demographic_conflicts(df_tokens, caseids, pairs):
+    """Whether the cases of each pair have different ages, sexes or event
+    dates
+
+    A value that is missing from one of the cases is not a conflict.
+    """
+    ret = np.zeros(len(pairs), dtype=bool)
+    for prefix in DEMOGRAPHIC_TOKENS:
+        sel = df_tokens.token.str.startswith(prefix).values
+        values = df_tokens.loc[sel].drop_duplicates("caseid").set_index("caseid").token
+        values = values.reindex(caseids).values
+        a, b = values[pairs[:, 0]], values[pairs[:, 1]]
+        ret |= pd.notna(a) & pd.notna(b) & (a != b)
+    return ret
+
+
+def detect_duplicates(
+    df_tokens, num_perm=64, bands=16, threshold=0.8, min_tokens=5, seed=0
+):
+    """Cluster the cases whose token sets are similar
+
+    Candidate pairs found with locality-sensitive hashing are kept if the
+    fraction of equal MinHash values, an estimate of the Jaccard similarity
+    of their token sets, is at least `threshold`, and if their age, sex and
+    event date do not differ. Cases with fewer than `min_tokens` tokens are
+    never clustered: a few common reactions and a sex are not enough to tell
+    that two reports describe the same patient.
+
+    :return: DataFrame with the columns caseid and cluster, for the cases
+        that have at least one duplicate. The cluster is identified by its
+        smallest caseid.
+    """
+    if num_perm % bands:
+        raise ValueError(f"num_perm ({num_perm}) must be a multiple of bands")
+    n_tokens = df_tokens.caseid.map(df_tokens.caseid.value_counts()).values
+    df_tokens = df_tokens.loc[n_tokens >= min_tokens]
+    case_codes, caseids = pd.factorize(df_tokens.caseid, sort=True)
+    signatures = minhash_signatures(
+        case_codes, hash_tokens(df_tokens.token.values), len(caseids), num_perm, seed
+    )
+    pairs = lsh_candidate_pairs(signatures, bands=bands)
+    similarity = (signatures[pairs[:, 0]] == signatures[pairs[:, 1]]).mean(axis=1)
+    pairs = pairs[similarity >= threshold]
+    pairs = pairs[~demographic_conflicts(df_tokens, caseids, pairs)]
+    logger.info(f"{len(similarity):,d} candidate pairs, {len(pairs):,d} are duplicates")
+    labels = connected_components(len(caseids), pairs)
+    sel = labels != np.arange(len(caseids))
+    sel[labels[sel]] = True
+    return pd.DataFrame(
+        {"caseid": caseids[sel], "cluster": caseids[labels[sel]]}
+    ).reset_index(drop=True)
+
+
+def load_clusters(fn):
+    """The duplicate clusters as a caseid -> cluster Series"""
+    df = utils.read_table(
+        fn,
+        columns=["caseid", "cluster"],
+        dtype={"caseid": utils.CASEID_DTYPE, "cluster": utils.CASEID_DTYPE},
+    )
+    return df.set_index("caseid").cluster
+
+
+def main(
+    *,
+    year_q_from,
+    year_q_to,
+    dir_in,
+    fn_out,
+    fn_case_index=None,
+    num_perm=64,
+    bands=16,
+    threshold=0.8,
+    min_tokens=5,
+    csv_engine="pandas",
+):
+    """
+
+    :param str year_q_from:
+        XXXXqQ, where XXXX is the year, q is the literal "q" and Q is 1, 2, 3 or 4
+    :param str year_q_to:
+        XXXXqQ, where XXXX is the year, q is the literal "q" and Q is 1, 2, 3 or 4
+    :param str dir_in:
+        Directory with the (deduplicated) FAERS tables
+    :param str fn_out:
+        Output file, a Parquet table of caseid and cluster
+    :param str fn_case_index:
+        The caseid index built by the deduplication stage, used to ignore
+        superseded case versions
+    :param int num_perm:
+        N of MinHash permutations
+    :param int bands:
+        N of LSH bands. More bands find pairs with a lower similarity
+    :param float threshold:
+        Minimal estimated Jaccard similarity of two duplicate reports
+    :param int min_tokens:
+        Minimal number of drugs, reactions and demographic values of a
+        report that can be a duplicate
+    :param str csv_engine:
+        Parser for input tables that were not ingested to Parquet, "pandas"
+        or "pyarrow"
+
+    :return: None
+
+    """
+    quarters = list(generate_quarters(Quarter(year_q_from), Quarter(year_q_to)))
+    df_tokens = case_tokens(dir_in, quarters, fn_case_index, engine=csv_engine)
+    df_clusters = detect_duplicates(
+        df_tokens,
+        num_perm=num_perm,
+        bands=bands,
+        threshold=threshold,
+        min_tokens=min_tokens,
+    )
+    logger.info(
+        f"{len(df_clusters):,d} cases in {df_clusters.cluster.nunique():,d} "
+        f"duplicate clusters"
+    )
+    os.makedirs(os.path.dirname(os.path.abspath(fn_out)), exist_ok=True)
+    utils.write_table(df_clusters, fn_out)
+
+
+if __name__ == "__main__":
+    defopt.run(main)
@@ -1,7 +1,13 @@
+import asyncio
+import json
 import logging
 import os
+import re
 import shutil
 import urllib.request
+from email.utils import formatdate
+
+import aiohttp
 import defopt
 from multiprocessing.dummy import Pool as ThreadPool
 import tqdm
@@ -10,8 +16,15 @@ from src.utils import Quarter, generate_quarters
 
 logger = logging.getLogger("FAERS")
 
+NBER_BASE_URL = "https://data.nber.org/fda/faers"
+PART_SUFFIX = ".part"
+# Next to a `.part` file, the ETag or Last-Modified of the revision it holds
+VALIDATOR_SUFFIX = ".validator"
+MANIFEST_FILENAME = "_manifest.json"
+CHANGED_QUARTERS_FILENAME = "_changed_quarters.json"
+
 
-def quarter_urls(quarter):
+def quarter_urls(quarter, base_url=NBER_BASE_URL):
     ret = []
     year = quarter.year
     yearquarter = str(quarter)
@@ -26,27 +39,305 @@ def quarter_urls(quarter):
     for w in what:
         # tmplt = f"https://data.nber.org/fda/faers/{year}/csv/{w}{yearquarter}.csv.zip"
         # tmplt = f"https://data.nber.org/fda/faers/{year}/{w}{yearquarter}.csv.zip"
-        tmplt = f"https://data.nber.org/fda/faers/{year}/csv/{w}{yearquarter}.csv.zip"
+        tmplt = f"{base_url}/{year}/csv/{w}{yearquarter}.csv.zip"
         ret.append(tmplt)
     return ret
 
 
+def filename_from_url(url, dir_out):
+    return os.path.join(dir_out, os.path.split(url)[-1])
+
+
+def get_expected_filenames(*, year_q_from, year_q_to, dir_out):
+    q_first = Quarter(year_q_from)
+    q_last = Quarter(year_q_to)
+    ret = []
+    for q in generate_quarters(q_first, q_last):
+        ret.extend(filename_from_url(url, dir_out) for url in quarter_urls(q))
+    return ret
+
+
+def load_manifest(dir_out):
+    fn = os.path.join(dir_out, MANIFEST_FILENAME)
+    if not os.path.exists(fn):
+        return {}
+    with open(fn) as fh:
+        return json.load(fh)
+
+
+def save_manifest(dir_out, manifest):
+    fn = os.path.join(dir_out, MANIFEST_FILENAME)
+    with open(fn + PART_SUFFIX, "w") as fh:
+        json.dump(manifest, fh, indent=1, sort_keys=True)
+    os.replace(fn + PART_SUFFIX, fn)
+
+
+def read_changed_quarters(dir_out):
+    """Quarters (re)downloaded by the most recent run of `main`"""
+    fn = os.path.join(dir_out, CHANGED_QUARTERS_FILENAME)
+    if not os.path.exists(fn):
+        return []
+    with open(fn) as fh:
+        return json.load(fh)
+
+
+def manifest_entry(headers, fn_out):
+    return {
+        "etag": headers.get("ETag"),
+        "last_modified": headers.get("Last-Modified"),
+        "size": os.path.getsize(fn_out),
+    }
+
+
+def conditional_headers(entry, fn_out):
+    if entry and entry.get("size") != os.path.getsize(fn_out):
+        # The local copy is not the one the manifest describes
+        return {}
+    ret = {}
+    if entry and entry.get("etag"):
+        ret["If-None-Match"] = entry["etag"]
+    if entry and entry.get("last_modified"):
+        ret["If-Modified-Since"] = entry["last_modified"]
+    if not ret:
+        ret["If-Modified-Since"] = formatdate(os.path.getmtime(fn_out), usegmt=True)
+    return ret
+
+
 def download_url(url, dir_out):
-    fn_out = os.path.split(url)[-1]
-    fn_out = os.path.join(dir_out, fn_out)
+    fn_out = filename_from_url(url, dir_out)
     if os.path.exists(fn_out):
         logger.debug(f"Skipping {url} because {fn_out} already exists")
         return
+    fn_part = fn_out + PART_SUFFIX
     try:
-        urllib.request.urlretrieve(url, fn_out)
+        urllib.request.urlretrieve(url, fn_part)
     except Exception as err:
         logger.error(f"Failed to download {url} to {fn_out} {err}")
     else:
+        os.replace(fn_part, fn_out)
         logger.info(f"Saved {fn_out}")
         assert os.path.exists(fn_out)
 
 
-def main(*, year_q_from, year_q_to, dir_out, threads=4, clean_on_failure=True):
+def _total_size_from_content_range(content_range):
+    # "bytes 100-199/200" or "bytes */200"
+    m = re.search(r"/(\d+)$", content_range or "")
+    if m is None:
+        return None
+    return int(m.group(1))
+
+
+def _save_validator(fn_part, headers):
+    validator = headers.get("ETag") or headers.get("Last-Modified")
+    fn = fn_part + VALIDATOR_SUFFIX
+    if validator is None:
+        if os.path.exists(fn):
+            os.remove(fn)
+        return
+    with open(fn, "w") as fh:
+        fh.write(validator)
+
+
+def _load_validator(fn_part):
+    fn = fn_part + VALIDATOR_SUFFIX
+    if not os.path.exists(fn):
+        return None
+    with open(fn) as fh:
+        return fh.read().strip() or None
+
+
+def remove_part(fn_part):
+    """Remove a partial download and its validator"""
+    for fn in [fn_part, fn_part + VALIDATOR_SUFFIX]:
+        if os.path.exists(fn):
+            os.remove(fn)
+
+
+async def _fetch_to_part(session, url, fn_part, chunk_size, headers=None):
+    """Download (or resume downloading) `url` into `fn_part`
+
+    A partial file is resumed with a Range request conditioned (If-Range) on
+    the validator of the revision it holds, so that the server sends the
+    whole file again if it changed in the meantime. A partial file without a
+    validator is downloaded again from scratch.
+
+    Returns the response headers, or None if the server answered
+    "304 Not Modified" to a conditional request.
+    """
+    headers = dict(headers or {})
+    offset = os.path.getsize(fn_part) if os.path.exists(fn_part) else 0
+    validator = _load_validator(fn_part) if offset else None
+    if offset and validator is None:
+        logger.debug(f"Restarting {fn_part}: the revision it holds is unknown")
+        remove_part(fn_part)
+        offset = 0
+    if offset:
+        headers["Range"] = f"bytes={offset}-"
+        headers["If-Range"] = validator
+    async with session.get(url, headers=headers) as response:
+        if response.status == 304:
+            return None
+        if response.status == 416 and offset:
+            # Nothing left to fetch: the partial file may already be complete
+            total = _total_size_from_content_range(
+                response.headers.get("Content-Range")
+            )
+            if total == offset:
+                return response.headers.copy()
+            remove_part(fn_part)
+            raise aiohttp.ClientPayloadError(
+                f"Partial file {fn_part} does not match the remote size {total}"
+            )
+        response.raise_for_status()
+        if response.status == 206:
+            mode = "ab"
+            expected_size = _total_size_from_content_range(
+                response.headers.get("Content-Range")
+            )
+        else:
+            # The server ignored the range request, or the file changed since
+            # the partial download: start from scratch
+            mode = "wb"
+            expected_size = response.content_length
+            _save_validator(fn_part, response.headers)
+        with open(fn_part, mode) as fh:
+            async for chunk in response.content.iter_chunked(chunk_size):
+                fh.write(chunk)
+        response_headers = response.headers.copy()
+    actual_size = os.path.getsize(fn_part)
+    if expected_size is not None and actual_size != expected_size:
+        raise aiohttp.ClientPayloadError(
+            f"{url}: got {actual_size:,d} bytes, expected {expected_size:,d}"
+        )
+    return response_headers
+
+
+def is_retryable(err):
+    """Server errors, timeouts and broken connections are worth retrying;
+    client errors such as "404 Not Found" are not"""
+    if isinstance(err, aiohttp.ClientResponseError):
+        return err.status >= 500
+    return isinstance(err, (asyncio.TimeoutError, aiohttp.ClientError))
+
+
+async def download_url_async(
+    session, url, dir_out, retries=5, chunk_size=1 << 20, refresh=False, entry=None
+):
+    """Download `url` unless it is already in `dir_out`
+
+    With `refresh`, existing files are re-validated with a conditional request
+    based on their manifest `entry` and re-fetched only if they changed.
+    Returns a new manifest entry if the file was (re)downloaded, None otherwise.
+    Only the errors for which `is_retryable` holds are retried; the last error
+    is raised.
+    """
+    fn_out = filename_from_url(url, dir_out)
+    fn_part = fn_out + PART_SUFFIX
+    headers = {}
+    if os.path.exists(fn_out):
+        if not refresh:
+            logger.debug(f"Skipping {url} because {fn_out} already exists")
+            return None
+        headers = conditional_headers(entry, fn_out)
+        # A stale partial file cannot be combined with a newer revision
+        remove_part(fn_part)
+    for attempt in range(1, retries + 1):
+        try:
+            response_headers = await _fetch_to_part(
+                session, url, fn_part, chunk_size=chunk_size, headers=headers
+            )
+        except Exception as err:
+            if not is_retryable(err) or attempt == retries:
+                raise
+            logger.warning(
+                f"Attempt {attempt}/{retries} to download {url} failed {err}"
+            )
+            await asyncio.sleep(min(2**attempt, 30))
+        else:
+            if response_headers is None:
+                logger.debug(f"{url} did not change since the last download")
+                return None
+            os.replace(fn_part, fn_out)
+            remove_part(fn_part)
+            logger.info(f"Saved {fn_out}")
+            return manifest_entry(response_headers, fn_out)
+
+
+async def download_urls_async(
+    urls,
+    dir_out,
+    connections_per_host=4,
+    retries=5,
+    timeout=600,
+    progress=True,
+    refresh=False,
+    manifest=None,
+):
+    """Download `urls` over a shared keep-alive connection pool
+
+    Each file is written to a `.part` file first and renamed once complete.
+    Interrupted downloads are resumed from the `.part` file using HTTP Range
+    requests. Returns a {url: manifest entry} dict of the files that were
+    (re)downloaded and a {url: error} dict of the ones that failed.
+    """
+    if manifest is None:
+        manifest = {}
+    connector = aiohttp.TCPConnector(
+        limit=0, limit_per_host=connections_per_host, keepalive_timeout=60
+    )
+    client_timeout = aiohttp.ClientTimeout(total=None, sock_read=timeout)
+    async with aiohttp.ClientSession(
+        connector=connector, timeout=client_timeout
+    ) as session:
+
+        async def download(url):
+            try:
+                entry = await download_url_async(
+                    session,
+                    url,
+                    dir_out,
+                    retries=retries,
+                    refresh=refresh,
+                    entry=manifest.get(url),
+                )
+            except Exception as err:
+                logger.error(f"Failed to download {url}: {err!r}")
+                return url, None, err
+            return url, entry, None
+
+        tasks = [asyncio.ensure_future(download(url)) for url in urls]
+        downloaded = {}
+        failed = {}
+        for task in tqdm.tqdm(
+            asyncio.as_completed(tasks), total=len(tasks), disable=not progress
+        ):
+            url, entry, err = await task
+            if err is not None:
+                failed[url] = err
+            elif entry is not None:
+                downloaded[url] = entry
+    return downloaded, failed
+
+
+def raise_for_failures(failed):
+    """Fail the run once all the other downloads are done and recorded"""
+    if failed:
+        raise RuntimeError(
+            f"Failed to download {len(failed)} file(s): {', '.join(sorted(failed))}"
+        )
+
+
+def main(
+    *,
+    year_q_from,
+    year_q_to,
+    dir_out,
+    threads=4,
+    clean_on_failure=True,
+    engine="async",
+    base_url=NBER_BASE_URL,
+    refresh=False,
+):
     """
 
     :param str year_q_from:
@@ -56,11 +347,23 @@ def main(*, year_q_from, year_q_to, dir_out, threads=4, clean_on_failure=True):
     :param str dir_out:
         Output directory
     :param int threads:
-        N of parallel threads
+        N of parallel threads. With the async engine, N of parallel
+        connections per host
     :param bool clean_on_failure:
-        ???
+        Remove `dir_out`, including the files downloaded by earlier runs, if
+        the download fails
+    :param str engine:
+        "async" (resumable downloads over a keep-alive connection pool) or
+        "threads" (one blocking download per thread)
+    :param str base_url:
+        Root of the FAERS mirror, e.g. a local server when testing
+    :param bool refresh:
+        Re-validate already downloaded files against the mirror (ETag /
+        Last-Modified) and re-fetch the ones that changed. Requires the
+        async engine
 
-    :return: None
+    :return: list of quarters whose files were (re)downloaded. The list is
+        also saved to `_changed_quarters.json` in `dir_out`
 
     """
     dir_out = os.path.abspath(dir_out)
@@ -68,18 +371,56 @@ def main(*, year_q_from, year_q_to, dir_out, threads=4, clean_on_failure=True):
     try:
         q_first = Quarter(year_q_from)
         q_last = Quarter(year_q_to)
-        urls = []
+        url_quarters = {}
         for q in generate_quarters(q_first, q_last):
-            urls.extend(quarter_urls(q))
-
-        print(f"will download {len(urls)} urls")
-        with ThreadPool(threads) as pool:
-            _ = list(
-                tqdm.tqdm(
-                    pool.imap(lambda url: download_url(url, dir_out), urls),
-                    total=len(urls),
+            for url in quarter_urls(q, base_url=base_url):
+                url_quarters[url] = str(q)
+        urls = list(url_quarters)
+
+        logger.info(f"Will download {len(urls)} urls")
+        if engine == "async":
+            manifest = load_manifest(dir_out)
+            downloaded, failed = asyncio.run(
+                download_urls_async(
+                    urls,
+                    dir_out,
+                    connections_per_host=threads,
+                    refresh=refresh,
+                    manifest=manifest,
                 )
             )
+            manifest.update(downloaded)
+            save_manifest(dir_out, manifest)
+            raise_for_failures(failed)
+        elif engine == "threads":
+            if refresh:
+                raise ValueError("Refreshing requires the async download engine")
+            missing = {
+                url
+                for url in urls
+                if not os.path.exists(filename_from_url(url, dir_out))
+            }
+            with ThreadPool(threads) as pool:
+                _ = list(
+                    tqdm.tqdm(
+                        pool.imap(lambda url: download_url(url, dir_out), urls),
+                        total=len(urls),
+                    )
+                )
+            downloaded = {
+                url
+                for url in missing
+                if os.path.exists(filename_from_url(url, dir_out))
+            }
+            raise_for_failures({url: None for url in missing if url not in downloaded})
+        else:
+            raise ValueError(f"Unknown download engine {engine}")
+        changed_quarters = sorted({url_quarters[url] for url in downloaded})
+        if changed_quarters:
+            logger.info(f"Changed quarters: {', '.join(changed_quarters)}")
+        with open(os.path.join(dir_out, CHANGED_QUARTERS_FILENAME), "w") as fh:
+            json.dump(changed_quarters, fh)
+        return changed_quarters
     except Exception as err:
         if clean_on_failure:
             shutil.rmtree(dir_out)
@@ -8,10 +8,13 @@ import defopt
 import pandas as pd
 import tqdm
 import numpy as np
+from src import marked_store
 from src.utils import (
+    CASEID_DTYPE,
     Quarter,
     QuestionConfig,
     generate_quarters,
+    quarter_table_filename,
     read_demo_data,
     read_therapy_data,
 )
@@ -19,6 +22,17 @@ from src.utils import (
 logger = logging.getLogger("FAERS")
 
 
+def read_quarter_cases(dir_marked_data, q, config):
+    """The rows of quarter `q` of the marked data store, with only the
+    columns of `config`
+    """
+    stored = set(marked_store.stored_columns(dir_marked_data, q))
+    columns = [marked_store.REPORT_CASEID] + marked_store.config_columns(config.name)
+    return marked_store.read_quarter(
+        dir_marked_data, q, columns=[c for c in columns if c in stored]
+    )
+
+
 def get_relevant_cases(fn_marked, config, nrows=None):
     if fn_marked.endswith("csv"):
         df_marked = pd.read_csv(fn_marked, nrows=nrows)
@@ -26,15 +40,22 @@ def get_relevant_cases(fn_marked, config, nrows=None):
         df_marked = pickle.load(open(fn_marked, "rb"))
         if nrows is not None:
             df_marked = df_marked.head(nrows)
+    return classify_cases(df_marked, config)
+
+
+def classify_cases(df_marked, config):
+    """The exposure and reaction category of each marked case of `config`"""
     if "caseid" not in df_marked.columns:
         assert df_marked.index.name == "caseid"
         df_marked.reset_index(inplace=True)
 
-    columns_bookkeeping = ["caseid"]
+    columns_bookkeeping = [
+        c for c in ["caseid", marked_store.REPORT_CASEID] if c in df_marked.columns
+    ]
     columns_info = [
         c for c in df_marked if c.startswith("exposed ") or c.startswith("reacted ")
     ]
-    dtypes = {c: str for c in columns_bookkeeping}
+    dtypes = {c: CASEID_DTYPE for c in columns_bookkeeping}
     for c in columns_info:
         dtypes[c] = bool
 
@@ -59,28 +80,49 @@ def get_relevant_cases(fn_marked, config, nrows=None):
     ]
 
 
+def process_a_quarter(q, dir_marked_data, dir_raw_data, dir_out, config):
+    dir_out_curr = os.path.join(dir_out, config.name)
+    os.makedirs(dir_out_curr, exist_ok=True)
+    fn_out = os.path.join(dir_out_curr, f"{q}.csv.zip")
+    if os.path.exists(fn_out):
+        logger.debug(f"Skipping {q} because {fn_out} already exists")
+        return
+    fn_demo = quarter_table_filename(dir_raw_data, "demo", q)
+    fn_therapy = quarter_table_filename(dir_raw_data, "ther", q)
+    df_cases = classify_cases(read_quarter_cases(dir_marked_data, q, config), config)
+    df_demo = read_demo_data(fn_demo)
+    df_therapy = read_therapy_data(fn_therapy)
+    # Duplicate reports are marked under the caseid of their cluster, which
+    # may not be in this quarter's tables
+    on = "caseid"
+    if marked_store.REPORT_CASEID in df_cases.columns:
+        on = marked_store.REPORT_CASEID
+        df_demo = df_demo.rename(columns={"caseid": on})
+        df_therapy = df_therapy.rename(columns={"caseid": on})
+    df_cases = df_cases.merge(df_demo, on=on, how="left").merge(
+        df_therapy, on=on, how="left"
+    )
+    if on != "caseid":
+        df_cases = df_cases.drop(columns=on)
+    df_cases.to_csv(fn_out, index=False, compression="zip")
+
+
 def process_a_config(q_start, q_end, dir_marked_data, dir_raw_data, dir_out, config):
     os.makedirs(dir_out, exist_ok=True)
     quarters = list(generate_quarters(q_start, q_end))
     row = np.random.randint(1, 10)
     for q in tqdm.tqdm(quarters, position=row, leave=False, desc=config.name):
+        process_a_quarter(q, dir_marked_data, dir_raw_data, dir_out, config)
+
 
-        dir_out_curr = os.path.join(dir_out, config.name)
-        os.makedirs(dir_out_curr, exist_ok=True)
-        fn_out = os.path.join(dir_out_curr, f"{q}.csv.zip")
-        if os.path.exists(fn_out):
-            logger.debug(f"Skipping {q} because {fn_out} already exists")
-            continue
-        fn_marked = os.path.join(dir_marked_data, f"{q}.pkl")
-        fn_demo = os.path.join(dir_raw_data, f"demo{q}.csv.zip")
-        fn_therapy = os.path.join(dir_raw_data, f"ther{q}.csv.zip")
-        df_cases = get_relevant_cases(fn_marked, config)
-        df_demo = read_demo_data(fn_demo)
-        df_therapy = read_therapy_data(fn_therapy)
-        df_cases = df_cases.merge(df_demo, on="caseid", how="left").merge(
-            df_therapy, on="caseid", how="left"
-        )
-        df_cases.to_csv(fn_out, index=False, compression="zip")
+def invalidate_quarters(dir_out, configs, quarters):
+    """Remove the outputs computed from quarters whose raw data changed"""
+    for config in configs:
+        for q in quarters:
+            fn = os.path.join(dir_out, config.name, f"{q}.csv.zip")
+            if os.path.exists(fn):
+                logger.info(f"Removing {fn} because its input data changed")
+                os.remove(fn)
 
 
 def main(
@@ -93,6 +135,7 @@ def main(
     dir_out,
     threads=4,
     clean_on_failure=False,
+    changed_quarters=None,
 ):
     """
     :param str year_q_from:
@@ -111,6 +154,9 @@ def main(
         N of parallel threads
     :param bool clean_on_failure:
         ???
+    :param list[str] changed_quarters:
+        Quarters whose raw data changed since the previous run. Their
+        outputs are recomputed
     :return: None
 
     """
@@ -121,6 +167,7 @@ def main(
         q_from = Quarter(year_q_from)
         q_to = Quarter(year_q_to)
         configs = QuestionConfig.load_config_items(dir_config=dir_config)
+        invalidate_quarters(dir_out, configs, changed_quarters or [])
         with ThreadPool(threads) as pool:
             _ = list(
                 tqdm.tqdm(
@@ -0,0 +1,91 @@
+import glob
+import logging
+import os
+import re
+import shutil
+from functools import partial
+from multiprocessing import Pool
+
+import defopt
+import tqdm
+
+from src import utils
+from src.deduplicate_faers_data import materialize_file
+
+logger = logging.getLogger("FAERS")
+
+
+def parse_table_filename(fn):
+    """Split e.g. "drug2020q1.csv.zip" into ("drug", "2020q1")"""
+    m = re.search(
+        r"^([a-z]+)(\d\d\d\dq\d)(\.csv\.zip|\.parquet)$", os.path.split(fn)[-1]
+    )
+    if m is None:
+        return None, None
+    return m.group(1), m.group(2)
+
+
+def ingest_file(file_in, dir_out, compression="zstd", engine="pyarrow"):
+    """Convert a raw `.csv.zip` FAERS table to a typed, column-pruned Parquet file
+
+    Tables that are already in Parquet (e.g. written by the deduplication
+    stage) are copied as they are.
+    """
+    table, q = parse_table_filename(file_in)
+    if table not in utils.FAERS_TABLE_DTYPES:
+        logger.debug(f"Skipping {file_in}: not a table the pipeline uses")
+        return
+    file_out = os.path.join(dir_out, f"{table}{q}{utils.INGESTED_EXTENSION}")
+    if utils.is_up_to_date(file_out, [file_in]):
+        logger.debug(f"Skipping {file_in} because {file_out} already exists")
+        return
+    if file_in.endswith(utils.INGESTED_EXTENSION):
+        materialize_file(file_in, file_out)
+        return
+    dtypes = utils.FAERS_TABLE_DTYPES[table]
+    df = utils.read_table(file_in, columns=dtypes.keys(), dtype=dtypes, engine=engine)
+    utils.write_table(df, file_out, compression=compression)
+
+
+def main(*, dir_in, dir_out, threads=4, engine="pyarrow"):
+    """
+
+    :param str dir_in:
+        Input directory, with the (deduplicated) .csv.zip or .parquet files
+    :param str dir_out:
+        Output directory, where a Parquet file is saved per quarter and table
+    :param int threads:
+        N of parallel processes
+    :param str engine:
+        CSV parser, "pyarrow" (multithreaded) or "pandas"
+
+    :return: None
+
+    """
+
+    assert os.path.isdir(dir_in)
+    dir_out = os.path.abspath(dir_out)
+    os.makedirs(dir_out, exist_ok=True)
+    try:
+        in_files = {}
+        for extension in [utils.RAW_EXTENSION, utils.INGESTED_EXTENSION]:
+            # Prefer tables that are already in Parquet over their raw version
+            for f in glob.glob(os.path.join(dir_in, "*" + extension)):
+                in_files[parse_table_filename(f)] = f
+        in_files = sorted(in_files.values())
+        with Pool(threads) as pool:
+            _ = list(
+                tqdm.tqdm(
+                    pool.imap_unordered(
+                        partial(ingest_file, dir_out=dir_out, engine=engine), in_files
+                    ),
+                    total=len(in_files),
+                )
+            )
+    except Exception as err:
+        shutil.rmtree(dir_out)
+        raise err
+
+
+if __name__ == "__main__":
+    defopt.run(main)
@@ -1,24 +1,44 @@
+import glob
+import hashlib
+import json
 import os
 import logging
-import shutil
 import warnings
 import pickle
-from multiprocessing import Pool
+from concurrent.futures import ProcessPoolExecutor
 from functools import partial
 
 import pandas as pd
 import defopt
 import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pa_parquet
 import tqdm
+from scipy import sparse
 
-from src import utils
+from src import case_index, marked_store, utils
+from src.case_index import CaseIndex
+from src.detect_duplicate_reports import load_clusters
+from src.marked_store import config_columns
 from src.utils import Quarter, generate_quarters, QuestionConfig
 
 logger = logging.getLogger("FAERS")
 
+# Columns taken from the earliest row of a case when its rows are combined.
+# The other columns are taken from the latest row, or OR-ed if boolean.
+FIRST_ROW_COLUMNS = ["q", marked_store.REPORT_CASEID]
+
+# Where the quarters are saved before the cases reported in several quarters
+# are combined
+QUARTERS_SUBDIR = "quarters"
+# The quarter of the merged row of each case, and the quarters and configs
+# that were merged
+CASE_QUARTERS_FILENAME = "case_quarters.parquet"
+MERGE_STATE_FILENAME = "merge_state.json"
+
 
 def mark_drug_data(df, drug_names):
-    df.drugname = df.drugname.apply(QuestionConfig.normalize_drug_name)
+    df.drugname = utils.DRUG_NAMES(df.drugname)
     for drug in sorted(drug_names):
         df[f"drug {drug}"] = df.drugname == drug
     drug_columns = [f"drug {drug}" for drug in drug_names]
@@ -27,7 +47,7 @@ def mark_drug_data(df, drug_names):
 
 
 def mark_reaction_data(df, reaction_types):
-    df.pt = df.pt.apply(QuestionConfig.normalize_reaction_name)
+    df.pt = utils.REACTION_NAMES(df.pt)
 
     # Create a dict of new columns
     new_cols = {
@@ -52,19 +72,52 @@ def handle_duplicates_within_case(df, cols_boolean, cols_rest):
     return ret
 
 
-def handle_duplicates(df):
+def resolve_duplicates(df, cols_boolean, cols_rest):
+    """Vectorized `handle_duplicates_within_case` for all cases at once
+
+    A stable sort by caseid keeps the order of the rows within each case.
+    The last row of each case gives the values of `cols_rest`, the first row
+    gives `q` (and the other `FIRST_ROW_COLUMNS` present), and the boolean
+    columns are OR-ed with a grouped max.
+    """
+    df = df.sort_values("caseid", kind="stable")
+    # `groupby().last()` would skip missing values, unlike `.iloc[-1]`
+    is_last = ~df.caseid.duplicated(keep="last").values
+    is_first = ~df.caseid.duplicated(keep="first").values
+    ret = df.loc[is_last, cols_rest]
+    for c in FIRST_ROW_COLUMNS:
+        if c in df.columns:
+            ret[c] = df[c].values[is_first]
+    any_true = df.groupby("caseid", sort=False)[cols_boolean].max()
+    for c in cols_boolean:
+        ret[c] = any_true[c].values
+    return ret
+
+
+def handle_duplicates(df, clusters=None):
+    """Combine the rows of each case into one
+
+    If `clusters` (a caseid -> cluster Series, see `detect_duplicate_reports`)
+    is given, the reports of a duplicate cluster are combined as if they were
+    versions of one case, identified by the caseid of the cluster. The caseid
+    of the report the combined row's quarter comes from is kept in the
+    `marked_store.REPORT_CASEID` column.
+    """
+    if clusters is not None:
+        df.insert(1, marked_store.REPORT_CASEID, df.caseid.values)
+        df["caseid"] = (
+            df.caseid.map(clusters).fillna(df.caseid).astype(utils.CASEID_DTYPE)
+        )
+        df = df.sort_values(["caseid", "q"], kind="stable")
     cols_boolean = [c for c in df.columns if df.dtypes[c] == np.dtype(bool)]
-    cols_rest = [c for c in df.columns if (c not in cols_boolean) and (c != "q")]
-    rows_per_caseid = pd.value_counts(df["caseid"])
-    df["rows_per_caseid"] = rows_per_caseid.reindex(df.caseid).values
+    cols_rest = [c for c in df.columns if (c not in cols_boolean + FIRST_ROW_COLUMNS)]
+    df["rows_per_caseid"] = df.caseid.map(df.caseid.value_counts()).values
     sel = df.rows_per_caseid == 1
     already_good = df.loc[sel]
     logger.info(f"{sel.sum():,d} rows are already good")
     need_to_fix = df.loc[~sel]
     logger.info(f"{len(need_to_fix):,d} rows need some fixing")
-    fixed = need_to_fix.groupby("caseid").apply(
-        lambda d: handle_duplicates_within_case(d, cols_boolean, cols_rest)
-    )
+    fixed = resolve_duplicates(need_to_fix, cols_boolean, cols_rest)
     logger.info(f"Done fixing, combining the results")
     ret = pd.concat([already_good, fixed], sort=False)
     uniqueness = utils.compute_df_uniqueness(ret, ["caseid"], do_print=False)
@@ -72,7 +125,30 @@ def handle_duplicates(df):
     return ret.set_index("caseid")
 
 
-def mark_data(df_drug, df_reac, df_demo, config_items):
+def config_terms(config_items):
+    """The drug names and the reaction types used by `config_items`"""
+    drug_names = set()
+    reaction_types = set()
+    for config in config_items:
+        drug_names.update(set(config.drugs))
+        if config.control is not None:
+            drug_names.update(set(config.control))
+        reaction_types.update(set(config.reactions))
+    return drug_names, reaction_types
+
+
+def configs_fingerprint(config_items, inputs=()):
+    """A hash of the names and fingerprints of `config_items`, and of the
+    names of the optional `inputs` files
+    """
+    content = sorted((config.name, config.fingerprint()) for config in config_items)
+    if inputs:
+        content.append(list(inputs))
+    return hashlib.sha256(json.dumps(content).encode()).hexdigest()[:16]
+
+
+def merge_marks(df_drug, df_reac, df_demo, config_items):
+    """One row per (case, quarter) with the exposure and reaction flags"""
     logger.info("Marking the data")
     cols_to_collect = list(df_demo.columns)
     df_merged = df_demo.join(df_reac).join(df_drug)
@@ -93,13 +169,32 @@ def mark_data(df_drug, df_reac, df_demo, config_items):
         df_merged[reacted] = df_merged[reaction_columns].any(axis=1)
         cols_to_collect.append(reacted)
     df_merged = df_merged[cols_to_collect].reset_index().sort_values(["caseid", "q"])
+    return df_merged
+
+
+def mark_data(df_drug, df_reac, df_demo, config_items, clusters=None):
+    df_merged = merge_marks(df_drug, df_reac, df_demo, config_items)
     logger.info(f"Handling duplicates of {len(df_merged):,d} rows")
-    ret = handle_duplicates(df_merged)
+    ret = handle_duplicates(df_merged, clusters=clusters)
     return ret
 
 
+def drop_superseded_versions(df, index):
+    """Drop the rows of case versions that were superseded in a later quarter"""
+    if index is None:
+        return df
+    sel = index.is_latest(df.caseid.values, df.primaryid.values)
+    return df.loc[sel]
+
+
+def table_dtypes(usecols):
+    """The types of the drug and reaction table `usecols`"""
+    return {c: utils.CASEID_DTYPE if c == "caseid" else str for c in usecols}
+
+
 def load_quarder_files(template, quarters, **kwargs) -> pd.DataFrame:
-    dtype = kwargs.pop("dtype", str)
+    usecols = kwargs.pop("usecols", None)
+    dtype = kwargs.pop("dtype", str if usecols is None else table_dtypes(usecols))
     ret = []
     # Check if quarters is iterable but not a string
     if hasattr(quarters, "__iter__") and not isinstance(quarters, (str, bytes)):
@@ -110,85 +205,1066 @@ def load_quarder_files(template, quarters, **kwargs) -> pd.DataFrame:
 
     for q in quarters_to_process:
         fn = template.replace("Q", str(q))
-        tmp = pd.read_csv(fn, dtype=dtype, **kwargs)
+        tmp = utils.read_table(fn, columns=usecols, dtype=dtype, **kwargs)
         ret.append(tmp)
-    return pd.concat(ret)
+    return utils.concat_tables(ret)
+
+
+# The share of the memory limit of a marking process that one chunk of a
+# drug or reaction table may take. The chunk is copied while its names are
+# normalized and flagged, and the rest of the limit is left for the flags
+# reduced so far, the demographic table, and the address space the limit
+# counts without it being resident
+CHUNK_MEMORY_FRACTION = 1 / 16
+
+
+def iter_bounded_chunks(fn, usecols, chunksize=1 << 20, engine="pandas", max_bytes=0):
+    """The chunks of `fn`, of `chunksize` rows or fewer if that many rows take
+    more than `CHUNK_MEMORY_FRACTION` of `max_bytes`"""
+    dtype = table_dtypes(usecols)
+    chunksize = utils.chunk_rows(
+        fn,
+        columns=usecols,
+        dtype=dtype,
+        max_bytes=int(max_bytes * CHUNK_MEMORY_FRACTION),
+        chunksize=chunksize,
+        engine=engine,
+    )
+    return utils.iter_table_chunks(
+        fn, columns=usecols, dtype=dtype, chunksize=chunksize, engine=engine
+    )
+
+
+def load_filtered_quarter_files(
+    template,
+    quarters,
+    usecols,
+    column,
+    normalizer,
+    names,
+    chunksize,
+    engine,
+    max_bytes=0,
+):
+    """Like `load_quarder_files`, keeping only the rows whose normalized
+    `column` is one of `names`
+
+    The tables are read in chunks of `chunksize` rows (bounded by
+    `max_bytes`, see `iter_bounded_chunks`), so that the rows that are
+    dropped never have to be in memory all at once.
+    """
+    names = set(names)
+    ret = []
+    for q in quarters:
+        fn = template.replace("Q", str(q))
+        for chunk in iter_bounded_chunks(
+            fn, usecols, chunksize=chunksize, engine=engine, max_bytes=max_bytes
+        ):
+            keep = normalizer(chunk[column]).isin(names).values
+            ret.append(chunk.loc[keep])
+    return utils.concat_tables(ret)
 
 
-def process_quarters(
-    quarters, dir_in, dir_out, config_items, drug_names, reaction_types
+def read_quarters(
+    quarters,
+    dir_in,
+    csv_engine="pandas",
+    index=None,
+    nrows=None,
+    drug_names=None,
+    reaction_types=None,
+    chunksize=1 << 20,
+    max_bytes=0,
 ):
-    DEBUG = None
+    """The drug, reaction and demographic tables of `quarters`, not yet marked
+
+    If `drug_names` (`reaction_types`) are given, only the drug (reaction)
+    rows that can set a flag are read. The other rows make no difference to
+    the marked data: every case comes from the demographic table, and a case
+    without matching rows is marked as not exposed (did not react).
+    """
     template_drug = os.path.join(dir_in, "drugQ.csv.zip")
     usecols = ["primaryid", "caseid", "drugname"]
-    df_drug = load_quarder_files(
-        template_drug, quarters, usecols=usecols, nrows=DEBUG
-    ).dropna()
-    df_drug = mark_drug_data(df_drug, drug_names)
+    if drug_names is None or nrows is not None:
+        df_drug = load_quarder_files(
+            template_drug, quarters, usecols=usecols, nrows=nrows, engine=csv_engine
+        )
+    else:
+        df_drug = load_filtered_quarter_files(
+            template_drug,
+            quarters,
+            usecols,
+            "drugname",
+            utils.DRUG_NAMES,
+            drug_names,
+            chunksize=chunksize,
+            engine=csv_engine,
+            max_bytes=max_bytes,
+        )
+    df_drug = drop_superseded_versions(df_drug.dropna(), index)
 
     template_reac = os.path.join(dir_in, "reacQ.csv.zip")
     usecols = ["primaryid", "caseid", "pt"]
-    df_reac = load_quarder_files(template_reac, quarters, usecols=usecols, nrows=DEBUG)
-    df_reac = mark_reaction_data(df_reac, reaction_types)
+    if reaction_types is None or nrows is not None:
+        df_reac = load_quarder_files(
+            template_reac, quarters, usecols=usecols, nrows=nrows, engine=csv_engine
+        )
+    else:
+        df_reac = load_filtered_quarter_files(
+            template_reac,
+            quarters,
+            usecols,
+            "pt",
+            utils.REACTION_NAMES,
+            reaction_types,
+            chunksize=chunksize,
+            engine=csv_engine,
+            max_bytes=max_bytes,
+        )
+    df_reac = drop_superseded_versions(df_reac, index)
+    df_demo = read_demo_quarters(
+        quarters, dir_in, csv_engine=csv_engine, index=index, nrows=nrows
+    )
+    return df_drug, df_reac, df_demo
 
+
+def read_demo_quarters(quarters, dir_in, csv_engine="pandas", index=None, nrows=None):
+    """The demographic table of `quarters`, indexed by caseid"""
     df_demo = []
     for q in quarters:
-        fn_demo = os.path.join(dir_in, f"demo{q}.csv.zip")
-        tmp = utils.read_demo_data(fn_demo, nrows=DEBUG).set_index("caseid")
-        tmp["q"] = str(q)
+        fn_demo = utils.quarter_table_filename(dir_in, "demo", q)
+        tmp = utils.read_demo_data(fn_demo, nrows=nrows, engine=csv_engine)
+        if index is not None:
+            tmp = tmp.loc[index.is_latest_quarter(tmp.caseid.values, q)]
+        tmp = tmp.set_index("caseid")
+        tmp["q"] = utils.quarter_column(q, len(tmp))
         df_demo.append(tmp)
-    df_demo = pd.concat(df_demo)
-    df_marked = mark_data(
-        df_drug=df_drug, df_reac=df_reac, df_demo=df_demo, config_items=config_items
+    return utils.concat_tables(df_demo)
+
+
+def load_quarters(
+    quarters,
+    dir_in,
+    drug_names,
+    reaction_types,
+    csv_engine="pandas",
+    index=None,
+    nrows=None,
+):
+    """The marked drug and reaction tables and the demographic table of `quarters`"""
+    df_drug, df_reac, df_demo = read_quarters(
+        quarters, dir_in, csv_engine=csv_engine, index=index, nrows=nrows
     )
-    logger.info("Marked the data, dumping the file")
+    df_drug = mark_drug_data(df_drug, drug_names)
+    df_reac = mark_reaction_data(df_reac, reaction_types)
+    return df_drug, df_reac, df_demo
+
+
+def or_reduce(parts):
+    """OR the boolean flags of `parts`, frames indexed by caseid, per caseid
+
+    The reduction is associative, so partial results can be reduced in any
+    grouping.
+    """
+    return pd.concat(parts).groupby(level=0).max()
+
 
-    # Save the combined file
-    pickle.dump(df_marked, open(os.path.join(dir_out, "marked_data.pkl"), "wb"))
+def mark_chunked(
+    template,
+    quarters,
+    usecols,
+    column,
+    normalizer,
+    names,
+    prefix,
+    index=None,
+    dropna=False,
+    **kwargs,
+):
+    """The per-caseid flags `"{prefix} {name}"` of a table, computed in chunks
 
-    # Save individual quarterly files
+    Each chunk is reduced to the flags of its cases that have at least one
+    of `names`. The cases without any are left out, `merge_marks` treats
+    them the same as cases marked with False. The partials are OR-ed once
+    they outnumber the rows already reduced, so the total work stays linear
+    in the number of chunks.
+    """
+    names = sorted(set(names))
+    columns = [f"{prefix} {name}" for name in names]
+    reduced = pd.DataFrame(
+        columns=columns,
+        index=pd.Index([], dtype=utils.CASEID_DTYPE, name="caseid"),
+        dtype=bool,
+    )
+    pending = []
+    n_pending = 0
     for q in quarters:
-        df_q = df_marked[df_marked.q == str(q)]
-        if not df_q.empty:
-            pickle.dump(df_q, open(os.path.join(dir_out, f"{q}.pkl"), "wb"))
-            logger.info(f"Saved quarterly file for {q}")
+        fn = template.replace("Q", str(q))
+        for chunk in iter_bounded_chunks(fn, usecols, **kwargs):
+            if dropna:
+                chunk = chunk.dropna()
+            chunk = drop_superseded_versions(chunk, index)
+            values = normalizer(chunk[column]).values
+            flags = pd.DataFrame(
+                {c: values == name for c, name in zip(columns, names)},
+                index=pd.Index(chunk.caseid.values, name="caseid"),
+            )
+            flags = flags.loc[flags.any(axis=1).values]
+            pending.append(flags.groupby(level=0).any())
+            n_pending += len(pending[-1])
+            if n_pending >= len(reduced):
+                reduced = or_reduce([reduced] + pending)
+                pending = []
+                n_pending = 0
+    return or_reduce([reduced] + pending)
+
+
+def load_quarters_chunked(
+    quarters,
+    dir_in,
+    drug_names,
+    reaction_types,
+    csv_engine="pandas",
+    index=None,
+    chunksize=1 << 20,
+    max_bytes=0,
+):
+    """`load_quarters` without ever reading a whole drug or reaction table
+
+    Only the flags of the cases with a drug (reaction) of interest are kept
+    in memory, plus one chunk of `chunksize` rows, or fewer if that many rows
+    take more than `CHUNK_MEMORY_FRACTION` of `max_bytes`.
+    """
+    df_drug = mark_chunked(
+        os.path.join(dir_in, "drugQ.csv.zip"),
+        quarters,
+        ["primaryid", "caseid", "drugname"],
+        "drugname",
+        utils.DRUG_NAMES,
+        drug_names,
+        "drug",
+        index,
+        dropna=True,
+        chunksize=chunksize,
+        engine=csv_engine,
+        max_bytes=max_bytes,
+    )
+    df_reac = mark_chunked(
+        os.path.join(dir_in, "reacQ.csv.zip"),
+        quarters,
+        ["primaryid", "caseid", "pt"],
+        "pt",
+        utils.REACTION_NAMES,
+        reaction_types,
+        "reaction",
+        index,
+        chunksize=chunksize,
+        engine=csv_engine,
+        max_bytes=max_bytes,
+    )
+    df_demo = read_demo_quarters(quarters, dir_in, csv_engine=csv_engine, index=index)
+    return df_drug, df_reac, df_demo
+
+
+def shard_of(caseids, shards, clusters=None):
+    """The shard of each caseid, from a hash of the caseid
+
+    With duplicate `clusters`, the hash of the cluster is used instead, so
+    that all the reports that are combined into one case are in one shard.
+    """
+    caseids = pd.Series(caseids)
+    if clusters is not None:
+        caseids = caseids.map(clusters).fillna(caseids).astype(utils.CASEID_DTYPE)
+    hashes = pd.util.hash_array(caseids.values)
+    return (hashes % np.uint64(shards)).astype(int)
+
+
+def incidence_matrix(terms, term_lists):
+    """term x list matrix, with a 1 where a list contains the term"""
+    term_codes = pd.Index(terms)
+    rows = []
+    cols = []
+    for j, names in enumerate(term_lists):
+        codes = term_codes.get_indexer(sorted(set(names or [])))
+        codes = codes[codes >= 0]
+        rows.append(codes)
+        cols.append(np.full(len(codes), j))
+    rows = np.concatenate(rows) if rows else np.empty(0, dtype=int)
+    cols = np.concatenate(cols) if cols else np.empty(0, dtype=int)
+    return sparse.csr_matrix(
+        (np.ones(len(rows), dtype=np.int32), (rows, cols)),
+        shape=(len(term_codes), len(term_lists)),
+    )
+
+
+def case_term_matrix(case_codes, terms):
+    """Sparse case x term matrix of the (case code, term) rows of a table
+
+    :return: the matrix and the terms of its columns
+    """
+    term_codes, term_names = pd.factorize(terms)
+    sel = (case_codes >= 0) & (term_codes >= 0)
+    n_cases = case_codes.max() + 1 if len(case_codes) else 0
+    matrix = sparse.csr_matrix(
+        (
+            np.ones(sel.sum(), dtype=np.int32),
+            (case_codes[sel], term_codes[sel]),
+        ),
+        shape=(n_cases, len(term_names)),
+    )
+    return matrix, term_names
+
+
+def merge_marks_sparse(df_drug, df_reac, df_demo, config_items):
+    """`merge_marks` on the unmarked tables, without a column per term
+
+    The drug and reaction tables become sparse case x term matrices. The
+    exposed, control and reacted flags of all configs are the nonzeros of
+    their products with term x config incidence matrices.
+    """
+    logger.info("Marking the data (sparse)")
+    caseids = pd.Index(df_demo.index.unique())
+    n_cases = len(caseids)
+    drugs = utils.DRUG_NAMES(df_drug.drugname).values
+    reactions = utils.REACTION_NAMES(df_reac.pt).values
+    case_drug, drug_terms = case_term_matrix(caseids.get_indexer(df_drug.caseid), drugs)
+    case_reaction, reaction_terms = case_term_matrix(
+        caseids.get_indexer(df_reac.caseid), reactions
+    )
+    controls = [c for c in config_items if c.control is not None]
+    drug_incidence = sparse.hstack(
+        [
+            incidence_matrix(drug_terms, [c.drugs for c in config_items]),
+            incidence_matrix(drug_terms, [c.control for c in controls]),
+        ]
+    ).tocsr()
+    reaction_incidence = incidence_matrix(
+        reaction_terms, [c.reactions for c in config_items]
+    )
+
+    def case_flags(case_term, incidence):
+        flags = np.zeros((n_cases, incidence.shape[1]), dtype=bool)
+        counts = (case_term @ incidence).tocoo()
+        flags[counts.row, counts.col] = counts.data > 0
+        return flags
 
-    return df_marked
+    drug_flags = case_flags(case_drug, drug_incidence)
+    reaction_flags = case_flags(case_reaction, reaction_incidence)
+    row_codes = caseids.get_indexer(df_demo.index)
+    new_cols = {}
+    for j, config in enumerate(config_items):
+        new_cols[f"exposed {config.name}"] = drug_flags[row_codes, j]
+        if config.control is not None:
+            k = len(config_items) + controls.index(config)
+            new_cols[f"control {config.name}"] = drug_flags[row_codes, k]
+        new_cols[f"reacted {config.name}"] = reaction_flags[row_codes, j]
+    df_merged = pd.concat(
+        [df_demo, pd.DataFrame(new_cols, index=df_demo.index)], axis=1
+    )
+    return df_merged.reset_index().sort_values(["caseid", "q"])
+
+
+def mark_tables(
+    df_drug,
+    df_reac,
+    df_demo,
+    config_items,
+    drug_names,
+    reaction_types,
+    clusters=None,
+    engine="dense",
+):
+    """`mark_data` on the unmarked tables
+
+    The "dense" engine adds a column per drug and reaction, the "sparse"
+    engine uses sparse matrices whose size depends only on the number of
+    (case, term) rows.
+    """
+    if engine == "dense":
+        return mark_data(
+            df_drug=mark_drug_data(df_drug, drug_names),
+            df_reac=mark_reaction_data(df_reac, reaction_types),
+            df_demo=df_demo,
+            config_items=config_items,
+            clusters=clusters,
+        )
+    if engine == "sparse":
+        df_merged = merge_marks_sparse(df_drug, df_reac, df_demo, config_items)
+        logger.info(f"Handling duplicates of {len(df_merged):,d} rows")
+        return handle_duplicates(df_merged, clusters=clusters)
+    raise ValueError(f"Unknown marking engine {engine}")
+
+
+def _mark_shard(tables, **kwargs):
+    df_drug, df_reac, df_demo = tables
+    return mark_tables(df_drug, df_reac, df_demo, **kwargs)
+
+
+def mark_data_sharded(
+    df_drug,
+    df_reac,
+    df_demo,
+    config_items,
+    drug_names,
+    reaction_types,
+    shards,
+    clusters=None,
+    engine="dense",
+    max_bytes=0,
+):
+    """`mark_tables` in `shards` parallel processes
+
+    The rows are split by a hash of their caseid, so all the rows of a case
+    are marked and combined by the same process. The result is the same as
+    that of `mark_data`, in the same order.
+    """
+    shard_drug = shard_of(df_drug.caseid.values, shards, clusters)
+    shard_reac = shard_of(df_reac.caseid.values, shards, clusters)
+    shard_demo = shard_of(df_demo.index.values, shards, clusters)
+    tables = [
+        (
+            df_drug.loc[shard_drug == i],
+            df_reac.loc[shard_reac == i],
+            df_demo.loc[shard_demo == i],
+        )
+        for i in range(shards)
+        if (shard_demo == i).any()
+    ]
+    logger.info(f"Marking the data in {len(tables)} shards")
+    # Unlike a `Pool`, the executor fails if a worker is killed for its memory
+    with ProcessPoolExecutor(
+        min(shards, len(tables)),
+        initializer=utils.limit_memory,
+        initargs=(max_bytes,),
+    ) as pool:
+        parts = list(
+            pool.map(
+                partial(
+                    _mark_shard,
+                    drug_names=drug_names,
+                    reaction_types=reaction_types,
+                    config_items=config_items,
+                    clusters=clusters,
+                    engine=engine,
+                ),
+                tables,
+            )
+        )
+    return order_marked_rows(pd.concat(parts))
+
+
+def order_marked_rows(df):
+    """Sort marked rows the way `handle_duplicates` returns them
+
+    The cases that had one row come first, the combined ones after them,
+    each sorted by caseid.
+    """
+    order = np.lexsort((df.index.values, df.rows_per_caseid.isna().values))
+    return df.iloc[order]
+
+
+def quarter_meta_filename(fn):
+    return os.path.splitext(fn)[0] + ".json"
+
+
+def quarter_meta(df):
+    """The caseid type, config fingerprints and inputs of a marked quarter"""
+    return {
+        "caseid": str(df.index.dtype),
+        "configs": df.attrs.get("configs", {}),
+        "inputs": df.attrs.get("inputs"),
+    }
+
+
+def load_quarter_meta(fn):
+    """`quarter_meta` of the quarter pickled in `fn`, or None if there is none
+
+    It is read from the `.json` sidecar of the pickle, so that checking
+    whether a quarter is up to date does not unpickle it. Quarters saved
+    without a sidecar are unpickled.
+    """
+    if not os.path.exists(fn):
+        return None
+    fn_meta = quarter_meta_filename(fn)
+    if os.path.exists(fn_meta):
+        with open(fn_meta) as fh:
+            return json.load(fh)
+    return quarter_meta(pickle.load(open(fn, "rb")))
+
+
+def save_marked_quarter(df, fn):
+    """Pickle a marked quarter and its `quarter_meta` sidecar, atomically"""
+    fn_meta = quarter_meta_filename(fn)
+    # Until the pickle is replaced, so that the sidecar never describes an
+    # older version of it
+    if os.path.exists(fn_meta):
+        os.remove(fn_meta)
+    with open(fn + ".part", "wb") as fh:
+        pickle.dump(df, fh)
+    os.replace(fn + ".part", fn)
+    with open(fn_meta + ".part", "w") as fh:
+        json.dump(quarter_meta(df), fh)
+    os.replace(fn_meta + ".part", fn_meta)
+
+
+def quarter_inputs(fn_case_index, fn_duplicate_clusters, marking_engine, filtered_read):
+    """The inputs and options recorded with a marked quarter"""
+    return dict(
+        fn_case_index=fn_case_index,
+        fn_duplicate_clusters=fn_duplicate_clusters,
+        marking_engine=marking_engine,
+        filtered_read=filtered_read,
+    )
+
+
+def quarter_input_files(q, dir_in, fn_duplicate_clusters=None):
+    """The files quarter `q` is marked from
+
+    The case index is left out: `apply_index_changes` updates the marked
+    quarters when it changes, so that a new quarter does not make all the
+    earlier ones out of date.
+    """
+    ret = [utils.quarter_table_filename(dir_in, t, q) for t in ["demo", "drug", "reac"]]
+    if fn_duplicate_clusters:
+        ret.append(fn_duplicate_clusters)
+    return ret
+
+
+def load_valid_quarter_meta(output_file, fns_in, inputs):
+    """`load_quarter_meta` of a marked quarter that is up to date, else None"""
+    meta = load_quarter_meta(output_file)
+    if meta is None:
+        return None
+    if meta["caseid"] != utils.CASEID_DTYPE:
+        logger.info(f"Marking {output_file} again, its caseids are not integers")
+        return None
+    if meta["inputs"] != inputs or not utils.is_up_to_date(output_file, fns_in):
+        logger.info(f"Marking {output_file} again, its inputs changed")
+        return None
+    return meta
+
+
+def remove_marked_quarter(fn):
+    """Remove a quarter pickled by `save_marked_quarter`, so that it is marked
+    again"""
+    for fn_curr in [fn, quarter_meta_filename(fn)]:
+        if os.path.exists(fn_curr):
+            os.remove(fn_curr)
+
+
+def apply_index_changes(
+    dir_marked, before, after, dir_in, inputs, fn_duplicate_clusters=None
+):
+    """Bring the quarters marked with the case index `before` up to date with
+    the index `after`
+
+    A case whose latest version moved to another quarter is dropped from the
+    quarter of its previous version, whose other rows do not depend on it.
+    A quarter that now has the latest version of a case it was marked
+    without is removed, so that it is marked again. So is a quarter that
+    has to drop a report of a duplicate cluster, since the reports of a
+    cluster are combined into one row.
+
+    Returns the number of cases whose latest version changed.
+    """
+    caseids, quarters_before, quarters_after = case_index.changed_cases(before, after)
+    gained = {str(Quarter.from_ordinal(o)) for o in np.unique(quarters_after) if o >= 0}
+    for q in sorted(gained):
+        remove_marked_quarter(os.path.join(dir_marked, f"{q}.pkl"))
+    for o in np.unique(quarters_before):
+        q = str(Quarter.from_ordinal(o)) if o >= 0 else None
+        fn = os.path.join(dir_marked, f"{q}.pkl")
+        if q is None or q in gained or not os.path.exists(fn):
+            continue
+        fns_in = quarter_input_files(q, dir_in, fn_duplicate_clusters)
+        if fn_duplicate_clusters or not load_valid_quarter_meta(fn, fns_in, inputs):
+            remove_marked_quarter(fn)
+            continue
+        df = pickle.load(open(fn, "rb"))
+        keep = ~df.index.isin(caseids[quarters_before == o])
+        logger.info(f"Dropping {(~keep).sum():,d} superseded cases from {fn}")
+        attrs = df.attrs
+        df = df.loc[keep]
+        df.attrs = attrs
+        save_marked_quarter(df, fn)
+    return len(caseids)
+
+
+def update_range_index(
+    fn_case_index,
+    dir_out,
+    quarters,
+    dir_in,
+    fn_duplicate_clusters=None,
+    marking_engine="dense",
+    filtered_read=True,
+):
+    """Update the copy of the case index restricted to `quarters` in `dir_out`
+    and apply its changes to the quarters marked in `dir_out`
+
+    A case whose latest version comes after the last quarter keeps its
+    latest version within `quarters`. Returns the path of the copy, which the
+    quarters are marked with.
+    """
+    fn_range_index = os.path.join(dir_out, case_index.INDEX_FILENAME)
+    before = CaseIndex.load(fn_range_index, mmap_mode=None)
+    after = case_index.update_index(
+        fn_range_index, os.path.dirname(fn_case_index), quarters, save=False
+    )
+    inputs = quarter_inputs(
+        fn_range_index, fn_duplicate_clusters, marking_engine, filtered_read
+    )
+    dir_marked = os.path.join(dir_out, QUARTERS_SUBDIR)
+    os.makedirs(dir_marked, exist_ok=True)
+    # Saved once the marked quarters match it, so that a failed run applies
+    # the changes again
+    if apply_index_changes(
+        dir_marked, before, after, dir_in, inputs, fn_duplicate_clusters
+    ) or not os.path.exists(fn_range_index):
+        after.save(fn_range_index)
+    return fn_range_index
 
 
 def process_quarter_wrapper(
-    q, dir_in, dir_out, config_items, drug_names, reaction_types
+    q,
+    dir_in,
+    dir_out,
+    config_items,
+    drug_names,
+    reaction_types,
+    csv_engine="pandas",
+    fn_case_index=None,
+    fn_duplicate_clusters=None,
+    marking_engine="dense",
+    filtered_read=False,
+    shards=1,
+    chunksize=1 << 20,
+    max_bytes=0,
 ):
-    """Wrapper function for process_quarter to use with multiprocessing"""
+    """Mark quarter `q` and save it to `dir_out/{q}.pkl`
+
+    The cases reported in several quarters are combined later, by
+    `merge_quarter_files`. The file records the fingerprint of each config it
+    holds and the inputs it was marked from. If it already exists, only the
+    configs that are new or whose fingerprint changed are marked, and their
+    columns replace the old ones. The quarter is marked again if its tables
+    or the duplicate clusters changed, or if it was marked with other
+    options. Changes of the case index are applied by `apply_index_changes`.
+
+    Returns the quarter, its number of rows and the names of the configs
+    that were marked, or None if there was nothing to mark.
+    """
     output_file = os.path.join(dir_out, f"{q}.pkl")
-    if os.path.exists(output_file):
-        logger.debug(f"Skipping {q} because {output_file} already exists")
-        return
-    # Process the single quarter
-    template_drug = os.path.join(dir_in, "drugQ.csv.zip")
-    usecols = ["primaryid", "caseid", "drugname"]
-    df_drug = load_quarder_files(template_drug, [q], usecols=usecols).dropna()
-    df_drug = mark_drug_data(df_drug, drug_names)
+    fingerprints = {config.name: config.fingerprint() for config in config_items}
+    inputs = quarter_inputs(
+        fn_case_index, fn_duplicate_clusters, marking_engine, filtered_read
+    )
+    fns_in = quarter_input_files(q, dir_in, fn_duplicate_clusters)
+    df_done = None
+    meta = load_valid_quarter_meta(output_file, fns_in, inputs)
+    if meta is not None:
+        done = meta["configs"]
+        if done == fingerprints:
+            logger.debug(f"Skipping {q} because {output_file} already exists")
+            return
+        df_done = pickle.load(open(output_file, "rb"))
+        # Configs that were removed or changed
+        stale = [name for name in done if fingerprints.get(name) != done[name]]
+        df_done = df_done.drop(
+            columns=[c for name in stale for c in config_columns(name)],
+            errors="ignore",
+        )
+        config_items = [c for c in config_items if done.get(c.name) != c.fingerprint()]
+        drug_names, reaction_types = config_terms(config_items)
+        logger.info(f"Marking {len(config_items)} new configs in {output_file}")
+    if df_done is not None and not config_items:
+        df_done.attrs["configs"] = fingerprints
+        save_marked_quarter(df_done, output_file)
+        return dict(q=str(q), rows=len(df_done), configs=[])
+    index = CaseIndex.load(fn_case_index) if fn_case_index else None
+    clusters = load_clusters(fn_duplicate_clusters) if fn_duplicate_clusters else None
+    if marking_engine == "chunked":
+        df_drug, df_reac, df_demo = load_quarters_chunked(
+            [q],
+            dir_in,
+            drug_names,
+            reaction_types,
+            csv_engine=csv_engine,
+            index=index,
+            chunksize=chunksize,
+            max_bytes=max_bytes,
+        )
+        df_marked = mark_data(
+            df_drug, df_reac, df_demo, config_items=config_items, clusters=clusters
+        )
+    else:
+        df_drug, df_reac, df_demo = read_quarters(
+            [q],
+            dir_in,
+            csv_engine=csv_engine,
+            index=index,
+            drug_names=drug_names if filtered_read else None,
+            reaction_types=reaction_types if filtered_read else None,
+            chunksize=chunksize,
+            max_bytes=max_bytes,
+        )
+        if shards > 1:
+            df_marked = mark_data_sharded(
+                df_drug,
+                df_reac,
+                df_demo,
+                config_items=config_items,
+                drug_names=drug_names,
+                reaction_types=reaction_types,
+                shards=shards,
+                clusters=clusters,
+                engine=marking_engine,
+                max_bytes=max_bytes,
+            )
+        else:
+            df_marked = mark_tables(
+                df_drug,
+                df_reac,
+                df_demo,
+                config_items=config_items,
+                drug_names=drug_names,
+                reaction_types=reaction_types,
+                clusters=clusters,
+                engine=marking_engine,
+            )
+    if df_done is not None:
+        # The rows do not depend on the configs, only the new columns are kept
+        for config in config_items:
+            for c in config_columns(config.name):
+                if c in df_marked.columns:
+                    df_done[c] = df_marked[c].reindex(df_done.index).values
+        # The columns in the order `mark_data` gives them
+        flags = [
+            c
+            for name in fingerprints
+            for c in config_columns(name)
+            if c in df_done.columns
+        ]
+        rest = [c for c in df_done.columns if c not in flags + ["rows_per_caseid"]]
+        df_marked = df_done[rest + flags + ["rows_per_caseid"]]
+    df_marked.attrs["configs"] = fingerprints
+    df_marked.attrs["inputs"] = inputs
+    logger.info(f"Saving quarterly file {output_file}")
+    save_marked_quarter(df_marked, output_file)
 
-    template_reac = os.path.join(dir_in, "reacQ.csv.zip")
-    usecols = ["primaryid", "caseid", "pt"]
-    df_reac = load_quarder_files(template_reac, [q], usecols=usecols)
-    df_reac = mark_reaction_data(df_reac, reaction_types)
+    return dict(q=str(q), rows=len(df_marked), configs=[c.name for c in config_items])
 
-    fn_demo = os.path.join(dir_in, f"demo{q}.csv.zip")
-    df_demo = utils.read_demo_data(fn_demo).set_index("caseid")
-    df_demo["q"] = str(q)
 
-    df_marked = mark_data(
-        df_drug=df_drug, df_reac=df_reac, df_demo=df_demo, config_items=config_items
+# The arguments of `process_quarter_wrapper` that are the same for all
+# quarters, sent once to each marking process by `_init_marking_worker`
+_worker_kwargs = {}
+
+
+def _init_marking_worker(max_bytes, kwargs):
+    utils.limit_memory(max_bytes)
+    _worker_kwargs.update(kwargs)
+
+
+def _mark_quarter_in_worker(q):
+    """`process_quarter_wrapper` with the arguments the worker was given"""
+    return mark_quarter_in_process(q, **_worker_kwargs)
+
+
+def mark_quarter_in_process(q, **kwargs):
+    """`process_quarter_wrapper`, to be run in a worker process
+
+    The marked data is saved by the worker. Only the record of the quarter
+    and the names the worker normalized for it are sent back, so that the
+    parent can save them to the name caches.
+    """
+    normalizers = {
+        kind: normalizer for kind, (_, normalizer) in utils.NAME_CACHE_FILENAMES.items()
+    }
+    n_cached = {kind: len(normalizer.cache) for kind, normalizer in normalizers.items()}
+    record = process_quarter_wrapper(q, **kwargs)
+    new_names = {
+        kind: dict(list(normalizer.cache.items())[n_cached[kind] :])
+        for kind, normalizer in normalizers.items()
+    }
+    return record, new_names
+
+
+def combine_case_rows(df):
+    """Combine the marked rows of each case into one, like `handle_duplicates`
+
+    The rows of each case must be in the order of their quarters. The
+    combined rows keep the earliest quarter (and the caseid of its report),
+    the values of the latest row and the OR of the flags.
+    """
+    columns = df.columns
+    df = df.drop(columns="rows_per_caseid").reset_index()
+    cols_boolean = [c for c in df.columns if df.dtypes[c] == np.dtype(bool)]
+    cols_rest = [c for c in df.columns if (c not in cols_boolean + FIRST_ROW_COLUMNS)]
+    ret = resolve_duplicates(df, cols_boolean, cols_rest).set_index("caseid")
+    ret["rows_per_caseid"] = np.nan
+    return ret[columns]
+
+
+def save_case_quarters(dir_out, case_quarters):
+    """Save the quarter of the row of each case in the quarterly files"""
+    df = pd.DataFrame({"caseid": case_quarters.index, "q": case_quarters.values})
+    utils.write_table(df, os.path.join(dir_out, CASE_QUARTERS_FILENAME))
+
+
+def load_case_quarters(dir_out):
+    fn = os.path.join(dir_out, CASE_QUARTERS_FILENAME)
+    df = utils.read_table(
+        fn, columns=["caseid", "q"], dtype={"caseid": utils.CASEID_DTYPE}
     )
+    return df.set_index("caseid").q
 
-    # Only save the quarterly file for this quarter
 
-    logger.info(f"Saving quarterly file {output_file}")
-    pickle.dump(df_marked, open(output_file, "wb"))
+def merge_quarter_files(dir_in, dir_out, quarters, combined=False):
+    """Combine the cases that were reported in several quarters
+
+    The files in `dir_in` are the quarters marked by `process_quarter_wrapper`.
+    The quarters saved to the marked data store in `dir_out` hold the same
+    rows as if all quarters were marked at once: the rows of a case reported
+    in several quarters are combined into one, saved with the earliest of
+    these quarters.
+
+    The quarters are read one at a time, three times: to find the cases
+    reported in several quarters, to collect and combine their rows, and to
+    write the store. Only these cases are kept in memory. If `combined`,
+    all quarters are also saved to a single file, see `save_combined_file`.
+    """
+    fns = {q: os.path.join(dir_in, f"{q}.pkl") for q in quarters}
+    fns = {q: fn for q, fn in fns.items() if os.path.exists(fn)}
+
+    def read_quarters():
+        for q, fn in fns.items():
+            yield q, pickle.load(open(fn, "rb"))
 
-    return df_marked
+    caseids = pd.concat([df.index.to_series() for _, df in read_quarters()])
+    repeated = caseids.index[caseids.index.duplicated()].unique()
+    logger.info(f"{len(repeated):,d} cases were reported in several quarters")
+    # The quarters are read in order, so each case's rows are sorted by q
+    combined_cases = combine_case_rows(
+        pd.concat([df.loc[df.index.isin(repeated)] for _, df in read_quarters()])
+    )
+    combined_cases = dict(list(combined_cases.groupby("q", observed=True)))
+
+    case_quarters = []
+    for q, df in read_quarters():
+        df = pd.concat([df.loc[~df.index.isin(repeated)], combined_cases.get(str(q))])
+        df = order_marked_rows(df)
+        marked_store.write_quarter(dir_out, q, df)
+        logger.info(f"Saved quarterly file for {q}")
+        case_quarters.append(pd.Series(utils.quarter_column(q, len(df)), df.index))
+    save_case_quarters(dir_out, pd.concat(case_quarters))
+    if combined:
+        save_combined_file(dir_out, quarters)
+
+
+def save_combined_file(dir_out, quarters):
+    """Save all `quarters` of the store to a single file
+
+    The quarter files are copied one after another, so only one quarter is
+    in memory at a time. The rows of each quarter are in the order of
+    `handle_duplicates`.
+    """
+    fns = [marked_store.quarter_filename(dir_out, q) for q in quarters]
+    fns = [fn for fn in fns if os.path.exists(fn)]
+    schema = pa.unify_schemas([pa_parquet.read_schema(fn) for fn in fns])
+    fn_out = os.path.join(dir_out, marked_store.COMBINED_FILENAME)
+    with pa_parquet.ParquetWriter(fn_out + ".part", schema, compression="zstd") as fh:
+        for fn in fns:
+            fh.write_table(pa_parquet.read_table(fn).select(schema.names).cast(schema))
+    os.replace(fn_out + ".part", fn_out)
+
+
+def append_quarter_files(
+    dir_in, dir_out, quarters, new_quarters, remarked_quarters=(), combined=False
+):
+    """Add `new_quarters` to the quarters merged by `merge_quarter_files`
+
+    `new_quarters` must come after the quarters that are already merged. A
+    case of a new quarter that is already in the quarterly files is combined
+    with its existing row, which keeps its earliest quarter and is rewritten
+    in place. Only the new quarters and the stored quarters of their earlier
+    cases are read. If `combined`, the single file is copied again from all
+    `quarters`, since the earlier cases may be in any of them.
+
+    `remarked_quarters` are merged quarters that were marked again, e.g. to
+    drop the cases that a new quarter supersedes (see `apply_index_changes`).
+    Their stored rows are replaced, which requires that none of their cases
+    is in another quarter.
+    """
+    case_quarters = load_case_quarters(dir_out)
+    for q in remarked_quarters:
+        case_quarters = case_quarters.loc[(case_quarters != str(q)).values]
+        fn = os.path.join(dir_in, f"{q}.pkl")
+        if not os.path.exists(fn):
+            marked_store.remove_quarter(dir_out, q)
+            continue
+        df = order_marked_rows(pickle.load(open(fn, "rb")))
+        marked_store.write_quarter(dir_out, q, df)
+        logger.info(f"Replaced the quarterly file for {q}")
+        case_quarters = pd.concat(
+            [case_quarters, pd.Series(utils.quarter_column(q, len(df)), df.index)]
+        )
+    for q in new_quarters:
+        fn = os.path.join(dir_in, f"{q}.pkl")
+        if not os.path.exists(fn):
+            continue
+        df = pickle.load(open(fn, "rb"))
+        seen = df.index.isin(case_quarters.index)
+        logger.info(f"{seen.sum():,d} cases of {q} were reported in earlier quarters")
+        updates = df.loc[seen]
+        for p, caseids in updates.groupby(
+            case_quarters.reindex(updates.index).values, observed=True
+        ):
+            df_p = marked_store.read_quarter(dir_out, p)
+            caseids = caseids.index
+            df_p = pd.concat(
+                [
+                    df_p.loc[~df_p.index.isin(caseids)],
+                    combine_case_rows(
+                        pd.concat([df_p.loc[caseids], updates.loc[caseids]])
+                    ),
+                ]
+            )
+            marked_store.write_quarter(dir_out, p, order_marked_rows(df_p))
+            logger.info(
+                f"Updated {len(caseids):,d} cases in the quarterly file for {p}"
+            )
+        df = order_marked_rows(df.loc[~seen])
+        marked_store.write_quarter(dir_out, q, df)
+        logger.info(f"Saved quarterly file for {q}")
+        case_quarters = pd.concat(
+            [case_quarters, pd.Series(utils.quarter_column(q, len(df)), df.index)]
+        )
+    save_case_quarters(dir_out, case_quarters)
+    if combined:
+        save_combined_file(dir_out, quarters)
+
+
+def merge_quarters_or_append(
+    dir_in,
+    dir_out,
+    quarters,
+    config_items,
+    combined=False,
+    append=False,
+    unique_cases=False,
+):
+    """`append_quarter_files` if possible and `append`, `merge_quarter_files`
+    otherwise
+
+    Appending is possible if the quarters that were merged were not marked
+    again since, e.g. because their inputs changed. If `unique_cases`, no
+    case is in more than one quarter, so the quarters that were marked again
+    can replace their stored rows.
+    """
+    fn_state = os.path.join(dir_out, MERGE_STATE_FILENAME)
+    fns = {str(q): os.path.join(dir_in, f"{q}.pkl") for q in quarters}
+    state = {
+        "quarters": [str(q) for q in quarters],
+        "configs": configs_fingerprint(config_items),
+        "caseid": utils.CASEID_DTYPE,
+        "unique_cases": unique_cases,
+        "versions": {
+            q: os.path.getmtime(fn) for q, fn in fns.items() if os.path.exists(fn)
+        },
+    }
+    previous = None
+    if os.path.exists(fn_state):
+        previous = json.load(open(fn_state))
+        # Until this merge is done, so that a failed one is not appended to
+        os.remove(fn_state)
+    can_append = False
+    # A store marked with other configs, or from before caseids were
+    # integers, is merged again
+    if (
+        append
+        and previous
+        and all(previous.get(k) == state[k] for k in ["configs", "caseid"])
+    ):
+        merged = set(previous["quarters"])
+        new_quarters = [q for q in quarters if str(q) not in merged]
+        versions = previous.get("versions", {})
+        remarked_quarters = [
+            q
+            for q in quarters
+            if str(q) in merged
+            and versions.get(str(q)) != state["versions"].get(str(q))
+        ]
+        can_append = (
+            merged
+            and merged <= set(state["quarters"])
+            and all(str(q) > max(merged) for q in new_quarters)
+            and (
+                not remarked_quarters or (unique_cases and previous.get("unique_cases"))
+            )
+        )
+    if can_append:
+        logger.info(
+            f"Appending {len(new_quarters)} quarters, replacing "
+            f"{len(remarked_quarters)}"
+        )
+        append_quarter_files(
+            dir_in,
+            dir_out,
+            quarters,
+            new_quarters,
+            remarked_quarters=remarked_quarters,
+            combined=combined,
+        )
+    else:
+        merge_quarter_files(dir_in, dir_out, quarters, combined=combined)
+    fn_combined = os.path.join(dir_out, marked_store.COMBINED_FILENAME)
+    if not combined and os.path.exists(fn_combined):
+        # It would no longer match the store
+        os.remove(fn_combined)
+    with open(fn_state + ".part", "w") as fh:
+        json.dump(state, fh)
+    os.replace(fn_state + ".part", fn_state)
+
+
+def store_quarter_files(dir_in, dir_out, quarters):
+    """Save the quarters marked by `process_quarter_wrapper` to the store as
+    they are
+    """
+    fn_state = os.path.join(dir_out, MERGE_STATE_FILENAME)
+    if os.path.exists(fn_state):
+        os.remove(fn_state)
+    for q in quarters:
+        fn = os.path.join(dir_in, f"{q}.pkl")
+        if os.path.exists(fn):
+            marked_store.write_quarter(dir_out, q, pickle.load(open(fn, "rb")))
+
+
+def remove_partial_files(dir_out):
+    """Remove the files that a failed run left half-written
+
+    Every output is written to a `.part` file first, so the other files in
+    `dir_out` are complete: the quarters marked so far are kept for the next
+    run. A merge that did not finish has removed `MERGE_STATE_FILENAME`, so
+    the next run merges all quarters again.
+    """
+    for fn in glob.glob(os.path.join(dir_out, "**", "*.part"), recursive=True):
+        os.remove(fn)
+
+
+def invalidate_quarters(dir_out, quarters):
+    """Remove the outputs computed from quarters whose raw data changed"""
+    stale = []
+    for q in quarters:
+        marked_store.remove_quarter(dir_out, q)
+        fn = os.path.join(dir_out, QUARTERS_SUBDIR, f"{q}.pkl")
+        stale += [fn, quarter_meta_filename(fn)]
+    if stale:
+        stale.append(os.path.join(dir_out, marked_store.COMBINED_FILENAME))
+        stale.append(os.path.join(dir_out, MERGE_STATE_FILENAME))
+    for fn in stale:
+        if os.path.exists(fn):
+            logger.info(f"Removing {fn} because its input data changed")
+            os.remove(fn)
 
 
 def main(
@@ -200,6 +1276,18 @@ def main(
     dir_out,
     threads=1,
     clean_on_failure=True,
+    changed_quarters=None,
+    csv_engine="pandas",
+    fn_case_index=None,
+    fn_duplicate_clusters=None,
+    shards=1,
+    marking_engine="dense",
+    filtered_read=True,
+    merge_quarters=True,
+    combined_file=False,
+    chunksize=1 << 20,
+    memory_limit=0.0,
+    append=False,
 ):
 
     # --skip-if-exists --year-q-from=$(QUARTER_FROM) --year-q-to=$(QUARTER_TO) --dir-in=$(DIR_FAERS_DEDUPLICATED) --config-dir=$(CONFIG_DIR) --dir-out=$(DIR_MARKED_FILES) -t $(N_THREADS) --no-clean-on-failure
@@ -218,50 +1306,147 @@ def main(
     :param int threads:
         Threads in parallel processing
     :param bool clean_on_failure:
-        ???
+        Remove the half-written files if marking fails. The quarters marked
+        so far are kept, so that the next run continues from them
+    :param list[str] changed_quarters:
+        Quarters whose raw data changed since the previous run. Their
+        outputs are recomputed
+    :param str csv_engine:
+        Parser for input tables that were not ingested to Parquet, "pandas"
+        or "pyarrow"
+    :param str fn_case_index:
+        The caseid index built by the deduplication stage. If given, the rows
+        of cases that have a newer version in a later quarter are dropped
+        from each quarter, instead of being merged with the newer version.
+        Only the versions from `year_q_from` to `year_q_to` are considered:
+        a copy of the index restricted to these quarters is kept in
+        `dir_out`
+    :param str fn_duplicate_clusters:
+        The duplicate clusters found by `detect_duplicate_reports`. If given,
+        the reports of a cluster are combined as if they were one case
+    :param int shards:
+        Split the cases of each quarter by a hash of their caseid and mark
+        them in this many parallel processes. The quarters are then marked
+        one after another. 1 marks `threads` quarters in parallel
+    :param str marking_engine:
+        "dense" adds a boolean column per drug and reaction, "sparse" computes
+        the flags of all configs with sparse case x term matrices, "chunked"
+        marks the drug and reaction tables chunk by chunk and never holds a
+        whole table in memory
+    :param bool filtered_read:
+        Read the drug and reaction tables in chunks and keep only the rows
+        of the drugs and reactions in the configs
+    :param bool merge_quarters:
+        Combine the rows of the cases reported in several quarters, as if
+        all quarters were marked at once. Otherwise, the quarters are stored
+        as they were marked, independently of each other
+    :param bool combined_file:
+        Also save all quarters to a single file, `marked_data.parquet`, if
+        `merge_quarters`. The file is copied from every quarter of the store
+        after each merge, even one that only appended quarters
+    :param int chunksize:
+        N of rows read at once by the "chunked" engine and by `filtered_read`
+    :param float memory_limit:
+        Memory budget of each marking process, in GB. The drug and reaction
+        tables are read in chunks of at most `chunksize` rows and at most
+        `CHUNK_MEMORY_FRACTION` of the budget, measured on the first rows
+        of each table. The budget is also set as the ceiling of the virtual
+        address space of the process (RLIMIT_AS), which fails with
+        MemoryError above it. That counts more than resident memory, so it
+        needs headroom. 0 sets no limit
+    :param bool append:
+        If `merge_quarters`, add the quarters that are not merged yet to the
+        existing quarterly files, instead of merging all quarters again.
+        With `fn_case_index` (and no duplicate clusters), the merged quarters
+        from which a new quarter dropped superseded cases are replaced.
+        Falls back to a full merge if the configs changed, a new quarter
+        comes before a merged one, or a merged quarter was marked again
+        otherwise
 
     :return: None
 
     """
 
+    if marking_engine == "chunked" and shards > 1:
+        raise ValueError("The chunked marking engine does not support shards")
     dir_out = os.path.abspath(dir_out)
     os.makedirs(dir_out, exist_ok=True)
+    invalidate_quarters(dir_out, changed_quarters or [])
     try:
         q_from = Quarter(year_q_from)
         q_to = Quarter(year_q_to)
         config_items = QuestionConfig.load_config_items(config_dir)
-        drug_names = set()
-        reaction_types = set()
-        for config in config_items:
-            drug_names.update(set(config.drugs))
-            if config.control is not None:
-                drug_names.update(set(config.control))
-            reaction_types.update(set(config.reactions))
+        drug_names, reaction_types = config_terms(config_items)
         print(
             f"Will analyze {len(drug_names)} drugs and {len(reaction_types)} reactions"
         )
         quarters = list(generate_quarters(q_from, q_to))
-        process_quarters(
-            quarters,
+        # The quarters are marked separately and, if requested, combined
+        dir_marked = os.path.join(dir_out, QUARTERS_SUBDIR)
+        os.makedirs(dir_marked, exist_ok=True)
+        if fn_case_index:
+            fn_case_index = update_range_index(
+                fn_case_index,
+                dir_out,
+                quarters,
+                dir_in,
+                fn_duplicate_clusters=fn_duplicate_clusters,
+                marking_engine=marking_engine,
+                filtered_read=filtered_read,
+            )
+        # Names normalized in previous runs. The worker processes inherit them
+        utils.load_name_caches(dir_out)
+        max_bytes = int(memory_limit * 2**30)
+        kwargs = dict(
             dir_in=dir_in,
-            dir_out=dir_out,
+            dir_out=dir_marked,
             config_items=config_items,
             drug_names=drug_names,
             reaction_types=reaction_types,
+            csv_engine=csv_engine,
+            fn_case_index=fn_case_index,
+            fn_duplicate_clusters=fn_duplicate_clusters,
+            marking_engine=marking_engine,
+            filtered_read=filtered_read,
+            chunksize=chunksize,
+            max_bytes=max_bytes,
         )
-        with Pool(threads) as pool:
-            wrapper_func = partial(
-                process_quarter_wrapper,
-                dir_in=dir_in,
-                dir_out=dir_out,
-                config_items=config_items,
-                drug_names=drug_names,
-                reaction_types=reaction_types,
+        if shards > 1:
+            for q in tqdm.tqdm(quarters):
+                process_quarter_wrapper(q, shards=shards, **kwargs)
+        else:
+            with ProcessPoolExecutor(
+                threads,
+                initializer=_init_marking_worker,
+                initargs=(max_bytes, kwargs),
+            ) as pool:
+                results = pool.map(_mark_quarter_in_worker, quarters)
+                for record, new_names in tqdm.tqdm(results, total=len(quarters)):
+                    for kind, names in new_names.items():
+                        utils.NAME_CACHE_FILENAMES[kind][1].cache.update(names)
+                    if record is not None:
+                        logger.info(
+                            f"Marked {record['rows']:,d} cases of {record['q']} "
+                            f"for {len(record['configs'])} configs"
+                        )
+        utils.save_name_caches(dir_out)
+        if merge_quarters:
+            merge_quarters_or_append(
+                dir_marked,
+                dir_out,
+                quarters,
+                config_items,
+                combined=combined_file,
+                append=append,
+                # With the case index, each case is in a single quarter,
+                # unless the reports of a duplicate cluster are combined
+                unique_cases=bool(fn_case_index and not fn_duplicate_clusters),
             )
-            _ = list(tqdm.tqdm(pool.imap(wrapper_func, quarters), total=len(quarters)))
+        else:
+            store_quarter_files(dir_marked, dir_out, quarters)
     except Exception as err:
         if clean_on_failure:
-            shutil.rmtree(dir_out)
+            remove_partial_files(dir_out)
         raise err
 
 
@@ -0,0 +1,95 @@
+import glob
+import logging
+import os
+
+import pyarrow.parquet as pa_parquet
+
+from src import utils
+
+logger = logging.getLogger("FAERS")
+
+# The marked data is saved in this subdirectory of the marked data directory,
+# one Parquet file per quarter. The rows of a quarter are the cases whose
+# earliest report is from that quarter.
+STORE_SUBDIR = "marked"
+COMBINED_FILENAME = "marked_data.parquet"
+DEMOGRAPHIC_COLUMNS = ["age", "sex", "wt", "event_date", "q"]
+# The reports of a duplicate cluster are saved under the caseid of the
+# cluster. This column keeps the caseid of the report the row's quarter comes
+# from, which is the one in that quarter's other FAERS tables.
+REPORT_CASEID = "report_caseid"
+
+
+def config_columns(name):
+    """The columns `mark_data` may add for the config called `name`"""
+    return [f"exposed {name}", f"control {name}", f"reacted {name}"]
+
+
+def quarter_filename(dir_marked, q):
+    return os.path.join(dir_marked, STORE_SUBDIR, f"{q}{utils.INGESTED_EXTENSION}")
+
+
+def stored_quarters(dir_marked):
+    """The quarters in the store, in order"""
+    fns = glob.glob(quarter_filename(dir_marked, "*"))
+    return sorted(os.path.basename(fn).split(".")[0] for fn in fns)
+
+
+def stored_columns(dir_marked, q=None):
+    """The columns of quarter `q`, or of the first quarter, besides caseid"""
+    if q is None:
+        q = stored_quarters(dir_marked)[0]
+    names = pa_parquet.read_schema(quarter_filename(dir_marked, q)).names
+    return [c for c in names if c != "caseid"]
+
+
+def write_quarter(dir_marked, q, df):
+    """Save the marked rows of quarter `q`, a frame indexed by caseid"""
+    fn = quarter_filename(dir_marked, q)
+    os.makedirs(os.path.dirname(fn), exist_ok=True)
+    df = df.reset_index()
+    # `mark_data` keeps its own bookkeeping in the attributes
+    df.attrs = {}
+    utils.write_table(df, fn)
+
+
+def remove_quarter(dir_marked, q):
+    fn = quarter_filename(dir_marked, q)
+    if os.path.exists(fn):
+        logger.info(f"Removing {fn} because its input data changed")
+        os.remove(fn)
+
+
+def read_quarter(dir_marked, q, columns=None):
+    """The marked rows of quarter `q`, indexed by caseid
+
+    If `columns` are given, only they are read from the file.
+    """
+    if columns is not None:
+        columns = ["caseid"] + [c for c in columns if c != "caseid"]
+    df = utils.read_table(
+        quarter_filename(dir_marked, q),
+        columns=columns,
+        dtype={"caseid": utils.CASEID_DTYPE},
+    )
+    return df.set_index("caseid")
+
+
+def read_marked(dir_marked, quarters=None, columns=None):
+    """The marked rows of `quarters` (all quarters in the store by default)"""
+    if quarters is None:
+        quarters = stored_quarters(dir_marked)
+    quarters = [
+        q for q in map(str, quarters) if os.path.exists(quarter_filename(dir_marked, q))
+    ]
+    # A quarter with unknown codes has more categories than the others
+    return utils.concat_tables(
+        [read_quarter(dir_marked, q, columns=columns) for q in quarters]
+    )
+
+
+def read_config(dir_marked, config, quarters=None, columns=DEMOGRAPHIC_COLUMNS):
+    """`columns` and the marked columns of `config` only"""
+    stored = set(stored_columns(dir_marked))
+    columns = list(columns) + [c for c in config_columns(config.name) if c in stored]
+    return read_marked(dir_marked, quarters=quarters, columns=columns)
@@ -3,12 +3,17 @@ import logging
 import sys
 
 from src import (
+    case_index,
     download_faers_data,
+    verify_faers_data,
     deduplicate_faers_data,
+    ingest_faers_data,
+    detect_duplicate_reports,
     mark_data,
     get_demographic_data,
     summarize_demographic_data,
     report,
+    streaming_pipeline,
 )
 
 logger = logging.getLogger("FAERS")
@@ -27,40 +32,38 @@ logging_config = {
 }
 
 
-def main(
+def run_stage_by_stage(
     *,
-    year_q_from: str = "2020q1",
-    year_q_to: str = "2022q3",
+    year_q_from,
+    year_q_to,
+    refresh,
+    config_dir,
+    dir_interim,
+    download_dir,
+    dedup_dir,
+    ingest_dir,
+    marked_dir,
+    demography_dir,
+    detect_duplicates=False,
 ):
-    """
-    Run the pipeline.
-
-    Args:
-        year_q_from: The first quarter to process.
-        year_q_to: The last quarter to process.
-    """
-    logging.basicConfig(level=logging.INFO)
-    dir_data = "data"
-    dir_external = os.path.join(dir_data, "external")
-    dir_interim = os.path.join(dir_data, "interim")
-    dir_processed = os.path.join(dir_data, "processed")
-    config_dir = "config"
-
+    """Run every stage on all quarters before starting the next stage"""
     # 1. Download
     logging.info("[Pipeline] Downloading data...")
-    download_dir = os.path.join(dir_external, "faers")
     os.makedirs(download_dir, exist_ok=True)
-    download_faers_data.main(
+    changed_quarters = download_faers_data.main(
         year_q_from=year_q_from,
         year_q_to=year_q_to,
         dir_out=download_dir,
         threads=4,
+        refresh=refresh,
     )
-    # Optionally verify files here
+
+    # Verify the downloaded archives, so that corrupt files fail the run early
+    logging.info("[Pipeline] Verifying data...")
+    verify_faers_data.main(dir_in=download_dir, threads=4)
 
     # 2. Deduplicate
     logging.info("[Pipeline] Deduplicating data...")
-    dedup_dir = os.path.join(dir_interim, "faers_deduplicated")
     os.makedirs(dedup_dir, exist_ok=True)
     deduplicate_faers_data.main(
         dir_in=download_dir,
@@ -68,38 +71,133 @@ def main(
         threads=4,
     )
 
+    # Convert the tables to Parquet, once per quarter
+    logging.info("[Pipeline] Ingesting data...")
+    os.makedirs(ingest_dir, exist_ok=True)
+    ingest_faers_data.main(
+        dir_in=dedup_dir,
+        dir_out=ingest_dir,
+        threads=4,
+    )
+
+    # Find duplicate reports filed under different caseids
+    fn_duplicate_clusters = None
+    if detect_duplicates:
+        logging.info("[Pipeline] Detecting duplicate reports...")
+        fn_duplicate_clusters = detect_duplicate_reports.clusters_filename(
+            dir_interim, year_q_from, year_q_to
+        )
+        detect_duplicate_reports.main(
+            year_q_from=year_q_from,
+            year_q_to=year_q_to,
+            dir_in=ingest_dir,
+            fn_out=fn_duplicate_clusters,
+        )
+
     # 3. Mark the data
     logging.info("[Pipeline] Marking data...")
-    marked_dir = os.path.join(dir_interim, "marked_data_v2")
     os.makedirs(marked_dir, exist_ok=True)
     mark_data.main(
         year_q_from=year_q_from,
         year_q_to=year_q_to,
-        dir_in=dedup_dir,
+        dir_in=ingest_dir,
         config_dir=config_dir,
         dir_out=marked_dir,
         threads=7,
         clean_on_failure=True,
+        changed_quarters=changed_quarters,
+        fn_case_index=os.path.join(dedup_dir, case_index.INDEX_FILENAME),
+        fn_duplicate_clusters=fn_duplicate_clusters,
     )
 
     # 4. Demographic data
     logging.info("[Pipeline] Getting demographic data...")
-    demography_dir = os.path.join(dir_interim, "demographic_analysis_v2")
     os.makedirs(demography_dir, exist_ok=True)
     try:
         get_demographic_data.main(
             year_q_from=year_q_from,
             year_q_to=year_q_to,
-            dir_raw_data=dedup_dir,
+            dir_raw_data=ingest_dir,
             dir_marked_data=marked_dir,
             dir_config=config_dir,
             dir_out=demography_dir,
             threads=1,
             clean_on_failure=True,
+            changed_quarters=changed_quarters,
         )
     except FileNotFoundError as e:
         logging.warning(f"[Pipeline] Demographic data step failed: {e}")
 
+
+def main(
+    *,
+    year_q_from: str = "2020q1",
+    year_q_to: str = "2022q3",
+    refresh: bool = False,
+    streaming: bool = False,
+    detect_duplicates: bool = False,
+):
+    """
+    Run the pipeline.
+
+    Args:
+        year_q_from: The first quarter to process.
+        year_q_to: The last quarter to process.
+        refresh: Re-fetch the quarters that changed on the mirror and
+            recompute only their outputs.
+        streaming: Move each quarter through download, verification,
+            deduplication, ingestion and marking as soon as its files are
+            ready, instead of running the stages one after the other. With
+            detect_duplicates, marking waits for every quarter.
+        detect_duplicates: Combine the reports that MinHash finds to be
+            duplicates filed under different caseids.
+    """
+    logging.basicConfig(level=logging.INFO)
+    dir_data = "data"
+    dir_external = os.path.join(dir_data, "external")
+    dir_interim = os.path.join(dir_data, "interim")
+    dir_processed = os.path.join(dir_data, "processed")
+    config_dir = "config"
+    download_dir = os.path.join(dir_external, "faers")
+    dedup_dir = os.path.join(dir_interim, "faers_deduplicated")
+    ingest_dir = os.path.join(dir_interim, "faers_ingested")
+    marked_dir = os.path.join(dir_interim, "marked_data_v2")
+    demography_dir = os.path.join(dir_interim, "demographic_analysis_v2")
+    fn_duplicate_clusters = None
+    if detect_duplicates:
+        fn_duplicate_clusters = detect_duplicate_reports.clusters_filename(
+            dir_interim, year_q_from, year_q_to
+        )
+
+    if streaming:
+        logging.info("[Pipeline] Streaming the quarters through the stages...")
+        streaming_pipeline.main(
+            year_q_from=year_q_from,
+            year_q_to=year_q_to,
+            download_dir=download_dir,
+            dedup_dir=dedup_dir,
+            ingest_dir=ingest_dir,
+            config_dir=config_dir,
+            marked_dir=marked_dir,
+            demography_dir=demography_dir,
+            refresh=refresh,
+            fn_duplicate_clusters=fn_duplicate_clusters,
+        )
+    else:
+        run_stage_by_stage(
+            year_q_from=year_q_from,
+            year_q_to=year_q_to,
+            refresh=refresh,
+            config_dir=config_dir,
+            dir_interim=dir_interim,
+            download_dir=download_dir,
+            dedup_dir=dedup_dir,
+            ingest_dir=ingest_dir,
+            marked_dir=marked_dir,
+            demography_dir=demography_dir,
+            detect_duplicates=detect_duplicates,
+        )
+
     # 5. Demographic summary
     logging.info("[Pipeline] Summarizing demographic data...")
     summary_dir = os.path.join(dir_interim, "demographic_summary_v2")
@@ -121,10 +219,11 @@ def main(
     try:
         report.main(
             dir_marked_data=marked_dir,
-            dir_raw_data=dedup_dir,
+            dir_raw_data=ingest_dir,
             config_dir=config_dir,
             dir_reports=reports_dir,
             output_raw_exposure_data=True,
+            fn_duplicate_clusters=fn_duplicate_clusters,
         )
     except Exception as e:
         logging.warning(f"[Pipeline] Report step failed: {e}")
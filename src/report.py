@@ -1,5 +1,6 @@
 # We will use a class instead of a set of functions, mainly for figure management
-import pickle
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache, partial
 from glob import glob
 
 import defopt
@@ -13,7 +14,9 @@ from matplotlib import pylab as plt
 from statsmodels.stats.outliers_influence import variance_inflation_factor
 import logging
 
-from src import utils
+from src import marked_store, utils
+from src.detect_duplicate_reports import load_clusters
+from src.case_table import CaseTable, load_case_table
 from src.utils import html_from_fig, ContingencyMatrix, QuestionConfig
 
 logger = logging.getLogger("FAERS")
@@ -22,11 +25,19 @@ logger = logging.getLogger("FAERS")
 class Reporter:
     FORMATS = ["png"]
 
-    def __init__(self, config, dir_out, dir_raw_data, output_raw_exposure_data):
+    def __init__(
+        self,
+        config,
+        dir_out,
+        dir_raw_data,
+        output_raw_exposure_data,
+        fn_duplicate_clusters=None,
+    ):
         self.config = config
         self.title = config.name
         self.dir_out = os.path.join(dir_out, self.title)
         self.dir_raw_data = dir_raw_data
+        self.fn_duplicate_clusters = fn_duplicate_clusters
         for format_ in self.FORMATS:
             os.makedirs(os.path.join(self.dir_out, format_), exist_ok=True)
         self.figure_count = 0
@@ -224,15 +235,10 @@ class Reporter:
         return "\n".join(lines)
 
     def count_serious_outcomes(self, outcome_cases):
-        # We assume that if a case ID is listed in `outcome*.csv.zip` it is
-        # a "serious" outcome
-        outcome_files = glob(os.path.join(self.dir_raw_data, "outc*.csv.zip"))
-        serious_outcomes = set()
-        for f in outcome_files:
-            serious_outcomes.update(
-                pd.read_csv(f, usecols=["caseid"], dtype=str).caseid.values
-            )
-        n_serious = np.sum([c in serious_outcomes for c in outcome_cases])
+        serious_outcomes = load_serious_outcome_cases(
+            self.dir_raw_data, self.fn_duplicate_clusters
+        )
+        n_serious = np.isin(outcome_cases, serious_outcomes, assume_unique=True).sum()
         return n_serious
 
     def demographic_table(self, data):
@@ -311,15 +317,14 @@ class Reporter:
         )
         html_table = summary_table.to_html(index=False)
         additional_rows = []
-        cases_with_outcome = set(data.loc[data[col_ouctome]].index)
+        cases_with_outcome = data.index[data[col_ouctome].values].unique()
         additional_rows.append(
             f"Of {len(data):,d} cases, {len(cases_with_outcome):,d} had a reaction."
         )
         n_exposed = data[col_exposure].sum()
-        reports_with_exposure = set(data.loc[data[col_exposure]].index)
-        cases_with_outcome_and_exposure = cases_with_outcome.intersection(
-            reports_with_exposure
-        )
+        cases_with_outcome_and_exposure = data.index[
+            (data[col_ouctome] & data[col_exposure]).values
+        ].unique()
         n_serious = self.count_serious_outcomes(cases_with_outcome_and_exposure)
         p_serious = 100 * n_serious / n_exposed
         additional_rows.append(
@@ -341,16 +346,22 @@ class Reporter:
         lines.append("<H3>ROR data</H3>")
         config = self.config
         rors = []
-        columns_to_keep = ["age", "sex", "event_date", "q"] + [
-            c for c in data.columns if c.endswith(config.name)
-        ]
-        if "wt" in data.columns:
-            columns_to_keep.append("wt")
-        ror_data = pd.DataFrame()
-        gr = data[columns_to_keep].groupby("q")
-        for q, curr in sorted(gr):
-            ror_data = pd.concat((ror_data, curr))
-            contingency_matrix = ContingencyMatrix.from_results_table(ror_data, config)
+        col_exposure = f"exposed {config.name}"
+        col_outcome = f"reacted {config.name}"
+        # With the rows sorted by quarter, the cases up to a quarter are a
+        # prefix of the columns, counted by their cumulative sums
+        data = data.sort_values("q", kind="stable")
+        exposure = data[col_exposure].to_numpy(dtype=bool)
+        outcome = data[col_outcome].to_numpy(dtype=bool)
+        n_exposed = np.cumsum(exposure)
+        n_reacted = np.cumsum(outcome)
+        n_both = np.cumsum(exposure & outcome)
+        counts = data.q.value_counts(sort=False)
+        counts = counts.loc[counts.values > 0]
+        for q, stop in zip(counts.index, np.cumsum(counts.values)):
+            contingency_matrix = ContingencyMatrix.from_counts(
+                n_exposed[stop - 1], n_reacted[stop - 1], n_both[stop - 1], stop
+            )
             ror, (lower, upper) = contingency_matrix.ror()
             rors.append([q, lower, ror, upper])
         df_rors = pd.DataFrame(rors, columns=["q", "ROR_lower", "ROR", "ROR_upper"])
@@ -432,13 +443,43 @@ class Reporter:
         return ax_ror
 
 
-def filter_illegal_values(data):
-    sel = (
+@lru_cache(maxsize=None)
+def load_serious_outcome_cases(dir_raw_data, fn_duplicate_clusters=None):
+    # We assume that if a case ID is listed in `outcome*.csv.zip` it is
+    # a "serious" outcome
+    outcome_files = glob(os.path.join(dir_raw_data, "outc*" + utils.RAW_EXTENSION))
+    outcome_files += glob(
+        os.path.join(dir_raw_data, "outc*" + utils.INGESTED_EXTENSION)
+    )
+    # Each quarter is read once, from the Parquet file if it exists
+    outcome_files = sorted({utils.resolve_table_filename(f) for f in outcome_files})
+    serious_outcomes = [np.empty(0, dtype=utils.CASEID_DTYPE)]
+    for f in outcome_files:
+        serious_outcomes.append(
+            utils.read_table(
+                f, columns=["caseid"], dtype={"caseid": utils.CASEID_DTYPE}
+            ).caseid.values
+        )
+    caseids = pd.Series(np.concatenate(serious_outcomes))
+    if fn_duplicate_clusters:
+        # The marked data holds the reports of a duplicate cluster under the
+        # caseid of the cluster, whichever report had the outcome
+        clusters = load_clusters(fn_duplicate_clusters)
+        caseids = caseids.map(clusters).fillna(caseids).astype(utils.CASEID_DTYPE)
+    # Sorted and unique, the caseids are looked up with np.isin
+    return np.unique(caseids.values)
+
+
+def legal_values(data):
+    return (
         ((data.wt > 0) & (data.wt < 360))
         & ((data.age > 0) & (data.age < 120))
         & (data.sex.isin({"M", "F"}))
     )
-    return data.loc[sel]
+
+
+def filter_illegal_values(data):
+    return data.loc[legal_values(data)]
 
 
 def filter_data_for_regression(data, config, including_the_weight=True):
@@ -465,6 +506,64 @@ def filter_data_for_regression(data, config, including_the_weight=True):
         return data.loc[sel]
 
 
+def report_config(
+    config,
+    dir_marked_data,
+    dir_raw_data,
+    dir_reports,
+    output_raw_exposure_data,
+    fn_duplicate_clusters=None,
+):
+    # The demographic columns come from the case table, which the processes
+    # share, and only this config's columns are read from the store
+    table = CaseTable.load(dir_marked_data)
+    flags = marked_store.read_config(dir_marked_data, config, columns=[])
+    if not np.array_equal(flags.index.values, table.arrays["caseid"]):
+        raise ValueError(f"The case table of {dir_marked_data} is out of date")
+
+    def frame(ordinals=None):
+        ret = table.frame(ordinals)
+        for c in flags.columns:
+            values = flags[c].values
+            ret[c] = values if ordinals is None else values[ordinals]
+        return ret
+
+    data = frame()
+    reporter = Reporter(
+        config,
+        dir_reports,
+        dir_raw_data=dir_raw_data,
+        output_raw_exposure_data=output_raw_exposure_data,
+        fn_duplicate_clusters=fn_duplicate_clusters,
+    )
+    reporter.report(
+        data, "01 Initial data", explanation="Raw data", skip_lr=True, config=config
+    )
+
+    # The rows with legal values are selected on the shared arrays, so that
+    # only they are copied to this process
+    legal = legal_values(table.frame(columns=["age", "wt", "sex"]))
+    data = frame(np.flatnonzero(legal.values))
+
+    data_lr = filter_data_for_regression(data, config)
+
+    reporter.report(
+        data_lr,
+        "03 Stratified for LR",
+        config=config,
+        explanation="After filtering out age and weight values that do not fit 99 percentile of the exposed population",
+    )
+
+    data_lr = filter_data_for_regression(data, config, including_the_weight=False)
+    reporter.report(
+        data_lr,
+        "04 Stratified for LR ignoring weight",
+        config=config,
+        explanation="After filtering out age values that do not fit 99 percentile "
+        "of the exposed population",
+    )
+
+
 def main(
     *,
     dir_marked_data,
@@ -472,6 +571,8 @@ def main(
     config_dir,
     dir_reports,
     output_raw_exposure_data=False,
+    threads=1,
+    fn_duplicate_clusters=None,
 ):
     """
 
@@ -487,49 +588,34 @@ def main(
         output directory
     :param bool output_raw_exposure_data:
         whether to include raw table of exposure cases
+    :param int threads:
+        N of parallel processes, each reports one config at a time
+    :param str fn_duplicate_clusters:
+        The duplicate clusters the data was marked with, if any. A serious
+        outcome of any report of a cluster counts for the cluster
 
     :return:
 
     """
 
     config_items = QuestionConfig.load_config_items(config_dir)
-    files = sorted(glob(os.path.join(dir_marked_data, "*.pkl")))
-    data_all_configs = pd.concat([pickle.load(open(f, "rb")) for f in files])
-    for config in tqdm.tqdm(config_items):
-        print(f"DEBUG {config.name}")
-        columns_to_keep = ["age", "sex", "wt", "event_date", "q"] + [
-            c for c in data_all_configs.columns if c.endswith(config.name)
-        ]
-        data = data_all_configs[columns_to_keep]
-        reporter = Reporter(
-            config,
-            dir_reports,
-            dir_raw_data=dir_raw_data,
-            output_raw_exposure_data=output_raw_exposure_data,
-        )
-        reporter.report(
-            data, "01 Initial data", explanation="Raw data", skip_lr=True, config=config
-        )
-
-        data = filter_illegal_values(data)
-
-        data_lr = filter_data_for_regression(data, config)
-
-        reporter.report(
-            data_lr,
-            "03 Stratified for LR",
-            config=config,
-            explanation="After filtering out age and weight values that do not fit 99 percentile of the exposed population",
-        )
-
-        data_lr = filter_data_for_regression(data, config, including_the_weight=False)
-        reporter.report(
-            data_lr,
-            "04 Stratified for LR ignoring weight",
-            config=config,
-            explanation="After filtering out age values that do not fit 99 percentile "
-            "of the exposed population",
-        )
+    # Built once, then memory-mapped by every process
+    load_case_table(dir_marked_data)
+    func = partial(
+        report_config,
+        dir_marked_data=dir_marked_data,
+        dir_raw_data=dir_raw_data,
+        dir_reports=dir_reports,
+        output_raw_exposure_data=output_raw_exposure_data,
+        fn_duplicate_clusters=fn_duplicate_clusters,
+    )
+    if threads == 1:
+        for config in tqdm.tqdm(config_items):
+            print(f"DEBUG {config.name}")
+            func(config)
+        return
+    with ProcessPoolExecutor(threads) as pool:
+        _ = list(tqdm.tqdm(pool.map(func, config_items), total=len(config_items)))
 
 
 if __name__ == "__main__":
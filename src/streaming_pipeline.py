@@ -0,0 +1,256 @@
+import asyncio
+import glob
+import logging
+import os
+import queue
+import threading
+from multiprocessing import Pool
+
+from src import (
+    case_index,
+    deduplicate_faers_data,
+    detect_duplicate_reports,
+    download_faers_data,
+    get_demographic_data,
+    ingest_faers_data,
+    mark_data,
+    utils,
+    verify_faers_data,
+)
+from src.utils import Quarter, QuestionConfig, generate_quarters
+
+logger = logging.getLogger("FAERS")
+
+_DONE = object()
+
+
+def _stage_worker(name, func, queue_in, queue_out, failed):
+    """Apply `func` to every quarter from `queue_in` and pass it on to `queue_out`
+
+    After a failure in any stage, the remaining quarters are drained without
+    being processed, so that no stage is left blocked on a full queue.
+    """
+    try:
+        while True:
+            q = queue_in.get()
+            if q is _DONE:
+                break
+            if failed.is_set():
+                continue
+            logger.info(f"[{name}] {q}")
+            func(q)
+            if queue_out is not None:
+                queue_out.put(q)
+    except Exception:
+        logger.exception(f"[{name}] failed")
+        failed.set()
+        while queue_in.get() is not _DONE:
+            pass
+    finally:
+        if queue_out is not None:
+            queue_out.put(_DONE)
+
+
+def run_stages(quarters, stages, queue_size=2):
+    """Stream `quarters` through `stages`, a list of (name, func) pairs
+
+    Every stage runs in its own thread and works on one quarter at a time.
+    The stages are connected by queues of at most `queue_size` quarters, so
+    that a fast stage cannot run far ahead of a slow one.
+    """
+    queues = [queue.Queue(maxsize=queue_size) for _ in stages]
+    failed = threading.Event()
+    threads = []
+    for i, (name, func) in enumerate(stages):
+        queue_out = queues[i + 1] if i + 1 < len(stages) else None
+        t = threading.Thread(
+            target=_stage_worker,
+            args=(name, func, queues[i], queue_out, failed),
+            name=name,
+            daemon=True,
+        )
+        t.start()
+        threads.append(t)
+    for q in quarters:
+        if failed.is_set():
+            break
+        queues[0].put(q)
+    queues[0].put(_DONE)
+    for t in threads:
+        t.join()
+    if failed.is_set():
+        raise RuntimeError("A pipeline stage failed, see the log for details")
+
+
+def main(
+    *,
+    year_q_from,
+    year_q_to,
+    download_dir,
+    dedup_dir,
+    ingest_dir,
+    config_dir,
+    marked_dir,
+    demography_dir,
+    threads=4,
+    queue_size=2,
+    refresh=False,
+    base_url=download_faers_data.NBER_BASE_URL,
+    fn_duplicate_clusters=None,
+):
+    """Download, verify, deduplicate, ingest and mark each quarter as soon as
+    the files of that quarter are ready
+
+    The stages run concurrently: while one quarter is being downloaded, the
+    previous ones are deduplicated, ingested and marked. The CPU-bound work
+    is submitted to a pool of `threads` processes: the deduplication of the
+    next quarters and the tables of a quarter being ingested run in parallel.
+
+    Each quarter is marked with the case index of the quarters ingested so
+    far. A later quarter with newer versions of its cases only drops them
+    from it (see `mark_data.update_range_index`), so the final
+    `mark_data.main` merges the quarters without marking them again. The
+    duplicate clusters, if `fn_duplicate_clusters` is given, are detected
+    from all quarters at once and change the marked rows of every quarter,
+    so in that case the quarters are marked once all of them are ingested.
+    The demographic data also starts once every quarter is marked.
+
+    :return: list of quarters whose files were (re)downloaded
+    """
+    for d in [download_dir, dedup_dir, ingest_dir, marked_dir, demography_dir]:
+        os.makedirs(d, exist_ok=True)
+    quarters = list(generate_quarters(Quarter(year_q_from), Quarter(year_q_to)))
+    manifest = download_faers_data.load_manifest(download_dir)
+    verification = verify_faers_data.load_manifest(download_dir)
+    fn_verified = os.path.join(download_dir, verify_faers_data.SUCCESS_FILENAME)
+    if os.path.exists(fn_verified):
+        os.remove(fn_verified)
+    changed_quarters = set()
+    config_items = QuestionConfig.load_config_items(config_dir)
+    drug_names, reaction_types = mark_data.config_terms(config_items)
+    # As `mark_data.main` marks the quarters with its default options, so
+    # that it finds them up to date
+    mark_kwargs = dict(
+        dir_in=ingest_dir,
+        dir_out=os.path.join(marked_dir, mark_data.QUARTERS_SUBDIR),
+        config_items=config_items,
+        drug_names=drug_names,
+        reaction_types=reaction_types,
+        filtered_read=True,
+    )
+    fn_case_index = os.path.join(dedup_dir, case_index.INDEX_FILENAME)
+    # The quarters that a previous run indexed stay in the index, so that a
+    # rerun does not drop their cases from the earlier quarters and mark them
+    # again
+    indexed = set(
+        case_index.CaseIndex.load(
+            os.path.join(marked_dir, case_index.INDEX_FILENAME)
+        ).quarters
+    ) & {str(q) for q in quarters}
+
+    def download(q):
+        urls = download_faers_data.quarter_urls(q, base_url=base_url)
+        downloaded, failed = asyncio.run(
+            download_faers_data.download_urls_async(
+                urls,
+                download_dir,
+                connections_per_host=threads,
+                progress=False,
+                refresh=refresh,
+                manifest=manifest,
+            )
+        )
+        manifest.update(downloaded)
+        download_faers_data.save_manifest(download_dir, manifest)
+        download_faers_data.raise_for_failures(failed)
+        if downloaded:
+            changed_quarters.add(str(q))
+        for url in urls:
+            fn = download_faers_data.filename_from_url(url, download_dir)
+            if not os.path.exists(fn):
+                raise FileNotFoundError(f"Failed to download {url}")
+            record = verify_faers_data.verify_if_changed(fn, verification)
+            if not record["ok"]:
+                verify_faers_data.save_manifest(download_dir, verification)
+                raise RuntimeError(f"Corrupt archive {fn}: {record['error']}")
+        verify_faers_data.save_manifest(download_dir, verification)
+
+    deduplicated = {}
+
+    def deduplicate(q):
+        # Not waited for, so that the next quarters are deduplicated while
+        # this one is ingested
+        deduplicated[q] = pool.apply_async(
+            deduplicate_faers_data.deduplicate_quarter, (q, download_dir, dedup_dir)
+        )
+
+    def ingest(q):
+        deduplicated.pop(q).get()
+        jobs = [
+            pool.apply_async(ingest_faers_data.ingest_file, (fn, ingest_dir))
+            for fn in glob.glob(os.path.join(dedup_dir, f"*{q}.*"))
+        ]
+        for job in jobs:
+            job.get()
+
+    def mark(q):
+        if str(q) in changed_quarters:
+            mark_data.invalidate_quarters(marked_dir, [q])
+        indexed.add(str(q))
+        fn_range_index = mark_data.update_range_index(
+            fn_case_index, marked_dir, sorted(indexed), ingest_dir
+        )
+        record, new_names = pool.apply(
+            mark_data.mark_quarter_in_process,
+            (q,),
+            dict(mark_kwargs, fn_case_index=fn_range_index),
+        )
+        for kind, names in new_names.items():
+            utils.NAME_CACHE_FILENAMES[kind][1].cache.update(names)
+        if record is not None:
+            logger.info(f"Marked {record['rows']:,d} cases of {record['q']}")
+
+    stages = [("download", download), ("deduplicate", deduplicate), ("ingest", ingest)]
+    if not fn_duplicate_clusters:
+        stages.append(("mark", mark))
+    # Names normalized in previous runs. The worker processes inherit them
+    utils.load_name_caches(marked_dir)
+    with Pool(threads) as pool:
+        run_stages(quarters, stages, queue_size=queue_size)
+    utils.save_name_caches(marked_dir)
+    if verify_faers_data.is_verified(download_dir, verification):
+        verify_faers_data.write_success_file(download_dir, verification)
+    case_index.update_index(fn_case_index, dedup_dir)
+    if fn_duplicate_clusters:
+        detect_duplicate_reports.main(
+            year_q_from=year_q_from,
+            year_q_to=year_q_to,
+            dir_in=ingest_dir,
+            fn_out=fn_duplicate_clusters,
+        )
+    changed_quarters = sorted(changed_quarters)
+    mark_data.main(
+        year_q_from=year_q_from,
+        year_q_to=year_q_to,
+        dir_in=ingest_dir,
+        config_dir=config_dir,
+        dir_out=marked_dir,
+        threads=threads,
+        clean_on_failure=True,
+        # The quarters marked by the "mark" stage are already invalidated
+        changed_quarters=changed_quarters if fn_duplicate_clusters else None,
+        fn_case_index=fn_case_index,
+        fn_duplicate_clusters=fn_duplicate_clusters,
+    )
+    get_demographic_data.main(
+        year_q_from=year_q_from,
+        year_q_to=year_q_to,
+        dir_raw_data=ingest_dir,
+        dir_marked_data=marked_dir,
+        dir_config=config_dir,
+        dir_out=demography_dir,
+        threads=1,
+        clean_on_failure=True,
+        changed_quarters=changed_quarters,
+    )
+    return changed_quarters
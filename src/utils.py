@@ -1,12 +1,18 @@
+import hashlib
 import io
 import json
 import logging
 import os
+import zipfile
 from collections import namedtuple
+from contextlib import contextmanager
 from glob import glob
 
 import pandas as pd
 import numpy as np
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+import pyarrow.parquet as pa_parquet
 import scipy.stats as stats
 import re
 
@@ -67,6 +73,15 @@ class Quarter:
             year += 1
         return Quarter(year, quarter)
 
+    def ordinal(self):
+        """Number of quarters since year 0, handy for compact integer storage"""
+        return self.year * 4 + self.quarter - 1
+
+    @classmethod
+    def from_ordinal(cls, ordinal):
+        year, quarter = divmod(int(ordinal), 4)
+        return cls(year, quarter + 1)
+
     def __eq__(self, other):
         if other is self:
             return True
@@ -130,18 +145,33 @@ class ContingencyMatrix:
         return self
 
     @classmethod
-    def from_results_table(cls, data, config):
-        exposure = data[f"exposed {config.name}"]
-        exposure.name = "exposure"
-        outcome = data[f"reacted {config.name}"]
-        outcome.name = "outcome"
-        crosstab = (
-            pd.crosstab(exposure, outcome)
-            .reindex([False, True], axis=0, fill_value=0)
-            .reindex([False, True], axis=1, fill_value=0)
+    def from_counts(cls, n_exposed, n_reacted, n_both, n):
+        """From the N of exposed, reacted and exposed and reacted of `n` cases"""
+        crosstab = pd.DataFrame(
+            [
+                [n - n_exposed - n_reacted + n_both, n_reacted - n_both],
+                [n_exposed - n_both, n_both],
+            ],
+            index=pd.Index([False, True], name="exposure"),
+            columns=pd.Index([False, True], name="outcome"),
         )
         return ContingencyMatrix(crosstab)
 
+    @classmethod
+    def from_results_table(cls, data, config):
+        """The matrix of `config` from a marked table
+
+        The four cells are counted on the boolean columns, without a crosstab.
+        """
+        exposure = data[f"exposed {config.name}"].to_numpy(dtype=bool)
+        outcome = data[f"reacted {config.name}"].to_numpy(dtype=bool)
+        return cls.from_counts(
+            np.count_nonzero(exposure),
+            np.count_nonzero(outcome),
+            np.count_nonzero(exposure & outcome),
+            len(data),
+        )
+
     def get_count_value(self, exposure, outcome):
         ret = self.tbl.loc[(exposure, outcome)]["n"]
         return ret
@@ -269,6 +299,13 @@ class QuestionConfig:
             )
         return ret
 
+    def fingerprint(self):
+        """A hash of the drugs, reactions and control drugs of the config"""
+        content = [sorted(set(self.drugs)), sorted(set(self.reactions))]
+        if self.control is not None:
+            content.append(sorted(set(self.control)))
+        return hashlib.sha256(json.dumps(content).encode()).hexdigest()[:16]
+
     def filename_from_config(self, directory, extension=".csv"):
         if extension:
             assert extension.startswith(".")
@@ -282,9 +319,450 @@ class QuestionConfig:
         return str(self.__dict__)
 
 
+class NameNormalizer:
+    """Memoized normalization of a column of names
+
+    Every distinct value is normalized once and the results are kept in a
+    dictionary, which is shared by all the quarters a process handles and
+    can be saved to a file to be reused by other processes and runs.
+    """
+
+    def __init__(self, func):
+        self.func = func
+        self.cache = {}
+
+    def __call__(self, values):
+        """The normalized `values`, as a categorical"""
+        values = pd.Series(values)
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            codes = values.cat.codes.values
+            uniques = values.cat.categories
+        else:
+            codes, uniques = pd.factorize(values)
+        for u in uniques:
+            if u not in self.cache:
+                self.cache[u] = self.func(u)
+        normalized = pd.Index([self.cache[u] for u in uniques])
+        categories = normalized.unique()
+        unique_codes = categories.get_indexer(normalized)
+        codes = np.where(codes >= 0, unique_codes[codes], -1)
+        ret = pd.Categorical.from_codes(codes, categories)
+        return pd.Series(ret, index=values.index, name=values.name)
+
+    def load(self, fn):
+        if os.path.exists(fn):
+            with open(fn) as fh:
+                self.cache.update(json.load(fh))
+
+    def save(self, fn):
+        with open(fn + ".part", "w") as fh:
+            json.dump(self.cache, fh, sort_keys=True)
+        os.replace(fn + ".part", fn)
+
+
+DRUG_NAMES = NameNormalizer(QuestionConfig.normalize_drug_name)
+REACTION_NAMES = NameNormalizer(QuestionConfig.normalize_reaction_name)
+NAME_CACHE_FILENAMES = {
+    "drug": ("normalized_drug_names.json", DRUG_NAMES),
+    "reaction": ("normalized_reaction_names.json", REACTION_NAMES),
+}
+
+
+def load_name_caches(directory):
+    for fn, normalizer in NAME_CACHE_FILENAMES.values():
+        normalizer.load(os.path.join(directory, fn))
+
+
+def save_name_caches(directory):
+    for fn, normalizer in NAME_CACHE_FILENAMES.values():
+        normalizer.save(os.path.join(directory, fn))
+
+
+# FAERS caseids are numbers. They are parsed to integers when the tables are
+# ingested, so that joins, sorts and groupbys run on native integer keys
+CASEID_DTYPE = "int64"
+
+# The columns (and their types) that the pipeline uses from each FAERS table.
+# The ingest stage keeps only these columns.
+FAERS_TABLE_DTYPES = {
+    "demo": {
+        "primaryid": str,
+        "caseid": CASEID_DTYPE,
+        "caseversion": float,
+        "fda_dt": str,
+        "event_dt_num": str,
+        "age": float,
+        "age_cod": str,
+        "sex": str,
+        "wt": float,
+        "wt_cod": str,
+    },
+    "drug": {"primaryid": str, "caseid": CASEID_DTYPE, "drugname": str},
+    "reac": {"primaryid": str, "caseid": CASEID_DTYPE, "pt": str},
+    "outc": {"primaryid": str, "caseid": CASEID_DTYPE, "outc_cod": str},
+    "ther": {"primaryid": str, "caseid": CASEID_DTYPE, "dur": float, "dur_cod": str},
+}
+
+RAW_EXTENSION = ".csv.zip"
+INGESTED_EXTENSION = ".parquet"
+
+CSV_ENGINES = ("pandas", "pyarrow")
+
+# The quarters as an ordered categorical, with the same categories (every
+# quarter `Quarter` accepts) whatever quarters a table holds
+QUARTER_DTYPE = pd.CategoricalDtype(
+    [f"{year}q{quarter}" for year in range(1901, 2100) for quarter in range(1, 5)],
+    ordered=True,
+)
+# Columns with a fixed set of values. Every table that has them gets these
+# dtypes when it is read, so that the tables of several quarters share the
+# categories and can be concatenated without falling back to strings. Values
+# outside of a set are added to its categories by `categorize`, with a warning.
+CATEGORICAL_DTYPES = {
+    "sex": pd.CategoricalDtype(["F", "M", "NS", "UNK"]),
+    "age_cod": pd.CategoricalDtype(["DEC", "YR", "MON", "WK", "DY", "HR"]),
+    "wt_cod": pd.CategoricalDtype(["KG", "LBS"]),
+    "dur_cod": pd.CategoricalDtype(["YR", "MON", "WK", "DAY", "HR", "MIN", "SEC"]),
+    "outc_cod": pd.CategoricalDtype(["DE", "LT", "HO", "DS", "CA", "RI", "OT"]),
+    "q": QUARTER_DTYPE,
+}
+# String columns with relatively few distinct values. They are read as
+# categoricals: the pyarrow engine dictionary-encodes them as it parses. The
+# categories of drugname and pt are the values of the table that was read.
+CATEGORICAL_COLUMNS = {"drugname", "pt"} | set(CATEGORICAL_DTYPES) - {"q"}
+
+
+def quarter_table_filename(dir_in, table, q):
+    """Path of a quarter's table, preferring the ingested Parquet file"""
+    fn = os.path.join(dir_in, f"{table}{q}{INGESTED_EXTENSION}")
+    if os.path.exists(fn):
+        return fn
+    return os.path.join(dir_in, f"{table}{q}{RAW_EXTENSION}")
+
+
+def resolve_table_filename(fn):
+    """Replace a raw `.csv.zip` path by its ingested Parquet version, if any"""
+    if fn.endswith(RAW_EXTENSION):
+        fn_ingested = fn[: -len(RAW_EXTENSION)] + INGESTED_EXTENSION
+        if os.path.exists(fn_ingested):
+            return fn_ingested
+    return fn
+
+
+def _nulls_as_nan(df):
+    # Arrow returns missing strings as None, make them NaN as read_csv does
+    for c in df.columns[df.dtypes == object]:
+        df[c] = df[c].where(df[c].notna(), np.nan)
+    return df
+
+
+def to_int64(values, name):
+    """`values` as an int64 array, raising ValueError if any is not a number"""
+    values = np.asarray(values)
+    if values.dtype.kind in "iu":
+        return values.astype(np.int64, copy=False)
+    ret = pd.to_numeric(pd.Series(values), errors="coerce")
+    if ret.isna().any():
+        bad = pd.Series(values)[ret.isna().values].head(5).tolist()
+        raise ValueError(f"Non-numeric {name} values, e.g. {bad}")
+    return ret.values.astype(np.int64)
+
+
+def _integers_as_int64(df, dtype):
+    # Integer columns come back as float from Arrow if they have nulls, and
+    # as strings from Parquet files ingested before they were integers
+    if not isinstance(dtype, dict):
+        return df
+    for c, dtype_curr in dtype.items():
+        if dtype_curr in (int, "int", "int64") and c in df.columns:
+            if df[c].dtype != np.int64:
+                df[c] = to_int64(df[c].values, c)
+    return df
+
+
+def quarter_column(q, n):
+    """`n` times quarter `q`, as a `QUARTER_DTYPE` categorical"""
+    codes = np.full(n, QUARTER_DTYPE.categories.get_loc(str(q)), dtype=np.int16)
+    return pd.Categorical.from_codes(codes, dtype=QUARTER_DTYPE)
+
+
+# The values outside of `CATEGORICAL_DTYPES` that were already warned about
+_unknown_categories = set()
+
+
+def _categorical_dtype(values, column):
+    """`CATEGORICAL_DTYPES[column]`, with the categories `values` add to it
+
+    A cast to the fixed dtype would turn the values it does not know into
+    missing values, so they are appended to its categories instead.
+    """
+    dtype = CATEGORICAL_DTYPES[column]
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        present = values.cat.remove_unused_categories().cat.categories
+    else:
+        present = pd.Index(values.dropna().unique())
+    unknown = present[~present.isin(dtype.categories)]
+    if unknown.empty:
+        return dtype
+    new = {(column, v) for v in unknown} - _unknown_categories
+    if new:
+        logger.warning(
+            f"Unknown {column} values {sorted(str(v) for _, v in new)} are kept "
+            f"as extra categories"
+        )
+        _unknown_categories.update(new)
+    return pd.CategoricalDtype(dtype.categories.append(unknown), dtype.ordered)
+
+
+def categorize(df):
+    """Give the `CATEGORICAL_COLUMNS` and `q` of `df` their categorical dtype"""
+    for c in df.columns:
+        if c in CATEGORICAL_DTYPES:
+            if df[c].dtype != CATEGORICAL_DTYPES[c]:
+                df[c] = df[c].astype(_categorical_dtype(df[c], c))
+        elif c in CATEGORICAL_COLUMNS:
+            if not isinstance(df[c].dtype, pd.CategoricalDtype):
+                df[c] = df[c].astype("category")
+    return df
+
+
+def concat_tables(dfs):
+    """`pd.concat` of tables that keeps their categorical columns categorical
+
+    The categories of a column that differ between the tables, e.g. the drug
+    names of two quarters, are merged first.
+    """
+    dfs = [df for df in dfs if df is not None]
+    for c in dfs[0].columns if dfs else []:
+        dtypes = [df[c].dtype for df in dfs if c in df.columns]
+        if all(isinstance(dt, pd.CategoricalDtype) for dt in dtypes) and any(
+            dt != dtypes[0] for dt in dtypes
+        ):
+            categories = pd.Index(np.concatenate([dt.categories for dt in dtypes]))
+            dtype = pd.CategoricalDtype(categories.unique())
+            dfs = [df.astype({c: dtype}) if c in df.columns else df for df in dfs]
+    return pd.concat(dfs)
+
+
+def _with_schema(df, dtype):
+    return categorize(_integers_as_int64(df, dtype))
+
+
+def _arrow_type(column, dtype):
+    if dtype in (float, "float", "float64"):
+        return pa.float64()
+    if dtype in (int, "int", "int64"):
+        return pa.int64()
+    if dtype in (bool, "bool"):
+        return pa.bool_()
+    if column in CATEGORICAL_COLUMNS:
+        return pa.dictionary(pa.int32(), pa.string())
+    return pa.string()
+
+
+@contextmanager
+def _open_csv_stream(fn):
+    """Open a CSV file, or the single CSV member of a zip archive, for reading"""
+    if not fn.endswith(".zip"):
+        with open(fn, "rb") as fh:
+            yield fh
+        return
+    with zipfile.ZipFile(fn) as zf:
+        members = [m for m in zf.namelist() if m.lower().endswith(".csv")]
+        if len(members) != 1:
+            raise ValueError(f"{fn}: expected a single CSV member, found {members}")
+        with zf.open(members[0]) as fh:
+            yield fh
+
+
+def _arrow_csv_options(columns, dtype, block_size):
+    if columns is not None:
+        columns = list(columns)
+        names = columns
+    elif isinstance(dtype, dict):
+        names = list(dtype)
+    else:
+        names = []
+    column_types = {}
+    for c in names:
+        dtype_curr = dtype.get(c, str) if isinstance(dtype, dict) else dtype
+        if dtype_curr is not None:
+            column_types[c] = _arrow_type(c, dtype_curr)
+    read_options = pa_csv.ReadOptions(use_threads=True, block_size=block_size)
+    parse_options = pa_csv.ParseOptions(newlines_in_values=True)
+    convert_options = pa_csv.ConvertOptions(
+        include_columns=columns, column_types=column_types, strings_can_be_null=True
+    )
+    return read_options, parse_options, convert_options
+
+
+def read_csv_arrow(fn, columns=None, dtype=None, nrows=None, block_size=16 << 20):
+    """Parse a (zipped) CSV file with the multithreaded Arrow CSV parser
+
+    The file is parsed straight from the zip member stream, in blocks of
+    `block_size` bytes that are converted in parallel.
+    """
+    if columns is not None:
+        columns = list(columns)
+    read_options, parse_options, convert_options = _arrow_csv_options(
+        columns, dtype, block_size
+    )
+    with _open_csv_stream(fn) as fh:
+        if nrows is None:
+            table = pa_csv.read_csv(
+                fh,
+                read_options=read_options,
+                parse_options=parse_options,
+                convert_options=convert_options,
+            )
+        else:
+            reader = pa_csv.open_csv(
+                fh,
+                read_options=read_options,
+                parse_options=parse_options,
+                convert_options=convert_options,
+            )
+            batches = []
+            n_read = 0
+            for batch in reader:
+                batches.append(batch)
+                n_read += batch.num_rows
+                if n_read >= nrows:
+                    break
+            table = pa.Table.from_batches(batches, schema=reader.schema)
+            table = table.slice(0, nrows)
+    return _nulls_as_nan(table.to_pandas())
+
+
+def read_table(fn, columns=None, dtype=None, nrows=None, engine="pandas", **kwargs):
+    """Read a FAERS table either from the Parquet cache or from the raw CSV
+
+    Only `columns` are read. Parquet files are already typed, so `dtype` and
+    `engine` are only used for the CSV files, except that the integer columns
+    of `dtype` are always returned as int64, and the columns in
+    `CATEGORICAL_COLUMNS` as categoricals. With `engine="pyarrow"`, the CSV
+    is parsed by the multithreaded Arrow parser.
+    """
+    fn = resolve_table_filename(fn)
+    if fn.endswith(INGESTED_EXTENSION):
+        ret = pd.read_parquet(fn, columns=None if columns is None else list(columns))
+        if nrows is not None:
+            ret = ret.head(nrows)
+        return _with_schema(_nulls_as_nan(ret), dtype)
+    if columns is not None:
+        columns = list(columns)
+    if engine == "pyarrow":
+        if kwargs:
+            raise ValueError(
+                f"The pyarrow engine does not support {', '.join(kwargs)} arguments"
+            )
+        ret = read_csv_arrow(fn, columns=columns, dtype=dtype, nrows=nrows)
+        return _with_schema(ret, dtype)
+    elif engine != "pandas":
+        raise ValueError(f"Unknown CSV engine {engine}, expected one of {CSV_ENGINES}")
+    ret = pd.read_csv(fn, dtype=dtype, usecols=columns, nrows=nrows, **kwargs)
+    return _with_schema(ret, dtype)
+
+
+# N of rows `chunk_rows` measures the size of a table's rows on
+CHUNK_SAMPLE_ROWS = 1 << 14
+
+
+def iter_table_chunks(fn, columns=None, dtype=None, chunksize=1 << 20, engine="pandas"):
+    """Read a FAERS table like `read_table`, in chunks of about `chunksize` rows"""
+    fn = resolve_table_filename(fn)
+    if columns is not None:
+        columns = list(columns)
+    if fn.endswith(INGESTED_EXTENSION):
+        for batch in pa_parquet.ParquetFile(fn).iter_batches(
+            batch_size=chunksize, columns=columns
+        ):
+            yield _with_schema(_nulls_as_nan(batch.to_pandas()), dtype)
+    elif engine == "pyarrow":
+        # Roughly `chunksize` rows of a few short columns per block
+        block_size = max(chunksize * 32, 1 << 20)
+        read_options, parse_options, convert_options = _arrow_csv_options(
+            columns, dtype, block_size
+        )
+        with _open_csv_stream(fn) as fh:
+            reader = pa_csv.open_csv(
+                fh,
+                read_options=read_options,
+                parse_options=parse_options,
+                convert_options=convert_options,
+            )
+            for batch in reader:
+                yield _with_schema(_nulls_as_nan(batch.to_pandas()), dtype)
+    elif engine == "pandas":
+        for chunk in pd.read_csv(fn, dtype=dtype, usecols=columns, chunksize=chunksize):
+            yield _with_schema(chunk, dtype)
+    else:
+        raise ValueError(f"Unknown CSV engine {engine}, expected one of {CSV_ENGINES}")
+
+
+def chunk_rows(
+    fn, columns=None, dtype=None, max_bytes=0, chunksize=1 << 20, engine="pandas"
+):
+    """`chunksize`, or fewer rows if `chunksize` rows of `fn` take more than
+    `max_bytes` in memory
+
+    The bytes per row are measured on the first chunk of `CHUNK_SAMPLE_ROWS`
+    rows, as pandas holds them. 0 or None sets no limit.
+    """
+    if not max_bytes:
+        return chunksize
+    chunks = iter_table_chunks(
+        fn, columns=columns, dtype=dtype, chunksize=CHUNK_SAMPLE_ROWS, engine=engine
+    )
+    try:
+        sample = next(chunks, None)
+    finally:
+        chunks.close()
+    if sample is None or sample.empty:
+        return chunksize
+    bytes_per_row = sample.memory_usage(deep=True).sum() / len(sample)
+    return max(1, min(chunksize, int(max_bytes / bytes_per_row)))
+
+
+def write_table(df, fn, compression="zstd"):
+    """Save a FAERS table to Parquet, atomically"""
+    fn_tmp = fn + ".part"
+    df.to_parquet(fn_tmp, compression=compression, index=False)
+    os.replace(fn_tmp, fn)
+
+
+def is_up_to_date(fn_out, fns_in):
+    """Whether `fn_out` exists and is not older than any of `fns_in`"""
+    if not os.path.exists(fn_out):
+        return False
+    mtime = os.path.getmtime(fn_out)
+    return all(os.path.getmtime(fn) <= mtime for fn in fns_in)
+
+
+def limit_memory(max_bytes):
+    """Make allocations beyond `max_bytes` of address space raise MemoryError
+
+    Meant as a `Pool` initializer, so that a worker that grows too large
+    fails instead of bringing the node down. 0 or None sets no limit.
+
+    The limit (RLIMIT_AS) is a ceiling on virtual memory, not on resident
+    memory: the memory maps, thread stacks and allocator arenas of the
+    process count against it even when they are not resident. It must be set
+    with headroom above the memory the process is expected to use.
+    """
+    if not max_bytes:
+        return
+    import resource
+
+    _, hard = resource.getrlimit(resource.RLIMIT_AS)
+    if hard != resource.RLIM_INFINITY:
+        max_bytes = min(max_bytes, hard)
+    resource.setrlimit(resource.RLIMIT_AS, (max_bytes, hard))
+
+
 def read_demo_data(fn_demo, **kwargs):
     dtypes = {
-        "caseid": str,
+        "caseid": CASEID_DTYPE,
         "event_dt_num": str,
         "age": float,
         "age_cod": str,
@@ -292,7 +770,7 @@ def read_demo_data(fn_demo, **kwargs):
         "wt": float,
         "wt_cod": str,
     }
-    df_demo = pd.read_csv(fn_demo, dtype=dtypes, usecols=dtypes.keys(), **kwargs)
+    df_demo = read_table(fn_demo, columns=dtypes.keys(), dtype=dtypes, **kwargs)
 
     to_year_conversion_factor = {
         "YR": 1.0,
@@ -320,8 +798,8 @@ def read_demo_data(fn_demo, **kwargs):
 
 
 def read_therapy_data(fn_therapy, **kwargs):
-    dtypes = {"caseid": str, "dur": float, "dur_cod": str}
-    df_therapy = pd.read_csv(fn_therapy, dtype=dtypes, usecols=dtypes.keys(), **kwargs)
+    dtypes = {"caseid": CASEID_DTYPE, "dur": float, "dur_cod": str}
+    df_therapy = read_table(fn_therapy, columns=dtypes.keys(), dtype=dtypes, **kwargs)
     to_day_conversion_factor = {
         "MON": 30.5,
         "YR": 365.25,
@@ -0,0 +1,169 @@
+import csv
+import glob
+import io
+import json
+import logging
+import os
+import zipfile
+from multiprocessing import Pool
+
+import defopt
+import tqdm
+
+logger = logging.getLogger("FAERS")
+
+MANIFEST_FILENAME = "_verification.json"
+# Written only once every archive passed verification
+SUCCESS_FILENAME = "_verified"
+
+
+def verify_archive(fn, chunk_size=1 << 20):
+    """Check the zip structure and CRC of a downloaded FAERS archive
+
+    Reading a zip member to its end makes `zipfile` compare the CRC of the
+    decompressed data with the one stored in the archive. The number of rows
+    is the number of CSV records minus the header: quoted fields may contain
+    line breaks, so it can be smaller than the number of lines.
+    """
+    st = os.stat(fn)
+    ret = {
+        "path": fn,
+        "size": st.st_size,
+        "mtime": st.st_mtime,
+        "members": [],
+        "crc": None,
+        "n_rows": None,
+        "ok": False,
+        "error": None,
+    }
+    try:
+        with zipfile.ZipFile(fn) as zf:
+            members = zf.infolist()
+            ret["members"] = [m.filename for m in members]
+            csv_members = [m for m in members if m.filename.lower().endswith(".csv")]
+            if len(csv_members) != 1:
+                raise zipfile.BadZipFile(
+                    f"Expected a single CSV member, found {ret['members']}"
+                )
+            member = csv_members[0]
+            n_records = 0
+            with zf.open(member) as fh:
+                text = io.TextIOWrapper(
+                    io.BufferedReader(fh, buffer_size=chunk_size),
+                    encoding="utf-8",
+                    errors="replace",
+                    newline="",
+                )
+                for row in csv.reader(text):
+                    n_records += bool(row)
+            ret["crc"] = f"{member.CRC:08x}"
+            ret["n_rows"] = max(n_records - 1, 0)
+            ret["ok"] = True
+    except (zipfile.BadZipFile, EOFError, OSError, ValueError) as err:
+        ret["error"] = f"{type(err).__name__}: {err}"
+    return ret
+
+
+def load_manifest(dir_in):
+    fn = os.path.join(dir_in, MANIFEST_FILENAME)
+    if not os.path.exists(fn):
+        return {}
+    with open(fn) as fh:
+        return json.load(fh)
+
+
+def save_manifest(dir_in, manifest):
+    fn = os.path.join(dir_in, MANIFEST_FILENAME)
+    with open(fn + ".part", "w") as fh:
+        json.dump(manifest, fh, indent=1, sort_keys=True)
+    os.replace(fn + ".part", fn)
+
+
+def is_up_to_date(record, fn):
+    if record is None:
+        return False
+    st = os.stat(fn)
+    return (record["size"] == st.st_size) and (record["mtime"] == st.st_mtime)
+
+
+def verify_if_changed(fn, manifest):
+    """Verify `fn` unless its record in `manifest` is up to date
+
+    Returns the record, which is also stored in `manifest`.
+    """
+    key = os.path.basename(fn)
+    record = manifest.get(key)
+    if not is_up_to_date(record, fn):
+        record = verify_archive(fn)
+        manifest[key] = record
+    return record
+
+
+def is_verified(dir_in, manifest):
+    """Whether every archive in `dir_in` has an up to date, passing record"""
+    for fn in glob.glob(os.path.join(dir_in, "*.csv.zip")):
+        record = manifest.get(os.path.basename(fn))
+        if not (is_up_to_date(record, fn) and record["ok"]):
+            return False
+    return True
+
+
+def write_success_file(dir_in, manifest):
+    with open(os.path.join(dir_in, SUCCESS_FILENAME), "w") as fh:
+        fh.write(f"{len(manifest)} archives verified\n")
+
+
+def main(*, dir_in, threads=4, remove_corrupt=False):
+    """
+
+    :param str dir_in:
+        Directory with the downloaded archives
+    :param int threads:
+        N of parallel processes
+    :param bool remove_corrupt:
+        Delete the archives that fail verification, so that the next download
+        run fetches them again
+
+    :return: the verification manifest, {file name: record}
+
+    """
+    assert os.path.isdir(dir_in)
+    fn_success = os.path.join(dir_in, SUCCESS_FILENAME)
+    if os.path.exists(fn_success):
+        os.remove(fn_success)
+    files = sorted(glob.glob(os.path.join(dir_in, "*.csv.zip")))
+    manifest = load_manifest(dir_in)
+    # Forget about files that are no longer there
+    manifest = {
+        k: v for k, v in manifest.items() if os.path.exists(os.path.join(dir_in, k))
+    }
+    to_verify = [
+        fn for fn in files if not is_up_to_date(manifest.get(os.path.basename(fn)), fn)
+    ]
+    logger.info(
+        f"Verifying {len(to_verify)} of {len(files)} archives, the rest are unchanged"
+    )
+    if to_verify:
+        with Pool(threads) as pool:
+            for record in tqdm.tqdm(
+                pool.imap_unordered(verify_archive, to_verify), total=len(to_verify)
+            ):
+                manifest[os.path.basename(record["path"])] = record
+        save_manifest(dir_in, manifest)
+
+    corrupt = sorted(k for k, v in manifest.items() if not v["ok"])
+    if corrupt:
+        for k in corrupt:
+            logger.error(f"Corrupt archive {k}: {manifest[k]['error']}")
+            if remove_corrupt:
+                os.remove(os.path.join(dir_in, k))
+                del manifest[k]
+        if remove_corrupt:
+            save_manifest(dir_in, manifest)
+        raise RuntimeError(f"{len(corrupt)} corrupt archive(s): {', '.join(corrupt)}")
+    write_success_file(dir_in, manifest)
+    return manifest
+
+
+if __name__ == "__main__":
+    defopt.run(main)
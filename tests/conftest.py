@@ -0,0 +1,114 @@
+import json
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+# The modules are imported as `src.<module>`, as in pipeline.py
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src import utils  # noqa: E402
+from src.utils import QuestionConfig  # noqa: E402
+
+QUARTERS = ["2020q1", "2020q2", "2020q3", "2020q4"]
+# Spelled the way FAERS reports them, so that the names are normalized
+DRUGS = ["Aspirin", "aspirin.", "SAXENDA", "Metformin", "ibuprofen", "paracetamol"]
+REACTIONS = ["Nausea", "tachycardia", "Rash", "headache", "fatigue"]
+
+
+def synthetic_quarter(rng, q, caseids, versions):
+    """The ingested demo, drug, reac and outc tables of quarter `q`
+
+    Each case has a single version in the quarter, as after deduplication.
+    """
+    n = len(caseids)
+    primaryids = [f"{c}{v:02d}" for c, v in zip(caseids, versions)]
+    month = 3 * (int(q[-1]) - 1) + 1
+    event_dt = rng.choice(["20191231", "201911", "2019", None], size=n)
+    demo = pd.DataFrame(
+        {
+            "primaryid": primaryids,
+            "caseid": np.asarray(caseids, dtype=np.int64),
+            "caseversion": np.asarray(versions, dtype=float),
+            "fda_dt": [f"{q[:4]}{month:02d}{d:02d}" for d in rng.integers(1, 28, n)],
+            "event_dt_num": event_dt,
+            "age": rng.integers(1, 90, n).astype(float),
+            "age_cod": rng.choice(["YR", "MON", None], size=n),
+            "sex": rng.choice(["F", "M", None], size=n),
+            "wt": rng.integers(40, 120, n).astype(float),
+            "wt_cod": rng.choice(["KG", "LBS"], size=n),
+        }
+    )
+
+    def rows(names, max_per_case, column):
+        n_rows = rng.integers(0, max_per_case + 1, n)
+        return pd.DataFrame(
+            {
+                "primaryid": np.repeat(primaryids, n_rows),
+                "caseid": np.repeat(demo.caseid.values, n_rows),
+                column: rng.choice(names, size=n_rows.sum()),
+            }
+        )
+
+    drug = rows(DRUGS + [None], 3, "drugname")
+    reac = rows(REACTIONS, 2, "pt")
+    outc = rows(["DE", "HO", "OT"], 1, "outc_cod")
+    return {"demo": demo, "drug": drug, "reac": reac, "outc": outc}
+
+
+def write_synthetic_quarters(dir_in, quarters=QUARTERS, n_new=60, seed=0):
+    """Save small FAERS quarters to `dir_in`, as the ingest stage would
+
+    Every quarter reports `n_new` new cases, and new versions of some cases
+    of the earlier quarters.
+    """
+    rng = np.random.default_rng(seed)
+    os.makedirs(dir_in, exist_ok=True)
+    versions = {}
+    for i, q in enumerate(quarters):
+        new = list(range(1000 + i * n_new, 1000 + (i + 1) * n_new))
+        earlier = sorted(versions)
+        followed_up = list(rng.choice(earlier, size=len(earlier) // 3, replace=False))
+        caseids = sorted(new + [int(c) for c in followed_up])
+        for c in caseids:
+            versions[c] = versions.get(c, 0) + 1
+        tables = synthetic_quarter(rng, q, caseids, [versions[c] for c in caseids])
+        for table, df in tables.items():
+            fn = os.path.join(dir_in, f"{table}{q}{utils.INGESTED_EXTENSION}")
+            utils.write_table(df, fn)
+
+
+@pytest.fixture(scope="session")
+def faers_dir(tmp_path_factory):
+    """Ingested synthetic quarters. Tests must not write to this directory"""
+    ret = str(tmp_path_factory.mktemp("faers_ingested"))
+    write_synthetic_quarters(ret)
+    return ret
+
+
+@pytest.fixture
+def config_items():
+    return [
+        QuestionConfig(
+            "a",
+            drugs=["aspirin", "saxenda"],
+            reactions=["nausea", "tachycardia"],
+            control=["metformin"],
+        ),
+        QuestionConfig("b", drugs=["ibuprofen"], reactions=["rash"], control=None),
+    ]
+
+
+@pytest.fixture
+def config_dir(tmp_path, config_items):
+    ret = tmp_path / "config"
+    ret.mkdir()
+    for config in config_items:
+        content = {"drug": config.drugs, "reaction": config.reactions}
+        if config.control is not None:
+            content["control"] = config.control
+        with open(ret / f"{config.name}.json", "w") as fh:
+            json.dump(content, fh)
+    return str(ret)
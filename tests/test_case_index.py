@@ -0,0 +1,77 @@
+import os
+
+import numpy as np
+
+from src import case_index, utils
+from src.case_index import CaseIndex
+
+
+def test_update_keeps_latest_quarter():
+    index = CaseIndex()
+    index.update("2020q1", [3, 1, 2], [31, 11, 21], version=1.0)
+    index.update("2020q2", [2, 4], [22, 41], version=2.0)
+    assert list(index.entries["caseid"]) == [1, 2, 3, 4]
+    assert index.latest_quarter([2, 1, 5]) == ["2020q2", "2020q1", None]
+    assert list(index.is_latest([2, 2, 5], [21, 22, 51])) == [False, True, True]
+    assert list(index.is_latest_quarter([1, 2, 5], "2020q1")) == [True, False, True]
+    assert index.quarters == {"2020q1": 1.0, "2020q2": 2.0}
+
+
+def test_update_out_of_order():
+    """An earlier quarter added later does not hide the later versions"""
+    index = CaseIndex()
+    index.update("2020q2", [2, 4], [22, 41])
+    index.update("2020q1", [1, 2], [11, 21])
+    assert index.latest_quarter([1, 2, 4]) == ["2020q1", "2020q2", "2020q2"]
+    assert list(index.entries["primaryid"]) == [11, 22, 41]
+
+
+def test_update_replaces_the_entries_of_a_quarter():
+    index = CaseIndex()
+    index.update("2020q1", [1, 2], [11, 21])
+    index.update("2020q2", [2], [22])
+    index.update("2020q2", [2, 3], [23, 31], version=3.0)
+    assert list(index.entries["primaryid"]) == [11, 23, 31]
+    assert index.quarters["2020q2"] == 3.0
+
+
+def test_save_and_load(tmp_path):
+    fn = str(tmp_path / case_index.INDEX_FILENAME)
+    index = CaseIndex()
+    index.update("2020q1", [2, 1], [21, 11], version=1.5)
+    index.save(fn)
+    loaded = CaseIndex.load(fn)
+    assert isinstance(loaded.entries, np.memmap)
+    np.testing.assert_array_equal(loaded.entries, index.entries)
+    assert loaded.quarters == index.quarters
+
+
+def test_update_index(tmp_path, faers_dir):
+    fn = str(tmp_path / case_index.INDEX_FILENAME)
+    index = case_index.update_index(fn, faers_dir)
+    assert sorted(index.quarters) == ["2020q1", "2020q2", "2020q3", "2020q4"]
+    df_last = utils.read_table(
+        os.path.join(faers_dir, "demo2020q4.parquet"), columns=["caseid", "primaryid"]
+    )
+    assert index.is_latest(df_last.caseid.values, df_last.primaryid.values).all()
+    # Restricting the index to earlier quarters rebuilds it, so that the
+    # cases keep their latest version within these quarters
+    index = case_index.update_index(fn, faers_dir, ["2020q1", "2020q2"])
+    assert sorted(index.quarters) == ["2020q1", "2020q2"]
+    df_q2 = utils.read_table(
+        os.path.join(faers_dir, "demo2020q2.parquet"), columns=["caseid", "primaryid"]
+    )
+    assert index.is_latest(df_q2.caseid.values, df_q2.primaryid.values).all()
+
+
+def test_changed_cases():
+    before = CaseIndex()
+    before.update("2020q1", [1, 2, 3], [11, 21, 31])
+    after = CaseIndex(before.entries.copy(), before.quarters)
+    after.update("2020q2", [2, 4], [22, 41])
+    caseids, quarters_before, quarters_after = case_index.changed_cases(before, after)
+    q1, q2 = utils.Quarter("2020q1").ordinal(), utils.Quarter("2020q2").ordinal()
+    assert list(caseids) == [2, 4]
+    assert list(quarters_before) == [q1, -1]
+    assert list(quarters_after) == [q2, q2]
+    assert len(case_index.changed_cases(after, after)[0]) == 0
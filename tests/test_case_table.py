@@ -0,0 +1,28 @@
+import numpy as np
+import pandas as pd
+
+from src.case_table import CaseTable
+
+
+def test_frame_selects_rows_by_ordinal(tmp_path):
+    df = pd.DataFrame(
+        {
+            "age": [30.0, np.nan, 55.0, 71.0],
+            "sex": pd.Categorical(["F", "M", None, "F"]),
+            "event_date": ["20190315", "201902", None, "2018"],
+            "q": pd.Categorical(["2020q1", "2020q1", "2020q2", "2020q3"]),
+        },
+        index=pd.Index([11, 12, 13, 14], name="caseid"),
+    )
+    CaseTable.from_frame(df).save(str(tmp_path))
+    table = CaseTable.load(str(tmp_path))
+    full = table.frame()
+    assert full.event_date.tolist()[:2] == [
+        pd.Timestamp("2019-03-15"),
+        pd.Timestamp("2019-02-01"),
+    ]
+    ordinals = np.array([3, 0, 2])
+    pd.testing.assert_frame_equal(table.frame(ordinals), full.iloc[ordinals])
+    pd.testing.assert_frame_equal(
+        table.frame(ordinals, columns=["sex"]), full.iloc[ordinals][["sex"]]
+    )
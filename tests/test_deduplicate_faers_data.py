@@ -0,0 +1,48 @@
+import pandas as pd
+
+from src import deduplicate_faers_data
+
+
+def test_latest_case_versions_tie_breaking():
+    df_demo = pd.DataFrame(
+        {
+            "caseid": ["1", "1", "2", "2", "3", "3", "3", "4"],
+            "caseversion": ["9", "10", "2", "2", "1", "1", "1", None],
+            "fda_dt": [
+                "20200105",
+                "20200101",
+                "20200101",
+                "20200301",
+                "20200201",
+                "20200201",
+                "20200101",
+                "20200101",
+            ],
+            "primaryid": ["19", "110", "22", "21", "399", "3100", "3101", "41"],
+        }
+    )
+    # 1: caseversion 10 beats 9, whatever the receipt date
+    # 2: same caseversion, the latest receipt date wins
+    # 3: same caseversion and receipt date, the highest primaryid wins
+    # 4: a single version is kept even without a caseversion
+    assert deduplicate_faers_data.latest_case_versions(df_demo) == {
+        "110",
+        "21",
+        "3100",
+        "41",
+    }
+
+
+def test_latest_case_versions_does_not_depend_on_row_order():
+    df_demo = pd.DataFrame(
+        {
+            "caseid": ["5", "5", "5"],
+            "caseversion": ["1", "2", "2"],
+            "fda_dt": ["20200101", "20200101", "20200101"],
+            "primaryid": ["52", "51", "53"],
+        }
+    )
+    expected = deduplicate_faers_data.latest_case_versions(df_demo)
+    assert expected == {"53"}
+    shuffled = df_demo.iloc[[2, 0, 1]]
+    assert deduplicate_faers_data.latest_case_versions(shuffled) == expected
@@ -0,0 +1,148 @@
+import asyncio
+import os
+import threading
+
+import pytest
+from aiohttp import web
+
+from src import download_faers_data
+
+
+class Mirror:
+    """A local FAERS mirror serving a single body for every path"""
+
+    def __init__(self, body=b"A" * 1000, etag='"v1"'):
+        self.body = body
+        self.etag = etag
+        self.status = None
+        self.requests = []
+
+    async def handle(self, request):
+        self.requests.append(dict(request.headers))
+        if self.status is not None:
+            return web.Response(status=self.status)
+        rng = request.headers.get("Range")
+        if rng and request.headers.get("If-Range") in (None, self.etag):
+            start = int(rng.split("=")[1].rstrip("-"))
+            return web.Response(
+                status=206,
+                body=self.body[start:],
+                headers={
+                    "ETag": self.etag,
+                    "Content-Range": f"bytes {start}-{len(self.body) - 1}/{len(self.body)}",
+                },
+            )
+        return web.Response(body=self.body, headers={"ETag": self.etag})
+
+
+@pytest.fixture
+def mirror():
+    """Serve a `Mirror` from a background thread, so that the code under test
+    can run its own event loop"""
+    ret = Mirror()
+    loop = asyncio.new_event_loop()
+    app = web.Application()
+    app.router.add_get("/{path:.*}", ret.handle)
+    runner = web.AppRunner(app)
+    loop.run_until_complete(runner.setup())
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    loop.run_until_complete(site.start())
+    port = site._server.sockets[0].getsockname()[1]
+    ret.base_url = f"http://127.0.0.1:{port}"
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    yield ret
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join()
+    loop.run_until_complete(runner.cleanup())
+    loop.close()
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    async def sleep(_):
+        pass
+
+    monkeypatch.setattr(download_faers_data.asyncio, "sleep", sleep)
+
+
+def download(mirror, dir_out, name="x.csv.zip", **kwargs):
+    url = f"{mirror.base_url}/{name}"
+    return asyncio.run(
+        download_faers_data.download_urls_async(
+            [url], str(dir_out), progress=False, **kwargs
+        )
+    )
+
+
+def write_part(dir_out, body, validator, name="x.csv.zip"):
+    fn_part = os.path.join(dir_out, name + download_faers_data.PART_SUFFIX)
+    with open(fn_part, "wb") as fh:
+        fh.write(body)
+    if validator is not None:
+        with open(fn_part + download_faers_data.VALIDATOR_SUFFIX, "w") as fh:
+            fh.write(validator)
+
+
+def read(dir_out, name="x.csv.zip"):
+    with open(os.path.join(dir_out, name), "rb") as fh:
+        return fh.read()
+
+
+def test_resume_same_revision(mirror, tmp_path):
+    write_part(tmp_path, mirror.body[:400], mirror.etag)
+    downloaded, failed = download(mirror, tmp_path)
+    assert not failed and len(downloaded) == 1
+    assert read(tmp_path) == mirror.body
+    assert mirror.requests[0]["Range"] == "bytes=400-"
+    assert mirror.requests[0]["If-Range"] == mirror.etag
+    assert os.listdir(tmp_path) == ["x.csv.zip"]
+
+
+def test_resume_changed_revision_starts_over(mirror, tmp_path):
+    write_part(tmp_path, mirror.body[:400], mirror.etag)
+    mirror.body, mirror.etag = b"B" * 1000, '"v2"'
+    download(mirror, tmp_path)
+    assert read(tmp_path) == mirror.body
+
+
+def test_part_without_validator_starts_over(mirror, tmp_path):
+    write_part(tmp_path, b"C" * 400, None)
+    download(mirror, tmp_path)
+    assert read(tmp_path) == mirror.body
+    assert "Range" not in mirror.requests[0]
+
+
+def test_refresh_unchanged(mirror, tmp_path):
+    downloaded, _ = download(mirror, tmp_path)
+    mirror.requests.clear()
+    mirror.status = 304
+    downloaded, failed = download(mirror, tmp_path, refresh=True, manifest=downloaded)
+    assert downloaded == {} and failed == {}
+    assert mirror.requests[0]["If-None-Match"] == '"v1"'
+
+
+def test_client_errors_are_not_retried(mirror, tmp_path):
+    mirror.status = 404
+    downloaded, failed = download(mirror, tmp_path, retries=3)
+    assert downloaded == {} and len(failed) == 1
+    assert len(mirror.requests) == 1
+
+
+def test_server_errors_are_retried(mirror, tmp_path):
+    mirror.status = 503
+    _, failed = download(mirror, tmp_path, retries=3)
+    assert len(failed) == 1
+    assert len(mirror.requests) == 3
+
+
+def test_main_fails_on_missing_files(mirror, tmp_path):
+    mirror.status = 404
+    with pytest.raises(RuntimeError, match="Failed to download 5 file"):
+        download_faers_data.main(
+            year_q_from="2020q1",
+            year_q_to="2020q2",
+            dir_out=str(tmp_path),
+            base_url=mirror.base_url,
+            clean_on_failure=False,
+        )
@@ -0,0 +1,203 @@
+import logging
+import os
+import pickle
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from src import case_index, mark_data, marked_store, utils
+
+
+def marked_rows(seed=0, n_cases=40):
+    """Rows as `merge_marks` gives them: several per case, sorted by caseid and q"""
+    rng = np.random.default_rng(seed)
+    n = 3 * n_cases
+    df = pd.DataFrame(
+        {
+            "caseid": np.sort(rng.integers(0, n_cases, n)),
+            "age": rng.choice([np.nan, 30.0, 40.0], size=n),
+            "sex": pd.Categorical(rng.choice(["F", "M", None], size=n)),
+            "q": utils.quarter_column("2020q1", n),
+            "exposed a": rng.random(n) < 0.3,
+            "reacted a": rng.random(n) < 0.3,
+        }
+    )
+    df["q"] = pd.Categorical.from_codes(
+        df.q.cat.codes + df.groupby("caseid").cumcount().values.astype(np.int16),
+        dtype=utils.QUARTER_DTYPE,
+    )
+    return df
+
+
+def test_resolve_duplicates_matches_groupby_apply():
+    df = marked_rows()
+    cols_boolean = ["exposed a", "reacted a"]
+    cols_rest = ["caseid", "age", "sex"]
+    df = df.loc[df.caseid.duplicated(keep=False)]
+    # The implementation `resolve_duplicates` replaced
+    expected = df.groupby("caseid").apply(
+        lambda d: mark_data.handle_duplicates_within_case(d, cols_boolean, cols_rest)
+    )
+    actual = mark_data.resolve_duplicates(df, cols_boolean, cols_rest)
+    columns = cols_rest + ["q"] + cols_boolean
+    expected = expected[columns].reset_index(drop=True)
+    actual = actual[columns].reset_index(drop=True)
+    pd.testing.assert_frame_equal(actual.astype(object), expected.astype(object))
+
+
+def test_handle_duplicates_keeps_first_quarter_and_last_values():
+    df = pd.DataFrame(
+        {
+            "caseid": [1, 1, 2],
+            "age": [30.0, np.nan, 50.0],
+            "q": pd.Categorical(
+                ["2020q1", "2020q2", "2020q1"], dtype=utils.QUARTER_DTYPE
+            ),
+            "exposed a": [True, False, False],
+        }
+    )
+    ret = mark_data.handle_duplicates(df)
+    assert ret.loc[1, "q"] == "2020q1"
+    assert np.isnan(ret.loc[1, "age"])
+    assert ret.loc[1, "exposed a"]
+    assert ret.loc[2, "age"] == 50.0
+
+
+def mark_quarter(dir_out, q, faers_dir, config_items, fn_case_index=None, **kwargs):
+    drug_names, reaction_types = mark_data.config_terms(config_items)
+    os.makedirs(dir_out, exist_ok=True)
+    mark_data.process_quarter_wrapper(
+        q,
+        faers_dir,
+        dir_out,
+        config_items,
+        drug_names,
+        reaction_types,
+        fn_case_index=fn_case_index,
+        **kwargs,
+    )
+    with open(os.path.join(dir_out, f"{q}.pkl"), "rb") as fh:
+        return pickle.load(fh)
+
+
+ENGINES = {
+    "dense_filtered": dict(marking_engine="dense", filtered_read=True, chunksize=17),
+    "sparse": dict(marking_engine="sparse"),
+    "chunked": dict(marking_engine="chunked", chunksize=17),
+    # Chunks of a few rows, bounded by the memory budget
+    "chunked_budget": dict(marking_engine="chunked", max_bytes=1 << 15),
+    "sharded": dict(marking_engine="dense", shards=3),
+    "sharded_sparse": dict(marking_engine="sparse", shards=2),
+}
+
+
+@pytest.mark.parametrize("with_index", [False, True])
+@pytest.mark.parametrize("engine", sorted(ENGINES))
+def test_marking_engines_match_dense(
+    tmp_path, faers_dir, config_items, engine, with_index
+):
+    fn_case_index = None
+    if with_index:
+        fn_case_index = str(tmp_path / case_index.INDEX_FILENAME)
+        case_index.update_index(fn_case_index, faers_dir)
+    expected = mark_quarter(
+        str(tmp_path / "dense"),
+        "2020q2",
+        faers_dir,
+        config_items,
+        fn_case_index=fn_case_index,
+    )
+    actual = mark_quarter(
+        str(tmp_path / engine),
+        "2020q2",
+        faers_dir,
+        config_items,
+        fn_case_index=fn_case_index,
+        **ENGINES[engine],
+    )
+    assert len(expected) > 0
+    pd.testing.assert_frame_equal(actual, expected)
+
+
+def write_clusters(fn, faers_dir):
+    """Clusters of a case of each quarter with a case of the next one"""
+    caseids = [
+        utils.read_table(
+            os.path.join(faers_dir, f"demo{q}.parquet"), columns=["caseid"]
+        ).caseid.max()
+        for q in ["2020q1", "2020q2", "2020q3"]
+    ]
+    utils.write_table(
+        pd.DataFrame({"caseid": caseids, "cluster": [caseids[0]] * len(caseids)}),
+        fn,
+    )
+    return fn
+
+
+def read_store(dir_out):
+    quarters = marked_store.stored_quarters(dir_out)
+    return {q: marked_store.read_quarter(dir_out, q) for q in quarters}
+
+
+@pytest.mark.parametrize("inputs", ["none", "index", "index_and_clusters"])
+def test_append_matches_full_merge(tmp_path, faers_dir, config_dir, caplog, inputs):
+    caplog.set_level(logging.INFO, logger="FAERS")
+    kwargs = dict(dir_in=faers_dir, config_dir=config_dir, threads=2)
+    if inputs != "none":
+        kwargs["fn_case_index"] = os.path.join(faers_dir, case_index.INDEX_FILENAME)
+    if inputs == "index_and_clusters":
+        kwargs["fn_duplicate_clusters"] = write_clusters(
+            str(tmp_path / "clusters.parquet"), faers_dir
+        )
+    dir_appended = str(tmp_path / "appended")
+    for year_q_to in ["2020q3", "2020q4", "2021q1"]:
+        mark_data.main(
+            year_q_from="2020q1",
+            year_q_to=year_q_to,
+            dir_out=dir_appended,
+            append=True,
+            **kwargs,
+        )
+    dir_rebuilt = str(tmp_path / "rebuilt")
+    mark_data.main(
+        year_q_from="2020q1", year_q_to="2021q1", dir_out=dir_rebuilt, **kwargs
+    )
+    if inputs == "index":
+        # The earlier quarters only drop the cases that a new one supersedes
+        assert "superseded cases" in caplog.text
+        assert "Marking" not in caplog.text
+    if inputs != "index_and_clusters":
+        assert "Appending 1 quarters" in caplog.text
+    appended = read_store(dir_appended)
+    rebuilt = read_store(dir_rebuilt)
+    assert sorted(appended) == ["2020q1", "2020q2", "2020q3", "2020q4"]
+    assert sorted(rebuilt) == sorted(appended)
+    for q in rebuilt:
+        pd.testing.assert_frame_equal(appended[q], rebuilt[q])
+    pd.testing.assert_series_equal(
+        mark_data.load_case_quarters(dir_appended).sort_index(),
+        mark_data.load_case_quarters(dir_rebuilt).sort_index(),
+    )
+
+
+def test_changed_quarter_is_removed_and_marked_again(
+    tmp_path, faers_dir, config_dir, caplog
+):
+    kwargs = dict(
+        year_q_from="2020q1",
+        year_q_to="2020q4",
+        dir_in=faers_dir,
+        config_dir=config_dir,
+        dir_out=str(tmp_path / "marked"),
+    )
+    mark_data.main(**kwargs)
+    before = read_store(kwargs["dir_out"])
+    caplog.set_level(logging.INFO, logger="FAERS")
+    mark_data.main(changed_quarters=["2020q2"], **kwargs)
+    removed = marked_store.quarter_filename(kwargs["dir_out"], "2020q2")
+    assert f"Removing {removed} because its input data changed" in caplog.text
+    after = read_store(kwargs["dir_out"])
+    assert sorted(after) == sorted(before)
+    for q in before:
+        pd.testing.assert_frame_equal(after[q], before[q])
@@ -0,0 +1,38 @@
+import os
+
+import luigi
+
+from pipeline import RefreshableTask
+
+
+class Counted(RefreshableTask):
+    dir_out = luigi.Parameter()
+
+    def output(self):
+        return luigi.LocalTarget(os.path.join(self.dir_out, "out.txt"))
+
+    def run(self):
+        fn_runs = os.path.join(self.dir_out, "runs.txt")
+        with open(fn_runs, "a") as fh:
+            fh.write(f"{self.refresh_stamp}\n")
+        with self.output().open("w") as fh:
+            fh.write("done")
+
+
+def runs(dir_out, refresh_stamp=""):
+    luigi.build(
+        [Counted(dir_out=str(dir_out), refresh_stamp=refresh_stamp)],
+        local_scheduler=True,
+    )
+    with open(os.path.join(dir_out, "runs.txt")) as fh:
+        return fh.read().split("\n")[:-1]
+
+
+def test_refresh_stamp_reruns_once(tmp_path):
+    assert runs(tmp_path) == [""]
+    assert runs(tmp_path) == [""]
+    assert runs(tmp_path, "2024-01-01") == ["", "2024-01-01"]
+    assert runs(tmp_path, "2024-01-01") == ["", "2024-01-01"]
+    assert runs(tmp_path, "2024-02-01") == ["", "2024-01-01", "2024-02-01"]
+    stamps = [fn for fn in os.listdir(tmp_path) if fn.startswith("_refreshed_")]
+    assert stamps == ["_refreshed_Counted_2024-02-01"]
@@ -0,0 +1,29 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+from src import report, utils
+
+
+def test_serious_outcomes_of_duplicate_clusters(tmp_path, faers_dir):
+    outcomes = report.load_serious_outcome_cases(faers_dir)
+    assert len(outcomes) > 0
+    without_outcome = sorted(
+        set(
+            utils.read_table(
+                os.path.join(faers_dir, "demo2020q1.parquet"), columns=["caseid"]
+            ).caseid
+        )
+        - set(outcomes)
+    )
+    # The outcome of a report counts for the cluster it belongs to
+    cluster, member = int(without_outcome[0]), int(outcomes[0])
+    fn_clusters = str(tmp_path / "clusters.parquet")
+    utils.write_table(
+        pd.DataFrame({"caseid": [cluster, member], "cluster": [cluster, cluster]}),
+        fn_clusters,
+    )
+    clustered = report.load_serious_outcome_cases(faers_dir, fn_clusters)
+    assert cluster in clustered and member not in clustered
+    assert np.all(np.diff(clustered) > 0)
@@ -0,0 +1,45 @@
+import logging
+import os
+
+import numpy as np
+import pandas as pd
+
+from src import utils
+
+
+def test_categorize_keeps_unknown_values(caplog):
+    df = pd.DataFrame(
+        {"sex": ["F", "M", None, "X"], "outc_cod": ["DE", "HO", "RI", "OT"]}
+    )
+    with caplog.at_level(logging.WARNING, logger="FAERS"):
+        df = utils.categorize(df)
+    assert df.outc_cod.dtype == utils.CATEGORICAL_DTYPES["outc_cod"]
+    assert df.sex.tolist()[:2] == ["F", "M"] and df.sex.tolist()[3] == "X"
+    assert pd.isna(df.sex[2])
+    assert list(df.sex.cat.categories) == ["F", "M", "NS", "UNK", "X"]
+    assert "Unknown sex values ['X']" in caplog.text
+
+    # Read back, e.g. from Parquet, the extra category is kept without a warning
+    caplog.clear()
+    with caplog.at_level(logging.WARNING, logger="FAERS"):
+        again = utils.categorize(df[["sex"]].astype(object))
+    assert again.sex.dtype == df.sex.dtype
+    assert not caplog.text
+    assert np.array_equal(again.sex.isna(), df.sex.isna())
+
+
+def test_chunk_rows_bounds_the_chunk_memory(faers_dir):
+    fn = os.path.join(faers_dir, "drug2020q1.parquet")
+    df = utils.read_table(fn)
+    bytes_per_row = df.memory_usage(deep=True).sum() / len(df)
+    assert utils.chunk_rows(fn, chunksize=1000) == 1000
+    rows = utils.chunk_rows(fn, max_bytes=int(10 * bytes_per_row), chunksize=1000)
+    assert 5 <= rows <= 20
+    chunks = list(utils.iter_table_chunks(fn, chunksize=rows))
+    assert max(len(c) for c in chunks) == rows
+    # The categories of the chunks are merged in another order
+    pd.testing.assert_frame_equal(
+        utils.concat_tables(chunks).reset_index(drop=True),
+        df,
+        check_categorical=False,
+    )
@@ -0,0 +1,34 @@
+import os
+import zipfile
+
+from src import verify_faers_data
+
+
+def write_archive(fn, text):
+    with zipfile.ZipFile(fn, "w") as zf:
+        zf.writestr("demo.csv", text)
+
+
+def test_verify_if_changed(tmp_path, monkeypatch):
+    fn = str(tmp_path / "demo2020q1.csv.zip")
+    write_archive(fn, 'caseid,sex\n1,"F"\n2,"M\nF"\n')
+    manifest = {}
+    record = verify_faers_data.verify_if_changed(fn, manifest)
+    assert record["ok"] and record["n_rows"] == 2
+    assert verify_faers_data.is_verified(str(tmp_path), manifest)
+
+    calls = []
+    monkeypatch.setattr(verify_faers_data, "verify_archive", calls.append)
+    assert verify_faers_data.verify_if_changed(fn, manifest) is record
+    assert calls == []
+
+
+def test_corrupt_archive(tmp_path):
+    fn = str(tmp_path / "demo2020q1.csv.zip")
+    write_archive(fn, "caseid\n1\n")
+    with open(fn, "r+b") as fh:
+        fh.seek(os.path.getsize(fn) // 3)
+        fh.write(b"\0" * 8)
+    manifest = {}
+    assert not verify_faers_data.verify_if_changed(fn, manifest)["ok"]
+    assert not verify_faers_data.is_verified(str(tmp_path), manifest)